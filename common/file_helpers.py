@@ -1,10 +1,13 @@
-import io
 import os
 import tempfile
 import contextlib
 import zstandard as zstd
+from collections.abc import Iterator
+from typing import IO
 
 LOG_COMPRESSION_LEVEL = 10 # little benefit up to level 15. level ~17 is a small step change
+UPLOAD_CHUNK_SIZE = 256 * 1024
+UPLOAD_SPOOL_SIZE = 16 * 1024 * 1024
 
 
 class CallbackReader:
@@ -41,14 +44,14 @@ def atomic_write_in_dir(path: str, mode: str = 'w', buffering: int = -1, encodin
   os.replace(tmp_file_name, path)
 
 
-def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.BufferedIOBase, int]:
+def get_upload_stream(filepath: str, should_compress: bool) -> tuple[IO[bytes], int]:
   if not should_compress:
     file_size = os.path.getsize(filepath)
     file_stream = open(filepath, "rb")
     return file_stream, file_size
 
-  # Compress the file on the fly
-  compressed_stream = io.BytesIO()
+  # Compress the file on the fly, big files spill over to disk rather than being held in memory
+  compressed_stream = tempfile.SpooledTemporaryFile(max_size=UPLOAD_SPOOL_SIZE)
   compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
 
   with open(filepath, "rb") as f:
@@ -56,3 +59,10 @@ def get_upload_stream(filepath: str, should_compress: bool) -> tuple[io.Buffered
     compressed_size = compressed_stream.tell()
     compressed_stream.seek(0)
     return compressed_stream, compressed_size
+
+
+def get_compressed_upload_chunks(filepath: str, chunk_size: int = UPLOAD_CHUNK_SIZE) -> Iterator[bytes]:
+  """Compresses the file as it's read, so uploading can start right away and never holds more than a chunk or so"""
+  compressor = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL)
+  with open(filepath, "rb") as f:
+    yield from compressor.read_to_iter(f, read_size=chunk_size, write_size=chunk_size)
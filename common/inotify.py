@@ -0,0 +1,102 @@
+import os
+import errno
+import ctypes
+import ctypes.util
+import select
+import struct
+import sys
+from typing import NamedTuple
+
+# inotify(7) event masks
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+_EVENT_HEADER = struct.Struct("iIII")  # wd, mask, cookie, len
+
+
+def _load_libc():
+  if not sys.platform.startswith("linux"):
+    return None
+  try:
+    libc = ctypes.CDLL(ctypes.util.find_library("c") or "libc.so.6", use_errno=True)
+  except OSError:
+    return None
+  if not all(hasattr(libc, f) for f in ("inotify_init1", "inotify_add_watch", "inotify_rm_watch")):
+    return None
+  libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+  return libc
+
+_libc = _load_libc()
+
+
+class InotifyEvent(NamedTuple):
+  wd: int
+  mask: int
+  cookie: int
+  name: str
+
+
+class Inotify:
+  """Watches paths for changes with Linux's inotify. Raises OSError where it isn't available"""
+  def __init__(self):
+    if _libc is None:
+      raise OSError(errno.ENOSYS, "inotify isn't available")
+    self.fd: int = _libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+    if self.fd < 0:
+      raise OSError(ctypes.get_errno(), "inotify_init1 failed")
+
+  def add_watch(self, path: str, mask: int) -> int:
+    wd: int = _libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+    if wd < 0:
+      err = ctypes.get_errno()
+      raise OSError(err, os.strerror(err), path)
+    return wd
+
+  def rm_watch(self, wd: int) -> None:
+    # the watch is already gone if its path was deleted
+    _libc.inotify_rm_watch(self.fd, wd)
+
+  def read(self, timeout: float | None = 0) -> list[InotifyEvent]:
+    """All queued events, waiting up to timeout seconds (forever if None) for the first one"""
+    if not select.select([self.fd], [], [], timeout)[0]:
+      return []
+
+    events = []
+    while True:
+      try:
+        buf = os.read(self.fd, 64 * 1024)
+      except BlockingIOError:
+        break
+
+      offset = 0
+      while offset < len(buf):
+        wd, mask, cookie, name_len = _EVENT_HEADER.unpack_from(buf, offset)
+        offset += _EVENT_HEADER.size
+        name = buf[offset:offset + name_len].rstrip(b"\0").decode(errors="surrogateescape")
+        offset += name_len
+        events.append(InotifyEvent(wd, mask, cookie, name))
+    return events
+
+  def fileno(self) -> int:
+    return self.fd
+
+  def close(self) -> None:
+    if self.fd >= 0:
+      os.close(self.fd)
+      self.fd = -1
+
+  def __enter__(self):
+    return self
+
+  def __exit__(self, *args):
+    self.close()
@@ -1,5 +1,9 @@
 import re
 import os
+import contextlib
+import hashlib
+import pickle
+import tempfile
 from dataclasses import dataclass
 from collections.abc import Callable
 
@@ -66,12 +70,18 @@ class Val:
   sigs: dict[str, Signal] | None = None
 
 
-BO_RE = re.compile(r"^BO_ (\w+) (\w+) *: (\w+) (\w+)")
-SG_RE = re.compile(r"^SG_ (\w+) : (\d+)\|(\d+)@(\d)([+-]) \(([0-9.+\-eE]+),([0-9.+\-eE]+)\) \[[0-9.+\-eE]+\|[0-9.+\-eE]+\] \".*\" .*")
-SGM_RE = re.compile(r"^SG_ (\w+) (\w+) *: (\d+)\|(\d+)@(\d)([+-]) \(([0-9.+\-eE]+),([0-9.+\-eE]+)\) \[[0-9.+\-eE]+\|[0-9.+\-eE]+\] \".*\" .*")
-VAL_RE = re.compile(r"^VAL_ (\w+) (\w+) (.*);")
+BO_PATTERN = r"BO_ (\w+) (\w+) *: (\w+) (\w+)"
+SG_PATTERN = r"SG_ (\w+) (?:\w+ *)?: (\d+)\|(\d+)@(\d)([+-]) \(([0-9.+\-eE]+),([0-9.+\-eE]+)\) \[[0-9.+\-eE]+\|[0-9.+\-eE]+\] \".*?\" "
+VAL_PATTERN = r"VAL_ (\w+) (\w+) (.*);"
+# one pass over the whole file, other lines are skipped by the regex engine. the outer
+# group of each alternative closes last, so Match.lastgroup tells the line type apart
+DBC_TOKEN_RE = re.compile(rf"^[ \t]*(?:(?P<BO>{BO_PATTERN})|(?P<SG>{SG_PATTERN})|(?P<VAL>{VAL_PATTERN}))", re.MULTILINE)
 VAL_SPLIT_RE = re.compile(r'["]+')
 
+# big endian (motorola) bit order, and each bit's position in it
+BE_BITS = [j + i * 8 for i in range(64) for j in range(7, -1, -1)]
+BE_BIT_INDEX = {bit: idx for idx, bit in enumerate(BE_BITS)}
+
 
 @dataclass
 class DBC:
@@ -82,81 +92,129 @@ class DBC:
   vals: list[Val]
 
   def __init__(self, name: str):
-    dbc_path = name
-    if not os.path.exists(dbc_path):
-      dbc_path = os.path.join(DBC_PATH, name + ".dbc")
-
-    self._parse(dbc_path)
+    self._parse(get_dbc_path(name))
 
   def _parse(self, path: str):
     self.name = os.path.basename(path).replace(".dbc", "")
     with open(path) as f:
-      lines = f.readlines()
+      content = f.read()
 
     checksum_state = get_checksum_state(self.name)
-    be_bits = [j + i * 8 for i in range(64) for j in range(7, -1, -1)]
     self.msgs: dict[int, Msg] = {}
     self.addr_to_msg: dict[int, Msg] = {}
     self.name_to_msg: dict[str, Msg] = {}
     self.vals: list[Val] = []
     address = 0
     signals_temp: dict[int, dict[str, Signal]] = {}
-    for line_num, line in enumerate(lines, 1):
-      line = line.strip()
-      if line.startswith("BO_ "):
-        m = BO_RE.match(line)
-        if not m:
-          continue
-        address = int(m.group(1), 0)
-        msg_name = m.group(2)
-        size = int(m.group(3), 0)
+    line_num, line_pos = 1, 0
+    for m in DBC_TOKEN_RE.finditer(content):
+      kind = m.lastgroup
+      if kind == "BO":
+        addr, msg_name, size = m.group(2, 3, 4)
+        address = int(addr, 0)
         sigs = {}
-        self.msgs[address] = Msg(msg_name, address, size, sigs)
+        self.msgs[address] = Msg(msg_name, address, int(size, 0), sigs)
         self.addr_to_msg[address] = self.msgs[address]
         self.name_to_msg[msg_name] = self.msgs[address]
         signals_temp[address] = sigs
-      elif line.startswith("SG_ "):
-        m = SG_RE.search(line)
-        offset = 0
-        if not m:
-          m = SGM_RE.search(line)
-          if not m:
-            continue
-          offset = 1
-        sig_name = m.group(1)
-        start_bit = int(m.group(2 + offset))
-        size = int(m.group(3 + offset))
-        is_little_endian = m.group(4 + offset) == "1"
-        is_signed = m.group(5 + offset) == "-"
-        factor = float(m.group(6 + offset))
-        offset_val = float(m.group(7 + offset))
+      elif kind == "SG":
+        sig_name, start_bit, size, endian, sign, factor, offset_val = m.group(7, 8, 9, 10, 11, 12, 13)
+        start_bit = int(start_bit)
+        size = int(size)
+        is_little_endian = endian == "1"
 
         if is_little_endian:
           lsb = start_bit
           msb = start_bit + size - 1
         else:
-          idx = be_bits.index(start_bit)
-          lsb = be_bits[idx + size - 1]
+          lsb = BE_BITS[BE_BIT_INDEX[start_bit] + size - 1]
           msb = start_bit
 
-        sig = Signal(sig_name, start_bit, msb, lsb, size, is_signed, factor, offset_val, is_little_endian)
+        line_num += content.count("\n", line_pos, m.start())
+        line_pos = m.start()
+        sig = Signal(sig_name, start_bit, msb, lsb, size, sign == "-", float(factor), float(offset_val), is_little_endian)
         set_signal_type(sig, checksum_state, self.name, line_num)
         signals_temp[address][sig_name] = sig
-      elif line.startswith("VAL_ "):
-        m = VAL_RE.search(line)
-        if not m:
-          continue
-        val_addr = int(m.group(1), 0)
-        sgname = m.group(2)
-        defs = m.group(3)
-        words = [w.strip() for w in VAL_SPLIT_RE.split(defs) if w.strip()]
-        words = [w.upper().replace(" ", "_") for w in words]
+      elif kind == "VAL":
+        val_addr, sgname, defs = m.group(15, 16, 17)
+        words = [w.strip().upper().replace(" ", "_") for w in VAL_SPLIT_RE.split(defs) if w.strip()]
         val_def = " ".join(words).strip()
-        self.vals.append(Val(sgname, val_addr, val_def))
+        self.vals.append(Val(sgname, int(val_addr, 0), val_def))
     for addr, sigs in signals_temp.items():
       self.msgs[addr].sigs = sigs
 
 
+# ***** shared DBCs *****
+
+# bump when the parse output changes, so stale pickles aren't loaded
+DBC_CACHE_VERSION = 1
+# pickles are only loaded by the dbc.py they were written by, so changes to DBC, Msg or Signal invalidate them too
+with open(__file__, "rb") as _f:
+  DBC_SOURCE_HASH = hashlib.sha1(_f.read()).hexdigest()[:16]
+# parsed DBCs are pickled here, keyed by path and mtime, set to an empty string to disable
+DBC_CACHE_DIR = os.environ.get("DBC_CACHE_DIR", os.path.join(os.path.expanduser("~"), ".cache", "opendbc"))
+
+_dbc_registry: dict[tuple[str, int], DBC] = {}
+
+
+def get_dbc_path(name: str) -> str:
+  if os.path.exists(name):
+    return name
+  return os.path.join(DBC_PATH, name + ".dbc")
+
+
+def _cache_file(path: str) -> str:
+  digest = hashlib.sha1(os.path.abspath(path).encode()).hexdigest()[:16]
+  return os.path.join(DBC_CACHE_DIR, f"{os.path.basename(path)}.{digest}.pkl")
+
+
+def _load_cached(path: str, mtime_ns: int) -> DBC | None:
+  try:
+    with open(_cache_file(path), "rb") as f:
+      version, source_hash, cached_mtime_ns, dbc = pickle.load(f)
+  except Exception:
+    # missing, corrupt or written by an incompatible version, just reparse
+    return None
+  if (version, source_hash) != (DBC_CACHE_VERSION, DBC_SOURCE_HASH) or cached_mtime_ns != mtime_ns or not isinstance(dbc, DBC):
+    return None
+  return dbc
+
+
+def _store_cached(path: str, mtime_ns: int, dbc: DBC) -> None:
+  tmp_name = None
+  try:
+    os.makedirs(DBC_CACHE_DIR, exist_ok=True)
+    with tempfile.NamedTemporaryFile("wb", dir=DBC_CACHE_DIR, delete=False) as f:
+      tmp_name = f.name
+      pickle.dump((DBC_CACHE_VERSION, DBC_SOURCE_HASH, mtime_ns, dbc), f, protocol=pickle.HIGHEST_PROTOCOL)
+    os.replace(tmp_name, _cache_file(path))
+  except Exception:
+    # caching is best effort, the parsed DBC is still used
+    if tmp_name is not None:
+      with contextlib.suppress(OSError):
+        os.unlink(tmp_name)
+
+
+def get_dbc(name: str) -> DBC:
+  """
+  Returns the parsed DBC for name, shared by every parser, packer and define in the process.
+  Other processes load it from the on-disk cache instead of reparsing, until the file changes.
+  """
+  path = get_dbc_path(name)
+  mtime_ns = os.stat(path).st_mtime_ns
+  key = (os.path.abspath(path), mtime_ns)
+
+  dbc = _dbc_registry.get(key)
+  if dbc is None:
+    dbc = _load_cached(path, mtime_ns) if DBC_CACHE_DIR else None
+    if dbc is None:
+      dbc = DBC(path)
+      if DBC_CACHE_DIR:
+        _store_cached(path, mtime_ns, dbc)
+    _dbc_registry[key] = dbc
+  return dbc
+
+
 # ***** checksum functions *****
 
 def ecar_setup_signal(sig: Signal, dbc_name: str, line_num: int) -> None:
@@ -1,41 +1,110 @@
 import math
+from dataclasses import dataclass
 
 from opendbc.car.carlog import carlog
-from opendbc.can.dbc import DBC, Signal, SignalType
+from opendbc.can.dbc import Msg, Signal, SignalType, get_dbc
+from opendbc.can.parser import compile_signal
+
+
+@dataclass
+class PackTemplate:
+  msg: Msg
+  # signal name -> (signal, is_big_endian, shift, mask), shift/mask are for the frame as an int in that byte order
+  signals: dict[str, tuple[Signal, bool, int, int]]
+  counter: Signal | None
+  checksum: Signal | None
+  # signals that overlap across byte orders or don't fit in the frame are packed with set_value
+  compiled: bool
+
+  @classmethod
+  def from_msg(cls, msg: Msg) -> 'PackTemplate':
+    signals = {}
+    plans = {name: compile_signal(sig, msg.size) for name, sig in msg.sigs.items()}
+    for name, sig in msg.sigs.items():
+      plan = plans[name]
+      is_be, shift, mask = plan[:3] if plan is not None else (False, 0, 0)
+      signals[name] = (sig, is_be, shift, mask)
+
+    counter = next((s for s in msg.sigs.values() if s.type == SignalType.COUNTER or s.name == "COUNTER"), None)
+    checksum = next((s for s in msg.sigs.values() if s.type > SignalType.COUNTER), None)
+    if checksum is not None and checksum.calc_checksum is None:
+      checksum = None
+
+    compiled = None not in plans.values()
+    if compiled:
+      # the two byte orders are packed separately and OR'd together, so a big and a
+      # little endian signal sharing bits wouldn't overwrite each other like set_value does
+      le_bits, be_bits = 0, 0
+      for sig in msg.sigs.values():
+        dat = bytearray(msg.size)
+        set_value(dat, sig, (1 << sig.size) - 1)
+        if sig.is_little_endian:
+          le_bits |= int.from_bytes(dat, "little")
+        else:
+          be_bits |= int.from_bytes(dat, "little")
+      compiled = (le_bits & be_bits) == 0
+
+    return cls(msg, signals, counter, checksum, compiled)
 
 
 class CANPacker:
   def __init__(self, dbc_name: str):
-    self.dbc = DBC(dbc_name)
+    self.dbc = get_dbc(dbc_name)
     self.counters: dict[int, int] = {}
+    self.templates: dict[int, PackTemplate] = {}
+
+  def get_template(self, address: int) -> PackTemplate | None:
+    tmpl = self.templates.get(address)
+    if tmpl is None:
+      msg = self.dbc.addr_to_msg.get(address)
+      if msg is None:
+        return None
+      tmpl = self.templates[address] = PackTemplate.from_msg(msg)
+    return tmpl
 
   def pack(self, address: int, values: dict[str, float]) -> bytearray:
-    msg = self.dbc.addr_to_msg.get(address)
-    if msg is None:
+    tmpl = self.get_template(address)
+    if tmpl is None:
       carlog.error(f"msg not found for {address=}")
       return bytearray()
-    dat = bytearray(msg.size)
+
+    size = tmpl.msg.size
+    words = [0, 0]  # little and big endian
+    ivals: list[tuple[Signal, int]] = []
     counter_set = False
     for name, value in values.items():
-      sig = msg.sigs.get(name)
-      if sig is None:
-        carlog.error(f"unknown signal {name=} in {msg.name}")
+      entry = tmpl.signals.get(name)
+      if entry is None:
+        carlog.error(f"unknown signal {name=} in {tmpl.msg.name}")
         continue
+      sig, is_be, shift, mask = entry
       ival = int(math.floor((value - sig.offset) / sig.factor + 0.5))
-      if ival < 0:
-        ival = (1 << sig.size) + ival
-      set_value(dat, sig, ival)
+      if tmpl.compiled:
+        words[is_be] = (words[is_be] & ~(mask << shift)) | ((ival & mask) << shift)
+      else:
+        ivals.append((sig, ival))
       if sig.type == SignalType.COUNTER or sig.name == "COUNTER":
         self.counters[address] = int(value)
         counter_set = True
-    sig_counter = next((s for s in msg.sigs.values() if s.type == SignalType.COUNTER or s.name == "COUNTER"), None)
-    if sig_counter and not counter_set:
-      if address not in self.counters:
-        self.counters[address] = 0
-      set_value(dat, sig_counter, self.counters[address])
-      self.counters[address] = (self.counters[address] + 1) % (1 << sig_counter.size)
-    sig_checksum = next((s for s in msg.sigs.values() if s.type > SignalType.COUNTER), None)
-    if sig_checksum and sig_checksum.calc_checksum:
+
+    sig_counter = tmpl.counter
+    if sig_counter is not None and not counter_set:
+      cnt = self.counters.get(address, 0)
+      if tmpl.compiled:
+        _, is_be, shift, mask = tmpl.signals[sig_counter.name]
+        words[is_be] = (words[is_be] & ~(mask << shift)) | ((cnt & mask) << shift)
+      else:
+        ivals.append((sig_counter, cnt))
+      self.counters[address] = (cnt + 1) % (1 << sig_counter.size)
+
+    dat = bytearray((words[0] | int.from_bytes(words[1].to_bytes(size, "big"), "little")).to_bytes(size, "little"))
+    for sig, ival in ivals:
+      if ival < 0:
+        ival = (1 << sig.size) + ival
+      set_value(dat, sig, ival)
+
+    sig_checksum = tmpl.checksum
+    if sig_checksum is not None and sig_checksum.calc_checksum is not None:
       checksum = sig_checksum.calc_checksum(address, sig_checksum, dat)
       set_value(dat, sig_checksum, checksum)
     return dat
@@ -54,6 +123,10 @@ class CANPacker:
       return 0, b'', bus
     return addr, bytes(dat), bus
 
+  def pack_many(self, msgs: list[tuple[str | int, int, dict[str, float]]]) -> list[tuple[int, bytes, int]]:
+    """Packs all of a cycle's (name_or_addr, bus, values) messages, same as calling make_can_msg on each."""
+    return [self.make_can_msg(name_or_addr, bus, values) for name_or_addr, bus, values in msgs]
+
 
 def set_value(msg: bytearray, sig: Signal, ival: int) -> None:
   i = sig.lsb // 8
@@ -1,15 +1,18 @@
 import math
 import numbers
 from collections import defaultdict, deque
+from collections.abc import Sequence
 from dataclasses import dataclass, field
 
+import numpy as np
+
 from opendbc.car.carlog import carlog
-from opendbc.can.dbc import DBC, Signal
-from opendbc.car.ecar.ecarcan import ecar_checksum
+from opendbc.can.dbc import DBC, Signal, get_dbc
 
 
 MAX_BAD_COUNTER = 5
 CAN_INVALID_CNT = 5
+DECODE_CACHE_SIZE = 256  # distinct payloads remembered per message
 
 
 def get_raw_value(dat: bytes | bytearray, sig: Signal) -> int:
@@ -27,6 +30,24 @@ def get_raw_value(dat: bytes | bytearray, sig: Signal) -> int:
   return ret
 
 
+def compile_signal(sig: Signal, size: int) -> tuple[bool, int, int, int, float, float] | None:
+  """
+  Precompute how to decode sig from a frame of size bytes with integer ops.
+  Returns (is_big_endian, shift, mask, sign_bit, factor, offset), where the raw value is
+  (int.from_bytes(dat, byteorder) >> shift) & mask, or None if the signal does not fit in the frame.
+  """
+  if not (0 <= sig.lsb < size * 8 and 0 <= sig.msb < size * 8):
+    return None
+  mask = (1 << sig.size) - 1
+  sign_bit = 1 << (sig.size - 1) if sig.is_signed else 0
+  if sig.is_little_endian:
+    shift = sig.lsb
+  else:
+    # in the big endian integer, byte i is the (size - 1 - i)-th byte from the bottom
+    shift = (size - 1 - sig.lsb // 8) * 8 + sig.lsb % 8
+  return not sig.is_little_endian, shift, mask, sign_bit, sig.factor, sig.offset
+
+
 @dataclass
 class MessageState:
   address: int
@@ -44,44 +65,151 @@ class MessageState:
   counter: int = 0
   counter_fail: int = 0
   first_seen_nanos: int = 0
+  decode_cache: dict[bytes, tuple[bool, list[int], list[float]]] = field(default_factory=dict, repr=False)
 
-  def parse(self, nanos: int, dat: bytes) -> bool:
-    tmp_vals: list[float] = [0.0] * len(self.signals)
-    checksum_failed = False
-    counter_failed = False
+  def __post_init__(self):
+    self.names: list[str] = [sig.name for sig in self.signals]
+    self.checksums: list[int] = [i for i, sig in enumerate(self.signals) if sig.calc_checksum is not None]
+    self.counters: list[int] = [i for i, sig in enumerate(self.signals) if sig.type == 1]  # COUNTER
 
-    if self.first_seen_nanos == 0:
-      self.first_seen_nanos = nanos
+    # extraction plan for full-length frames, falls back to get_raw_value if any signal doesn't fit
+    plan = [compile_signal(sig, self.size) for sig in self.signals]
+    self.plan: list[tuple[bool, int, int, int, float, float]] | None = None if None in plan else plan
+
+    if not self.vals:
+      self.vals = [0.0] * len(self.signals)
+      self.all_vals = [[] for _ in self.signals]
 
-    for i, sig in enumerate(self.signals):
+  def get_raw_values(self, dat: bytes, indices: Sequence[int]) -> list[int]:
+    ret = []
+    for i in indices:
+      sig = self.signals[i]
       tmp = get_raw_value(dat, sig)
       if sig.is_signed:
         tmp -= ((tmp >> (sig.size - 1)) & 0x1) * (1 << sig.size)
+      ret.append(tmp)
+    return ret
+
+  def decode(self, dat: bytes) -> list[float]:
+    if self.plan is None or len(dat) != self.size:
+      raw = self.get_raw_values(dat, range(len(self.signals)))
+      return [tmp * sig.factor + sig.offset for tmp, sig in zip(raw, self.signals, strict=True)]
+
+    # sign extension is ((v ^ sign_bit) - sign_bit), which is a no-op for unsigned signals
+    words = (int.from_bytes(dat, "little"), int.from_bytes(dat, "big"))
+    return [((((words[is_be] >> shift) & mask) ^ sign_bit) - sign_bit) * factor + offset
+            for is_be, shift, mask, sign_bit, factor, offset in self.plan]
+
+  def checksum_valid(self, dat: bytes) -> bool:
+    checksum_ok = True
+    for i, tmp in zip(self.checksums, self.get_raw_values(dat, self.checksums), strict=True):
+      sig = self.signals[i]
+      if sig.calc_checksum is not None and sig.calc_checksum(self.address, sig, bytearray(dat)) != tmp:
+        checksum_ok = False
+    return checksum_ok
+
+  def check_and_decode(self, dat: bytes) -> tuple[bool, list[int], list[float]]:
+    return self.checksum_valid(dat), self.get_raw_values(dat, self.counters), self.decode(dat)
 
-      if not self.ignore_checksum and sig.calc_checksum is not None:
-        if sig.calc_checksum(self.address, sig, bytearray(dat)) != tmp:
-          # print(f"little  {sig.is_little_endian} {hex(self.address)} {self.name} checks failed, {dat=} {dat.hex()=} checksum={sig.calc_checksum(self.address, sig, bytearray(dat))} {ecar_checksum(self.address, sig, bytearray(dat))} raw_value={tmp=}")
-          checksum_failed = True
+  def parse(self, nanos: int, dat: bytes) -> bool:
+    if self.first_seen_nanos == 0:
+      self.first_seen_nanos = nanos
 
-      if not self.ignore_counter and sig.type == 1:  # COUNTER
-        if not self.update_counter(tmp, sig.size):
+    # everything but the counter check is a pure function of the payload, and most
+    # messages cycle through a handful of payloads, so remember the decoded result
+    key = dat if isinstance(dat, bytes) else bytes(dat)
+    entry = self.decode_cache.get(key)
+    if entry is None:
+      entry = self.check_and_decode(key)
+      if len(self.decode_cache) >= DECODE_CACHE_SIZE:
+        self.decode_cache.clear()
+      self.decode_cache[key] = entry
+    checksum_ok, counter_vals, vals = entry
+
+    checksum_failed = not self.ignore_checksum and not checksum_ok
+    counter_failed = False
+    if not self.ignore_counter:
+      for i, tmp in zip(self.counters, counter_vals, strict=True):
+        if not self.update_counter(tmp, self.signals[i].size):
           counter_failed = True
 
-      tmp_vals[i] = tmp * sig.factor + sig.offset
-
     # must have good counter and checksum to update data
     if checksum_failed or counter_failed:
       carlog.warning(f"{hex(self.address)} {self.name} checks failed, {checksum_failed=} {counter_failed=}")
       return False
 
-    if not self.vals:
-      self.vals = [0.0] * len(self.signals)
-      self.all_vals = [[] for _ in self.signals]
+    self.vals = vals
+    for all_vals, v in zip(self.all_vals, vals, strict=True):
+      all_vals.append(v)
+
+    self.add_timestamp(nanos)
+    return True
 
-    for i, v in enumerate(tmp_vals):
-      self.vals[i] = v
-      self.all_vals[i].append(v)
+  def parse_batch(self, nanos: list[int], dats: list[bytes]) -> bool:
+    """
+    Decodes all frames of this message from one update in a single NumPy pass.
+    Equivalent to calling parse on each frame in order; returns True if any frame was valid.
+    """
+    # CAN FD frames don't fit in a uint64, those and odd length frames go frame by frame
+    if self.plan is None or self.size > 8 or any(len(dat) != self.size for dat in dats):
+      updated = False
+      for t, dat in zip(nanos, dats, strict=True):
+        updated |= self.parse(t, dat)
+      return updated
 
+    if self.first_seen_nanos == 0:
+      self.first_seen_nanos = nanos[0]
+
+    # pad to 8 bytes to get a uint64 per frame in each byte order, the padding
+    # sits below the big endian payload so those shifts move up by the pad size
+    n = len(dats)
+    padded = np.zeros((n, 8), dtype=np.uint8)
+    padded[:, :self.size] = np.frombuffer(b"".join(dats), dtype=np.uint8).reshape(n, self.size)
+    words = (padded.view("<u8")[:, 0], padded.view(">u8")[:, 0].astype(np.uint64))
+    be_pad = (8 - self.size) * 8
+
+    raw = []
+    for is_be, shift, mask, sign_bit, _, _ in self.plan:
+      v: np.ndarray = (words[is_be] >> np.uint64(shift + be_pad * is_be)) & np.uint64(mask)
+      if sign_bit:
+        v = v.view(np.int64) if sign_bit == 1 << 63 else (v.astype(np.int64) ^ sign_bit) - sign_bit
+      raw.append(v)
+
+    valid = np.ones(n, dtype=bool)
+    if not self.ignore_checksum:
+      for i in self.checksums:
+        sig = self.signals[i]
+        if sig.calc_checksum is not None:
+          valid &= np.array([sig.calc_checksum(self.address, sig, bytearray(dat)) for dat in dats]) == raw[i]
+
+    if not self.ignore_counter and self.counters:
+      counter_vals = [raw[i].tolist() for i in self.counters]
+      counter_sizes = [self.signals[i].size for i in self.counters]
+      for j in range(n):
+        for vals, size in zip(counter_vals, counter_sizes, strict=True):
+          if not self.update_counter(vals[j], size):
+            valid[j] = False
+
+    if not valid.all():
+      carlog.warning(f"{hex(self.address)} {self.name} checks failed for {n - valid.sum()} of {n} frames")
+      if not valid.any():
+        return False
+      raw = [v[valid] for v in raw]
+      nanos = np.asarray(nanos)[valid].tolist()
+
+    for i, (v, (_, _, _, _, factor, offset)) in enumerate(zip(raw, self.plan, strict=True)):
+      self.all_vals[i].extend((v * factor + offset).tolist())
+    self.vals = [all_vals[-1] for all_vals in self.all_vals]
+
+    # frequency is learned from the first timestamps, after that they can be added in bulk
+    for j, t in enumerate(nanos):
+      if self.frequency >= 1e-5:
+        self.timestamps.extend(nanos[j:])
+        break
+      self.add_timestamp(t)
+    return True
+
+  def add_timestamp(self, nanos: int) -> None:
     self.timestamps.append(nanos)
 
     if self.frequency < 1e-5 and len(self.timestamps) >= 3:
@@ -89,7 +217,6 @@ class MessageState:
       if (dt > 1.0 or len(self.timestamps) >= self.timestamps.maxlen) and dt != 0:
         self.frequency = min(len(self.timestamps) / dt, 100.0)
         self.timeout_threshold = (1_000_000_000 / self.frequency) * 10
-    return True
 
   def update_counter(self, cur_count: int, cnt_size: int) -> bool:
     if ((self.counter + 1) & ((1 << cnt_size) - 1)) != cur_count:
@@ -124,13 +251,15 @@ class CANParser:
   def __init__(self, dbc_name: str, messages: list[tuple[str | int, int]], bus: int):
     self.dbc_name: str = dbc_name
     self.bus: int = bus
-    self.dbc: DBC = DBC(dbc_name)
+    self.dbc: DBC = get_dbc(dbc_name)
 
     self.vl: dict[int | str, dict[str, float]] = VLDict(self)
     self.vl_all: dict[int | str, dict[str, list[float]]] = {}
     self.ts_nanos: dict[int | str, dict[str, int]] = {}
     self.addresses: set[int] = set()
     self.message_states: dict[int, MessageState] = {}
+    self._outputs: dict[int, tuple[dict[str, float], dict[str, int]]] = {}
+    self._updated_addrs: set[int] = set()
 
     for name_or_addr, freq in messages:
       if isinstance(name_or_addr, numbers.Number):
@@ -156,23 +285,24 @@ class CANParser:
     assert msg is not None
     assert msg.address not in self.addresses
 
+    state = MessageState(
+      address=msg.address,
+      name=msg.name,
+      size=msg.size,
+      signals=list(msg.sigs.values()),
+      ignore_alive=freq is not None and math.isnan(freq),
+    )
+
     self.addresses.add(msg.address)
     signal_names = list(msg.sigs.keys())
     signals_dict = {s: 0.0 for s in signal_names}
     dict.__setitem__(self.vl, msg.address, signals_dict)
     dict.__setitem__(self.vl, msg.name, signals_dict)
-    self.vl_all[msg.address] = defaultdict(list)
+    self.vl_all[msg.address] = defaultdict(list, zip(state.names, state.all_vals, strict=True))
     self.vl_all[msg.name] = self.vl_all[msg.address]
     self.ts_nanos[msg.address] = {s: 0 for s in signal_names}
     self.ts_nanos[msg.name] = self.ts_nanos[msg.address]
-
-    state = MessageState(
-      address=msg.address,
-      name=msg.name,
-      size=msg.size,
-      signals=list(msg.sigs.values()),
-      ignore_alive=freq is not None and math.isnan(freq),
-    )
+    self._outputs[msg.address] = (signals_dict, self.ts_nanos[msg.address])
     if freq is not None and freq > 0:
       state.frequency = freq
     else:
@@ -206,15 +336,22 @@ class CANParser:
     self.can_invalid_cnt = 0 if valid else min(self.can_invalid_cnt + 1, CAN_INVALID_CNT)
     return self.can_invalid_cnt < CAN_INVALID_CNT and counters_valid
 
-  def update(self, strings, sendcan: bool = False):
+  def update(self, strings, sendcan: bool = False, batch: bool = False):
+    """
+    Parses a list of (nanos, frames) and returns the set of updated addresses.
+    With batch, frames are grouped by address and each message is decoded in one
+    NumPy pass, which pays off for large drains like log replay and analysis.
+    """
     if strings and not isinstance(strings[0], list | tuple):
       strings = [strings]
 
-    for addr in self.addresses:
-      for k in self.vl_all[addr]:
-        self.vl_all[addr][k].clear()
+    # only messages updated by the previous call have anything to clear
+    for addr in self._updated_addrs:
+      for vals in self.message_states[addr].all_vals:
+        vals.clear()
 
     updated_addrs: set[int] = set()
+    batches: dict[int, tuple[list[int], list[bytes]]] = {}
     for entry in strings:
       t = entry[0]
       frames = entry[1]
@@ -226,29 +363,37 @@ class CANParser:
         state = self.message_states.get(address)
         if state is None or len(dat) > 64:
           continue
-        if state.parse(t, dat):
+        if batch:
+          if address not in batches:
+            batches[address] = ([], [])
+          batches[address][0].append(t)
+          batches[address][1].append(dat)
+        elif state.parse(t, dat):
           updated_addrs.add(address)
 
-          vl_addr = self.vl[address]
-          vl_all_addr = self.vl_all[address]
-          ts_addr = self.ts_nanos[address]
-
-          for i, sig in enumerate(state.signals):
-            vl_addr[sig.name] = state.vals[i]
-            vl_all_addr[sig.name] = state.all_vals[i]
-            ts_addr[sig.name] = state.timestamps[-1]
-
       if not bus_empty:
         self.last_nonempty_nanos = t
 
       self._last_update_nanos = t
 
+    for address, (nanos, dats) in batches.items():
+      if self.message_states[address].parse_batch(nanos, dats):
+        updated_addrs.add(address)
+
+    # only the latest values of each message are exposed in vl
+    for address in updated_addrs:
+      state = self.message_states[address]
+      vl_addr, ts_addr = self._outputs[address]
+      vl_addr.update(zip(state.names, state.vals, strict=True))
+      ts_addr.update(dict.fromkeys(state.names, state.timestamps[-1]))
+
+    self._updated_addrs = updated_addrs
     return updated_addrs
 
 
 class CANDefine:
   def __init__(self, dbc_name: str):
-    dbc = DBC(dbc_name)
+    dbc = get_dbc(dbc_name)
 
     dv = defaultdict(dict)
     for val in dbc.vals:
@@ -1,9 +1,11 @@
 #!/usr/bin/env python3
 import time
 from opendbc.can import CANPacker, CANParser
+from opendbc.can.dbc import DBC
+from opendbc.can.tests import ALL_DBCS
 
 
-def _benchmark(checks, n):
+def _benchmark(checks, n, unique=False, batch=False):
   parser = CANParser('toyota_new_mc_pt_generated', checks, 0)
   packer = CANPacker('toyota_new_mc_pt_generated')
 
@@ -11,6 +13,9 @@ def _benchmark(checks, n):
   can_msgs = []
   for i in range(10000):
     values = {"ACC_CONTROL": {"ACC_TYPE": 1, "ALLOW_LONG_PRESS": 3}}
+    if unique:
+      # defeat the parser's payload cache, every frame needs a full decode
+      values["ACC_CONTROL"]["ACCEL_CMD"] = (i % 10000) * 0.001
     msgs = [packer.make_can_msg(k, 0, v) for k, v in values.items()]
     can_msgs.append([int(0.01 * i * 1e9), msgs])
   t2 = time.process_time_ns()
@@ -24,7 +29,7 @@ def _benchmark(checks, n):
         strings.append(can_msgs[i:i + n])
       t1 = time.process_time_ns()
       for m in strings:
-        parser.update(m)
+        parser.update(m, batch=batch)
       t2 = time.process_time_ns()
     else:
       t1 = time.process_time_ns()
@@ -36,7 +41,22 @@ def _benchmark(checks, n):
 
   et = sum(ets) / len(ets)
   avg_nanos = et / len(can_msgs)
-  print('[%d] %.1fms to pack, %.1fms to parse %s messages, avg: %dns' % (n, pack_dt/1e6, et/1e6, len(can_msgs), avg_nanos))
+  mode = ''.join((', unique' if unique else '', ', batch' if batch else ''))
+  print('[%d%s] %.1fms to pack, %.1fms to parse %s messages, avg: %dns' % (n, mode, pack_dt/1e6, et/1e6, len(can_msgs), avg_nanos))
+
+
+def _benchmark_dbc(n):
+  # parses every DBC directly, bypassing the process and on-disk caches
+  ets = []
+  for _ in range(n):
+    t1 = time.process_time_ns()
+    for dbc in ALL_DBCS:
+      DBC(dbc)
+    t2 = time.process_time_ns()
+    ets.append(t2 - t1)
+
+  et = min(ets)
+  print('%.1fms to parse %d DBCs, avg: %dus' % (et/1e6, len(ALL_DBCS), et / len(ALL_DBCS) / 1e3))
 
 
 if __name__ == "__main__":
@@ -44,3 +64,8 @@ if __name__ == "__main__":
   _benchmark([('ACC_CONTROL', 10)], 1)
   _benchmark([('ACC_CONTROL', 10)], 5)
   _benchmark([('ACC_CONTROL', 10)], 10)
+  _benchmark([('ACC_CONTROL', 10)], 1, unique=True)
+  _benchmark([('ACC_CONTROL', 10)], 10, unique=True)
+  _benchmark([('ACC_CONTROL', 10)], 100, unique=True, batch=True)
+  _benchmark([('ACC_CONTROL', 10)], 10000, unique=True, batch=True)
+  _benchmark_dbc(10)
@@ -0,0 +1,9 @@
+import pytest
+
+from opendbc.can import dbc as dbc_module
+
+
+@pytest.fixture(autouse=True)
+def dbc_cache_dir(tmp_path_factory, monkeypatch):
+  # keep pickled DBCs out of the developer's ~/.cache
+  monkeypatch.setattr(dbc_module, "DBC_CACHE_DIR", str(tmp_path_factory.getbasetemp() / "dbc_cache"))
@@ -1,5 +1,14 @@
-from opendbc.can import CANParser
-from opendbc.can.tests import ALL_DBCS
+import os
+import random
+import shutil
+
+import pytest
+
+from opendbc.can import CANDefine, CANPacker, CANParser
+from opendbc.can import dbc as dbc_module
+from opendbc.can.dbc import DBC
+from opendbc.can.parser import MessageState
+from opendbc.can.tests import ALL_DBCS, TEST_DBC
 
 
 class TestDBCParser:
@@ -19,3 +28,92 @@ class TestDBCParser:
     for dbc in ALL_DBCS:
       with subtests.test(dbc=dbc):
         CANParser(dbc, [], 0)
+
+  def test_tokenizer(self, tmp_path):
+    dbc_path = tmp_path / "tokens.dbc"
+    dbc_path.write_bytes(b'\r\n'.join([
+      b'CM_ "SG_ and BO_ in a comment are ignored";',
+      b'BO_ 512 MUX: 8 XXX',
+      b' SG_ MUX_ID M : 7|8@0+ (1,0) [0|255] "" XXX',
+      b'\tSG_ MUXED m1 : 15|16@0- (0.5,-1) [0|0] "deg" XXX',
+      b' SG_ BROKEN : 7|8@0+ (1,0) "" XXX',
+      b' SG_ LE_SIGNAL : 32|12@1+ (1e-1,0) [0|1] "" XXX',
+      b'BO_ 0x201 HEX_ADDR: 8 XXX',
+      b'VAL_ 512 MUX_ID 1 "one" 2 "two words" ;',
+    ]))
+    dbc = DBC(str(dbc_path))
+
+    assert list(dbc.name_to_msg) == ["MUX", "HEX_ADDR"]
+    assert dbc.name_to_msg["HEX_ADDR"].address == 0x201
+    sigs = dbc.addr_to_msg[512].sigs
+    assert list(sigs) == ["MUX_ID", "MUXED", "LE_SIGNAL"]
+    assert (sigs["MUX_ID"].msb, sigs["MUX_ID"].lsb) == (7, 0)
+    assert (sigs["MUXED"].msb, sigs["MUXED"].lsb, sigs["MUXED"].is_signed) == (15, 16, True)
+    assert (sigs["MUXED"].factor, sigs["MUXED"].offset) == (0.5, -1)
+    assert (sigs["LE_SIGNAL"].msb, sigs["LE_SIGNAL"].lsb, sigs["LE_SIGNAL"].factor) == (43, 32, 0.1)
+    assert [(v.address, v.name, v.def_val) for v in dbc.vals] == [(512, "MUX_ID", "1 ONE 2 TWO_WORDS")]
+
+  def test_compiled_signals(self, subtests):
+    # the compiled shift/mask plan must decode exactly like the bit-by-bit reference
+    rng = random.Random(0)
+    for dbc in ALL_DBCS:
+      with subtests.test(dbc=dbc):
+        parser = CANParser(dbc, [], 0)
+        for msg in parser.dbc.msgs.values():
+          state = MessageState(msg.address, msg.name, msg.size, list(msg.sigs.values()))
+          for _ in range(10):
+            dat = rng.randbytes(msg.size)
+            expected = [tmp * sig.factor + sig.offset for tmp, sig in zip(state.get_raw_values(dat, range(len(state.signals))), state.signals, strict=True)]
+            assert state.decode(dat) == expected
+
+  def test_shared_dbc(self):
+    dbc_file = "honda_civic_touring_2016_can_generated"
+    dbc = CANParser(dbc_file, [], 0).dbc
+    assert CANParser(dbc_file, [], 0).dbc is dbc
+    assert CANPacker(dbc_file).dbc is dbc
+    assert CANDefine(dbc_file).dv
+
+  def test_dbc_cache(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(dbc_module, "DBC_CACHE_DIR", str(tmp_path / "cache"))
+    monkeypatch.setattr(dbc_module, "_dbc_registry", {})
+    dbc_path = str(tmp_path / "test.dbc")
+    shutil.copy(TEST_DBC, dbc_path)
+
+    # parsed once and pickled
+    dbc = dbc_module.get_dbc(dbc_path)
+    assert os.listdir(tmp_path / "cache") == [os.path.basename(dbc_module._cache_file(dbc_path))]
+
+    # another process loads the pickle instead of parsing
+    with monkeypatch.context() as m:
+      m.setattr(dbc_module, "_dbc_registry", {})
+      m.setattr(dbc_module.DBC, "_parse", lambda *args: pytest.fail("reparsed"))
+      cached = dbc_module.get_dbc(dbc_path)
+      assert cached is not dbc
+      assert cached.msgs == dbc.msgs
+
+    # changing the file invalidates both caches
+    st = os.stat(dbc_path)
+    with open(dbc_path, "a") as f:
+      f.write('\nBO_ 100 NEW_MESSAGE: 8 XXX\n SG_ NEW_SIGNAL : 0|8@1+ (1,0) [0|255] "" XXX\n')
+    os.utime(dbc_path, ns=(st.st_atime_ns, st.st_mtime_ns + 1_000_000))
+    assert "NEW_MESSAGE" in dbc_module.get_dbc(dbc_path).name_to_msg
+
+  def test_dbc_cache_invalidated_by_source(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(dbc_module, "DBC_CACHE_DIR", str(tmp_path / "cache"))
+    dbc = DBC(TEST_DBC)
+    mtime_ns = os.stat(TEST_DBC).st_mtime_ns
+    dbc_module._store_cached(TEST_DBC, mtime_ns, dbc)
+    assert dbc_module._load_cached(TEST_DBC, mtime_ns).msgs == dbc.msgs
+
+    # pickles written by a different dbc.py aren't loaded
+    monkeypatch.setattr(dbc_module, "DBC_SOURCE_HASH", "0" * 16)
+    assert dbc_module._load_cached(TEST_DBC, mtime_ns) is None
+
+  def test_dbc_cache_store_failure(self, tmp_path, monkeypatch):
+    monkeypatch.setattr(dbc_module, "DBC_CACHE_DIR", str(tmp_path / "cache"))
+
+    def fail(*args, **kwargs):
+      raise RecursionError
+    monkeypatch.setattr(dbc_module.pickle, "dump", fail)
+    dbc_module._store_cached(TEST_DBC, 0, DBC(TEST_DBC))
+    assert os.listdir(tmp_path / "cache") == []
@@ -1,8 +1,10 @@
+import math
 import pytest
 import random
 
 from opendbc.can import CANPacker, CANParser
-from opendbc.can.tests import TEST_DBC
+from opendbc.can.packer import set_value
+from opendbc.can.tests import ALL_DBCS, TEST_DBC
 
 MAX_BAD_COUNTER = 5
 
@@ -19,6 +21,38 @@ class TestCanParserPacker:
         assert bus == b
         assert dat[0] == i
 
+  def test_packer_templates(self, subtests):
+    # precompiled templates must pack exactly like setting each signal bit by bit
+    rng = random.Random(0)
+    for dbc in ALL_DBCS:
+      with subtests.test(dbc=dbc):
+        packer = CANPacker(dbc)
+        for msg in packer.dbc.msgs.values():
+          values = {name: rng.randrange(-(1 << (sig.size - 1)), 1 << sig.size) * sig.factor + sig.offset for name, sig in msg.sigs.items()}
+
+          expected = bytearray(msg.size)
+          for name, value in values.items():
+            sig = msg.sigs[name]
+            ival = int(math.floor((value - sig.offset) / sig.factor + 0.5))
+            set_value(expected, sig, (1 << sig.size) + ival if ival < 0 else ival)
+          checksum = packer.get_template(msg.address).checksum
+          if checksum is not None:
+            set_value(expected, checksum, checksum.calc_checksum(msg.address, checksum, expected))
+
+          assert packer.pack(msg.address, values) == expected
+
+  def test_pack_many(self):
+    packer = CANPacker(TEST_DBC)
+    many_packer = CANPacker(TEST_DBC)
+    msgs = [
+      ("STEERING_CONTROL", 0, {"STEER_TORQUE": 100, "STEER_TORQUE_REQUEST": 1}),
+      (316, 1, {"Signal1": 12345}),
+      ("CAN_FD_MESSAGE", 2, {"SIGNED": -10}),
+      ("UNKNOWN_MESSAGE", 0, {}),
+    ]
+    for _ in range(20):
+      assert many_packer.pack_many(msgs) == [packer.make_can_msg(*m) for m in msgs]
+
   def test_packer_counter(self):
     msgs = [("CAN_FD_MESSAGE", 0), ]
     packer = CANPacker(TEST_DBC)
@@ -175,6 +209,46 @@ class TestCanParserPacker:
         for sig in ("STEER_TORQUE", "STEER_TORQUE_REQUEST", "COUNTER", "CHECKSUM"):
           assert parser.vl["STEERING_CONTROL"][sig] == parser.vl[228][sig]
 
+  @pytest.mark.parametrize("dbc_file, msg_name", [
+    ("honda_civic_touring_2016_can_generated", "STEERING_CONTROL"),
+    ("subaru_global_2017_generated", "ES_LKAS"),
+    ("toyota_nodsu_pt_generated", "ACC_CONTROL"),
+    (TEST_DBC, "STEERING_CONTROL"),
+    (TEST_DBC, "CAN_FD_MESSAGE"),
+  ])
+  def test_batch_update(self, dbc_file, msg_name):
+    """Batch mode must give the same results as parsing frame by frame"""
+    packer = CANPacker(dbc_file)
+    parser = CANParser(dbc_file, [(msg_name, 0)], 0)
+    batch_parser = CANParser(dbc_file, [(msg_name, 0)], 0)
+    msg = parser.dbc.name_to_msg[msg_name]
+    rng = random.Random(0)
+
+    t = 0
+    for _ in range(20):
+      strings = []
+      for _ in range(rng.randrange(0, 50)):
+        t += 10_000_000
+        frames = []
+        for _ in range(rng.randrange(0, 3)):
+          if rng.random() < 0.1:
+            # random payloads exercise every bit and fail most checksums and counters
+            frames.append((msg.address, rng.randbytes(msg.size), 0))
+          else:
+            values = {name: rng.randrange(1 << min(sig.size, 16)) * sig.factor + sig.offset
+                      for name, sig in msg.sigs.items() if name not in ("COUNTER", "CHECKSUM")}
+            frames.append(packer.make_can_msg(msg_name, 0, values))
+        strings.append((t, frames))
+
+      assert parser.update(strings) == batch_parser.update(strings, batch=True)
+      assert parser.vl[msg_name] == batch_parser.vl[msg_name]
+      assert parser.vl_all[msg_name] == batch_parser.vl_all[msg_name]
+      assert parser.ts_nanos[msg_name] == batch_parser.ts_nanos[msg_name]
+      assert parser.can_valid == batch_parser.can_valid
+      state, batch_state = parser.message_states[msg.address], batch_parser.message_states[msg.address]
+      for attr in ("vals", "timestamps", "counter", "counter_fail", "frequency", "timeout_threshold", "first_seen_nanos"):
+        assert getattr(state, attr) == getattr(batch_state, attr), attr
+
   def test_scale_offset(self):
     """Test that both scale and offset are correctly preserved"""
     dbc_file = "honda_civic_touring_2016_can_generated"
@@ -13,17 +13,26 @@
 const bool PANDAD_MAXOUT = getenv("PANDAD_MAXOUT") != nullptr;
 
 Panda::Panda(std::string serial, uint32_t bus_offset) : bus_offset(bus_offset) {
+#ifndef __APPLE__
+  if (util::starts_with(serial, SOCKETCAN_PREFIX)) {
+    handle = std::make_unique<PandaSocketCanHandle>(serial);
+    LOGW("connected to %s over SocketCAN", serial.c_str());
+  }
+#endif
+
   // try USB first, then SPI
-  try {
-    handle = std::make_unique<PandaUsbHandle>(serial);
-    LOGW("connected to %s over USB", serial.c_str());
-  } catch (std::exception &e) {
+  if (!handle) {
+    try {
+      handle = std::make_unique<PandaUsbHandle>(serial);
+      LOGW("connected to %s over USB", serial.c_str());
+    } catch (std::exception &e) {
 #ifndef __APPLE__
-    handle = std::make_unique<PandaSpiHandle>(serial);
-    LOGW("connected to %s over SPI", serial.c_str());
+      handle = std::make_unique<PandaSpiHandle>(serial);
+      LOGW("connected to %s over SPI", serial.c_str());
 #else
-    throw e;
+      throw e;
 #endif
+    }
   }
 
   hw_type = get_hw_type();
@@ -52,6 +61,9 @@ std::vector<std::string> Panda::list(bool usb_only) {
         serials.push_back(s);
       }
     }
+    for (const auto &s : PandaSocketCanHandle::list()) {
+      serials.push_back(s);
+    }
   }
 #endif
 
@@ -136,6 +148,9 @@ std::optional<std::string> Panda::get_serial() {
 }
 
 bool Panda::up_to_date() {
+  if (util::starts_with(hw_serial(), SOCKETCAN_PREFIX)) {
+    return true;  // no firmware behind a CAN interface
+  }
   if (auto fw_sig = get_firmware_version()) {
     for (auto fn : { "panda.bin.signed", "panda_h7.bin.signed" }) {
       auto content = util::read_file(std::string("../../panda/board/obj/") + fn);
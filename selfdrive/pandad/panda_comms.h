@@ -4,6 +4,7 @@
 #include <cstdint>
 #include <mutex>
 #include <string>
+#include <utility>
 #include <vector>
 
 #ifndef __APPLE__
@@ -15,6 +16,8 @@
 
 #define TIMEOUT 0
 #define SPI_BUF_SIZE 2048
+#define SOCKETCAN_PREFIX "socketcan:"
+#define SOCKETCAN_BATCH 64
 
 
 // comms base class
@@ -90,4 +93,52 @@ private:
   spi_header header;
   uint32_t xfer_count = 0;
 };
+
+// serial is "socketcan:<ifname>[@<id>/<mask>...][,<ifname>...]", one interface per panda bus.
+// speaks the panda USB protocol on top of raw CAN sockets, so pandad doesn't need to know
+class PandaSocketCanHandle : public PandaCommsHandle {
+public:
+  PandaSocketCanHandle(std::string serial);
+  ~PandaSocketCanHandle();
+  int control_write(uint8_t request, uint16_t param1, uint16_t param2, unsigned int timeout=TIMEOUT);
+  int control_read(uint8_t request, uint16_t param1, uint16_t param2, unsigned char *data, uint16_t length, unsigned int timeout=TIMEOUT);
+  int bulk_write(unsigned char endpoint, unsigned char* data, int length, unsigned int timeout=TIMEOUT);
+  int bulk_read(unsigned char endpoint, unsigned char* data, int length, unsigned int timeout=TIMEOUT);
+  void cleanup();
+
+  static std::vector<std::string> list();
+
+private:
+  struct Bus {
+    int fd = -1;
+    std::string ifname;
+    std::vector<std::pair<uint32_t, uint32_t>> filters;  // (id, mask)
+    uint32_t rx_cnt = 0;
+    uint32_t tx_cnt = 0;
+    uint32_t rx_lost_cnt = 0;
+    uint32_t tx_lost_cnt = 0;
+    uint32_t error_cnt = 0;
+    uint32_t bus_off_cnt = 0;
+    bool bus_off = false;
+    bool error_warning = false;
+    bool error_passive = false;
+    uint8_t rx_error_cnt = 0;
+    uint8_t tx_error_cnt = 0;
+  };
+
+  std::vector<Bus> buses;
+  std::recursive_mutex hw_lock;
+  uint16_t safety_model = 0;
+  uint16_t safety_param = 0;
+  uint16_t alternative_experience = 0;
+  bool power_save = false;
+  bool loopback = false;
+  uint32_t safety_tx_blocked = 0;
+  uint64_t start_ts = 0;
+  uint64_t last_rx_ts = 0;
+
+  void open_bus(Bus &bus);
+  int recv_bus(uint8_t bus_num, unsigned char *data, int length);
+  void handle_socket_issue(int err, const char func[]);
+};
 #endif
@@ -13,6 +13,10 @@ from openpilot.system.hardware import HARDWARE
 from openpilot.common.swaglog import cloudlog
 
 
+SOCKETCAN_MIN_RUNTIME = 10  # seconds, pandad exiting sooner than this counts as a failed start
+SOCKETCAN_MAX_BACKOFF = 30  # seconds
+
+
 def get_expected_signature(panda: Panda) -> bytes:
   try:
     fn = os.path.join(FW_PATH, panda.get_mcu_type().config.app_fn)
@@ -79,6 +83,25 @@ def main() -> None:
   params = Params()
   no_internal_panda_count = 0
 
+  # SocketCAN boards have no firmware to flash, pandad opens the interfaces itself
+  socketcan = os.getenv("PANDAD_SOCKETCAN")
+  socketcan_failures = 0
+  while socketcan and not do_exit:
+    os.environ['MANAGER_DAEMON'] = 'pandad'
+    start = time.monotonic()
+    process = subprocess.Popen(["./pandad", f"socketcan:{socketcan}"], cwd=os.path.join(BASEDIR, "selfdrive/pandad"))
+    returncode = process.wait()
+    runtime = time.monotonic() - start
+
+    # e.g. the interface is missing, back off instead of respawning in a tight loop
+    if not do_exit:
+      socketcan_failures = socketcan_failures + 1 if runtime < SOCKETCAN_MIN_RUNTIME else 0
+      delay = min(2 ** socketcan_failures, SOCKETCAN_MAX_BACKOFF) if socketcan_failures else 1
+      cloudlog.event("pandad.socketcan_exited", returncode=returncode, runtime=runtime, retry_in=delay, error=True)
+      end = time.monotonic() + delay
+      while not do_exit and time.monotonic() < end:
+        time.sleep(0.1)
+
   while not do_exit:
     try:
       count += 1
@@ -0,0 +1,485 @@
+#ifndef __APPLE__
+#include <net/if.h>
+#include <sys/ioctl.h>
+#include <sys/socket.h>
+#include <unistd.h>
+#include <linux/can.h>
+#include <linux/can/error.h>
+#include <linux/can/raw.h>
+#include <linux/errqueue.h>
+#include <linux/net_tstamp.h>
+
+#include <algorithm>
+#include <cerrno>
+#include <cstring>
+#include <ctime>
+#include <sstream>
+#include <stdexcept>
+
+#include "cereal/gen/cpp/car.capnp.h"
+#include "common/swaglog.h"
+#include "common/timing.h"
+#include "common/util.h"
+#include "panda/board/can.h"
+#include "panda/board/health.h"
+#include "selfdrive/pandad/panda_comms.h"
+
+
+#define SOCKETCAN_CAN_OUT 3U
+#define SOCKETCAN_CAN_IN 0x81U
+
+const uint64_t SOCKETCAN_IGNITION_TIMEOUT = 2e9;  // nanoseconds without rx before the bus counts as off
+const uint64_t SOCKETCAN_RX_LATENCY_WARN = 20e6;  // nanoseconds a frame may wait in the socket
+const int SOCKETCAN_RCVBUF = 1 << 20;
+// the panda firmware's safety hooks don't run here, so by default only safety models that don't
+// rely on them may send. PANDAD_SOCKETCAN_UNSAFE_TX sends for any model that isn't silent
+const bool SOCKETCAN_UNSAFE_TX = getenv("PANDAD_SOCKETCAN_UNSAFE_TX") != nullptr;
+
+static bool safety_tx_allowed(uint16_t safety_model) {
+  if (safety_model == (uint16_t)cereal::CarParams::SafetyModel::ALL_OUTPUT) {
+    return true;
+  }
+  return SOCKETCAN_UNSAFE_TX && (safety_model != (uint16_t)cereal::CarParams::SafetyModel::SILENT) &&
+                                (safety_model != (uint16_t)cereal::CarParams::SafetyModel::NO_OUTPUT);
+}
+
+static uint8_t len_to_dlc(uint8_t len) {
+  uint8_t dlc = 0;
+  while (dlc < 15U && dlc_to_len[dlc] < len) {
+    dlc++;
+  }
+  return dlc;
+}
+
+static uint64_t nanos_realtime() {
+  struct timespec t;
+  clock_gettime(CLOCK_REALTIME, &t);
+  return t.tv_sec * 1000000000ULL + t.tv_nsec;
+}
+
+// sends as many frames as the kernel takes, returns the count and leaves errno set if short
+static int send_frames(int fd, struct canfd_frame *frames, int count) {
+  struct iovec iovs[SOCKETCAN_BATCH];
+  struct mmsghdr msgs[SOCKETCAN_BATCH] = {};
+  for (int i = 0; i < count; i++) {
+    iovs[i].iov_base = &frames[i];
+    iovs[i].iov_len = (frames[i].len > CAN_MAX_DLEN) ? CANFD_MTU : CAN_MTU;
+    msgs[i].msg_hdr.msg_iov = &iovs[i];
+    msgs[i].msg_hdr.msg_iovlen = 1;
+  }
+
+  int sent = 0;
+  while (sent < count) {
+    int ret = sendmmsg(fd, &msgs[sent], count - sent, MSG_DONTWAIT);
+    if (ret < 0) {
+      if (errno == EINTR) continue;
+      break;
+    }
+    sent += ret;
+  }
+  return sent;
+}
+
+PandaSocketCanHandle::PandaSocketCanHandle(std::string serial) : PandaCommsHandle(serial) {
+  if (!util::starts_with(serial, SOCKETCAN_PREFIX)) {
+    throw std::runtime_error("Error connecting to panda: not a SocketCAN serial");
+  }
+
+  std::stringstream spec(serial.substr(strlen(SOCKETCAN_PREFIX)));
+  std::string bus_spec;
+  while (std::getline(spec, bus_spec, ',')) {
+    std::stringstream parts(bus_spec);
+    std::string part;
+    Bus &bus = buses.emplace_back();
+    std::getline(parts, bus.ifname, '@');
+    while (std::getline(parts, part, '@')) {
+      size_t sep = part.find('/');
+      uint32_t id = strtoul(part.substr(0, sep).c_str(), nullptr, 0);
+      uint32_t mask = (sep == std::string::npos) ? CAN_EFF_MASK : strtoul(part.substr(sep + 1).c_str(), nullptr, 0);
+      bus.filters.push_back({id, mask});
+    }
+  }
+
+  if (buses.empty() || buses.size() > PANDA_CAN_CNT) {
+    throw std::runtime_error("Error connecting to panda: expected 1 to 3 SocketCAN interfaces");
+  }
+
+  try {
+    for (auto &bus : buses) {
+      open_bus(bus);
+    }
+  } catch (std::exception &e) {
+    cleanup();
+    throw;
+  }
+
+  hw_serial = serial;
+  start_ts = nanos_since_boot();
+}
+
+PandaSocketCanHandle::~PandaSocketCanHandle() {
+  std::lock_guard lk(hw_lock);
+  cleanup();
+  connected = false;
+}
+
+void PandaSocketCanHandle::open_bus(Bus &bus) {
+  bus.fd = socket(PF_CAN, SOCK_RAW | SOCK_NONBLOCK | SOCK_CLOEXEC, CAN_RAW);
+  if (bus.fd < 0) {
+    throw std::runtime_error("Error connecting to panda: failed to open CAN socket");
+  }
+
+  struct ifreq ifr = {};
+  strncpy(ifr.ifr_name, bus.ifname.c_str(), IFNAMSIZ - 1);
+  if (ioctl(bus.fd, SIOCGIFINDEX, &ifr) < 0) {
+    LOGE("CAN interface %s not found", bus.ifname.c_str());
+    throw std::runtime_error("Error connecting to panda: CAN interface not found");
+  }
+
+  int on = 1;
+  // classic CAN interfaces reject FD frames, that's fine
+  setsockopt(bus.fd, SOL_CAN_RAW, CAN_RAW_FD_FRAMES, &on, sizeof(on));
+  // our own frames come back with MSG_CONFIRM, reported as returned like the panda does
+  setsockopt(bus.fd, SOL_CAN_RAW, CAN_RAW_RECV_OWN_MSGS, &on, sizeof(on));
+  setsockopt(bus.fd, SOL_SOCKET, SO_RXQ_OVFL, &on, sizeof(on));
+  setsockopt(bus.fd, SOL_SOCKET, SO_RCVBUF, &SOCKETCAN_RCVBUF, sizeof(SOCKETCAN_RCVBUF));
+
+  int ts_flags = SOF_TIMESTAMPING_RX_SOFTWARE | SOF_TIMESTAMPING_SOFTWARE | SOF_TIMESTAMPING_RX_HARDWARE | SOF_TIMESTAMPING_RAW_HARDWARE;
+  if (setsockopt(bus.fd, SOL_SOCKET, SO_TIMESTAMPING, &ts_flags, sizeof(ts_flags)) < 0) {
+    LOGW("%s: SO_TIMESTAMPING not supported", bus.ifname.c_str());
+  }
+
+  can_err_mask_t err_mask = CAN_ERR_CRTL | CAN_ERR_BUSOFF | CAN_ERR_RESTARTED;
+  setsockopt(bus.fd, SOL_CAN_RAW, CAN_RAW_ERR_FILTER, &err_mask, sizeof(err_mask));
+
+  if (!bus.filters.empty()) {
+    std::vector<struct can_filter> filters;
+    for (auto &[id, mask] : bus.filters) {
+      filters.push_back({.can_id = id, .can_mask = mask});
+    }
+    if (setsockopt(bus.fd, SOL_CAN_RAW, CAN_RAW_FILTER, filters.data(), filters.size() * sizeof(struct can_filter)) < 0) {
+      throw std::runtime_error("Error connecting to panda: invalid CAN filter");
+    }
+  }
+
+  struct sockaddr_can addr = {};
+  addr.can_family = AF_CAN;
+  addr.can_ifindex = ifr.ifr_ifindex;
+  if (bind(bus.fd, (struct sockaddr *)&addr, sizeof(addr)) < 0) {
+    throw std::runtime_error("Error connecting to panda: failed to bind CAN socket");
+  }
+}
+
+void PandaSocketCanHandle::cleanup() {
+  for (auto &bus : buses) {
+    if (bus.fd >= 0) {
+      close(bus.fd);
+      bus.fd = -1;
+    }
+  }
+}
+
+std::vector<std::string> PandaSocketCanHandle::list() {
+  // e.g. PANDAD_SOCKETCAN=can0 or PANDAD_SOCKETCAN=vcan0,vcan1
+  const char *spec = getenv("PANDAD_SOCKETCAN");
+  if (spec == nullptr || strlen(spec) == 0) {
+    return {};
+  }
+  return {std::string(SOCKETCAN_PREFIX) + spec};
+}
+
+void PandaSocketCanHandle::handle_socket_issue(int err, const char func[]) {
+  LOGE_100("socketcan error %d \"%s\" in %s", err, strerror(err), func);
+  if (err == ENODEV || err == ENETDOWN || err == ENXIO) {
+    LOGE("lost connection");
+    connected = false;
+  }
+}
+
+int PandaSocketCanHandle::control_write(uint8_t request, uint16_t param1, uint16_t param2, unsigned int timeout) {
+  if (!connected) {
+    return -ENODEV;
+  }
+
+  std::lock_guard lk(hw_lock);
+  switch (request) {
+    case 0xdc:
+      safety_model = param1;
+      safety_param = param2;
+      break;
+    case 0xdf:
+      alternative_experience = param1;
+      break;
+    case 0xe5:
+      loopback = param1;
+      break;
+    case 0xe7:
+      power_save = param1;
+      break;
+    // bitrates are set on the interface (ip link), there's no fan, IR, or heartbeat
+    default:
+      break;
+  }
+  return 0;
+}
+
+int PandaSocketCanHandle::control_read(uint8_t request, uint16_t param1, uint16_t param2, unsigned char *data, uint16_t length, unsigned int timeout) {
+  if (!connected) {
+    return -ENODEV;
+  }
+
+  std::lock_guard lk(hw_lock);
+  const uint64_t now = nanos_since_boot();
+  switch (request) {
+    case 0xc1: {
+      if (length < 1) return 0;
+      data[0] = (uint8_t)cereal::PandaState::PandaType::UNKNOWN;
+      return 1;
+    }
+    case 0xd0: {
+      int len = std::min<int>(length, hw_serial.size());
+      memcpy(data, hw_serial.data(), len);
+      return len;
+    }
+    case 0xd2: {
+      health_t health = {};
+      health.uptime_pkt = (now - start_ts) / 1e9;
+      health.safety_tx_blocked_pkt = safety_tx_blocked;
+      for (const auto &bus : buses) {
+        health.tx_buffer_overflow_pkt += bus.tx_lost_cnt;
+        health.rx_buffer_overflow_pkt += bus.rx_lost_cnt;
+      }
+      // no ignition line, a live bus is the closest thing to ignition_can
+      health.ignition_can_pkt = (last_rx_ts != 0) && (now - last_rx_ts < SOCKETCAN_IGNITION_TIMEOUT);
+      // nothing enforces controls_allowed without the safety hooks, so it's never reported as set
+      health.controls_allowed_pkt = false;
+      health.car_harness_status_pkt = (uint8_t)cereal::PandaState::HarnessStatus::NORMAL;
+      health.safety_mode_pkt = safety_model;
+      health.safety_param_pkt = safety_param;
+      health.power_save_enabled_pkt = power_save;
+      health.alternative_experience_pkt = alternative_experience;
+      int len = std::min<int>(length, sizeof(health));
+      memcpy(data, &health, len);
+      return len;
+    }
+    case 0xc2: {
+      can_health_t can_health = {};
+      if (param1 < buses.size()) {
+        const Bus &bus = buses[param1];
+        can_health.bus_off = bus.bus_off;
+        can_health.bus_off_cnt = bus.bus_off_cnt;
+        can_health.error_warning = bus.error_warning;
+        can_health.error_passive = bus.error_passive;
+        can_health.receive_error_cnt = bus.rx_error_cnt;
+        can_health.transmit_error_cnt = bus.tx_error_cnt;
+        can_health.total_error_cnt = bus.error_cnt;
+        can_health.total_tx_lost_cnt = bus.tx_lost_cnt;
+        can_health.total_rx_lost_cnt = bus.rx_lost_cnt;
+        can_health.total_tx_cnt = bus.tx_cnt;
+        can_health.total_rx_cnt = bus.rx_cnt;
+      }
+      int len = std::min<int>(length, sizeof(can_health));
+      memcpy(data, &can_health, len);
+      return len;
+    }
+    // no firmware, serial console, or fan to read
+    default:
+      return 0;
+  }
+}
+
+int PandaSocketCanHandle::bulk_write(unsigned char endpoint, unsigned char* data, int length, unsigned int timeout) {
+  if (!connected || endpoint != SOCKETCAN_CAN_OUT) {
+    return 0;
+  }
+
+  std::lock_guard lk(hw_lock);
+  const bool tx_allowed = safety_tx_allowed(safety_model);
+
+  struct canfd_frame frames[PANDA_CAN_CNT][SOCKETCAN_BATCH];
+  int counts[PANDA_CAN_CNT] = {};
+  auto flush = [&](uint8_t bus_num) {
+    Bus &bus = buses[bus_num];
+    int sent = send_frames(bus.fd, frames[bus_num], counts[bus_num]);
+    bus.tx_cnt += sent;
+    if (sent < counts[bus_num]) {
+      // like USB, frames the kernel can't take right now are dropped
+      bus.tx_lost_cnt += counts[bus_num] - sent;
+      if (errno == ENOBUFS || errno == EAGAIN) {
+        LOGW_100("Transmit buffer full");
+      } else {
+        handle_socket_issue(errno, __func__);
+      }
+    }
+    counts[bus_num] = 0;
+  };
+
+  // same packing as Panda::pack_can_buffer
+  int pos = 0;
+  while (pos + (int)CANPACKET_HEAD_SIZE <= length) {
+    CANPacket_t pkt;
+    memcpy(&pkt, &data[pos], CANPACKET_HEAD_SIZE);
+    const uint8_t len = dlc_to_len[pkt.data_len_code];
+    if (pos + (int)CANPACKET_HEAD_SIZE + len > length) {
+      break;
+    }
+    const unsigned char *dat = &data[pos + CANPACKET_HEAD_SIZE];
+    pos += CANPACKET_HEAD_SIZE + len;
+
+    if (pkt.bus >= buses.size()) {
+      continue;
+    }
+    if (!tx_allowed) {
+      safety_tx_blocked++;
+      continue;
+    }
+
+    struct canfd_frame &frame = frames[pkt.bus][counts[pkt.bus]++];
+    frame = {};
+    frame.can_id = pkt.extended ? (pkt.addr | CAN_EFF_FLAG) : pkt.addr;
+    frame.len = len;
+    memcpy(frame.data, dat, len);
+
+    if (counts[pkt.bus] == SOCKETCAN_BATCH) {
+      flush(pkt.bus);
+    }
+  }
+
+  for (uint8_t i = 0; i < buses.size(); i++) {
+    if (counts[i] > 0) {
+      flush(i);
+    }
+  }
+  return pos;
+}
+
+int PandaSocketCanHandle::bulk_read(unsigned char endpoint, unsigned char* data, int length, unsigned int timeout) {
+  if (!connected || endpoint != SOCKETCAN_CAN_IN) {
+    return 0;
+  }
+
+  std::lock_guard lk(hw_lock);
+  int pos = 0;
+  for (uint8_t i = 0; i < buses.size() && connected; i++) {
+    pos += recv_bus(i, &data[pos], length - pos);
+  }
+  return pos;
+}
+
+int PandaSocketCanHandle::recv_bus(uint8_t bus_num, unsigned char *data, int length) {
+  Bus &bus = buses[bus_num];
+  struct canfd_frame frames[SOCKETCAN_BATCH];
+  struct iovec iovs[SOCKETCAN_BATCH];
+  struct mmsghdr msgs[SOCKETCAN_BATCH];
+  alignas(struct cmsghdr) char ctrl[SOCKETCAN_BATCH][CMSG_SPACE(sizeof(struct scm_timestamping)) + CMSG_SPACE(sizeof(uint32_t))];
+
+  int pos = 0;
+  uint64_t max_latency = 0;
+  while (true) {
+    // only take what's guaranteed to fit, the rest waits in the socket for the next read
+    int count = std::min<int>(SOCKETCAN_BATCH, (length - pos) / (CANPACKET_HEAD_SIZE + CANFD_MAX_DLEN));
+    if (count <= 0) {
+      break;
+    }
+
+    for (int i = 0; i < count; i++) {
+      iovs[i].iov_base = &frames[i];
+      iovs[i].iov_len = sizeof(frames[i]);
+      msgs[i].msg_hdr = {};
+      msgs[i].msg_hdr.msg_iov = &iovs[i];
+      msgs[i].msg_hdr.msg_iovlen = 1;
+      msgs[i].msg_hdr.msg_control = ctrl[i];
+      msgs[i].msg_hdr.msg_controllen = sizeof(ctrl[i]);
+    }
+
+    int n = recvmmsg(bus.fd, msgs, count, MSG_DONTWAIT, nullptr);
+    if (n < 0) {
+      if (errno != EAGAIN && errno != EWOULDBLOCK && errno != EINTR) {
+        handle_socket_issue(errno, __func__);
+      }
+      break;
+    }
+
+    const uint64_t now_realtime = nanos_realtime();
+    for (int i = 0; i < n; i++) {
+      const struct msghdr &hdr = msgs[i].msg_hdr;
+      for (struct cmsghdr *cmsg = CMSG_FIRSTHDR(&hdr); cmsg != nullptr; cmsg = CMSG_NXTHDR((struct msghdr *)&hdr, cmsg)) {
+        if (cmsg->cmsg_level != SOL_SOCKET) continue;
+        if (cmsg->cmsg_type == SO_TIMESTAMPING) {
+          // ts[0] is the kernel software timestamp on CLOCK_REALTIME, ts[2] the raw controller clock
+          struct scm_timestamping ts;
+          memcpy(&ts, CMSG_DATA(cmsg), sizeof(ts));
+          uint64_t rx_ts = ts.ts[0].tv_sec * 1000000000ULL + ts.ts[0].tv_nsec;
+          if (rx_ts != 0 && now_realtime > rx_ts) {
+            max_latency = std::max(max_latency, now_realtime - rx_ts);
+          }
+        } else if (cmsg->cmsg_type == SO_RXQ_OVFL) {
+          memcpy(&bus.rx_lost_cnt, CMSG_DATA(cmsg), sizeof(uint32_t));
+        }
+      }
+
+      const struct canfd_frame &frame = frames[i];
+      if (frame.can_id & CAN_ERR_FLAG) {
+        bus.error_cnt++;
+        if (frame.can_id & CAN_ERR_BUSOFF) {
+          bus.bus_off_cnt += !bus.bus_off;
+          bus.bus_off = true;
+        }
+        if (frame.can_id & CAN_ERR_RESTARTED) {
+          bus.bus_off = bus.error_warning = bus.error_passive = false;
+        }
+        if (frame.can_id & CAN_ERR_CRTL) {
+          bus.error_warning |= (frame.data[1] & (CAN_ERR_CRTL_RX_WARNING | CAN_ERR_CRTL_TX_WARNING)) != 0;
+          bus.error_passive |= (frame.data[1] & (CAN_ERR_CRTL_RX_PASSIVE | CAN_ERR_CRTL_TX_PASSIVE)) != 0;
+#ifdef CAN_ERR_CRTL_ACTIVE
+          if (frame.data[1] & CAN_ERR_CRTL_ACTIVE) {
+            bus.error_warning = bus.error_passive = false;
+          }
+#endif
+        }
+#ifdef CAN_ERR_CNT
+        if (frame.can_id & CAN_ERR_CNT) {
+          bus.tx_error_cnt = frame.data[6];
+          bus.rx_error_cnt = frame.data[7];
+        }
+#endif
+        continue;
+      }
+
+      const bool own = hdr.msg_flags & MSG_CONFIRM;
+      if (!own) {
+        bus.rx_cnt++;
+        last_rx_ts = nanos_since_boot();
+      }
+
+      const uint8_t len = std::min<uint8_t>(frame.len, CANFD_MAX_DLEN);
+      CANPacket_t pkt = {};
+      pkt.bus = bus_num;
+      pkt.data_len_code = len_to_dlc(len);
+      pkt.returned = own && !loopback;
+      pkt.extended = (frame.can_id & CAN_EFF_FLAG) != 0;
+      pkt.addr = frame.can_id & (pkt.extended ? CAN_EFF_MASK : CAN_SFF_MASK);
+      memcpy(pkt.data, frame.data, len);
+
+      const uint32_t pkt_len = CANPACKET_HEAD_SIZE + dlc_to_len[pkt.data_len_code];
+      uint8_t checksum = 0U;
+      for (uint32_t j = 0U; j < pkt_len; j++) {
+        checksum ^= ((uint8_t *)&pkt)[j];
+      }
+      pkt.checksum = checksum;
+
+      memcpy(&data[pos], &pkt, pkt_len);
+      pos += pkt_len;
+    }
+
+    if (n < count) {
+      break;  // socket drained
+    }
+  }
+
+  if (max_latency > SOCKETCAN_RX_LATENCY_WARN) {
+    LOGW_100("%s: frames waited %.1f ms in the socket", bus.ifname.c_str(), max_latency / 1e6);
+  }
+  return pos;
+}
+#endif
@@ -1,12 +1,20 @@
 #!/usr/bin/env python3
 import sys
 import math
+import time
+import argparse
 import capnp
 import numbers
+import functools
+import itertools
 import dictdiffer
-from collections import Counter
+import numpy as np
+from collections import Counter, defaultdict
+from operator import attrgetter
 
+from cereal import log
 from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.log_time_series import CAPNP_DTYPES
 
 EPSILON = sys.float_info.epsilon
 
@@ -39,7 +47,134 @@ def remove_ignored_fields(msg, ignore):
   return msg
 
 
-def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None,):
+def structural_diff(msg1, msg2, ignore_fields, tolerance):
+  msg1_dict = msg1.to_dict(verbose=True)
+  msg2_dict = msg2.to_dict(verbose=True)
+
+  dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
+
+  # Dictdiffer only supports relative tolerance, we also want to check for absolute
+  # TODO: add this to dictdiffer
+  def outside_tolerance(diff):
+    try:
+      if diff[0] == "change":
+        a, b = diff[2]
+        finite = math.isfinite(a) and math.isfinite(b)
+        if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
+          return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
+    except TypeError:
+      pass
+    return True
+
+  return list(filter(outside_tolerance, dd))
+
+
+def _compared_fields(schema, prefix):
+  """
+    Splits a struct into fields compared as columns, with their dtype and whether they're lists of numbers,
+    and fields that are compared whole. Unions are compared whole, since which member is set can differ.
+  """
+  columns, whole = [], []
+  if len(schema.union_fields):
+    return columns, [prefix]
+
+  for name in schema.non_union_fields:
+    field = schema.fields[name]
+    path = f"{prefix}.{name}"
+    typ = field.proto.slot.type if field.proto.which() == 'slot' else None
+    kind = None if typ is None else typ.which()
+    if typ is None or kind == 'struct':
+      sub_columns, sub_whole = _compared_fields(field.schema, path)
+      columns += sub_columns
+      whole += sub_whole
+    elif kind == 'list' and typ.list.elementType.which() in CAPNP_DTYPES and typ.list.elementType.which() not in ('enum', 'text', 'data'):
+      columns.append((path, CAPNP_DTYPES[typ.list.elementType.which()], True))
+    elif kind in CAPNP_DTYPES and kind not in ('text', 'data'):
+      columns.append((path + ".raw" if kind == 'enum' else path, CAPNP_DTYPES[kind], False))
+    elif kind != 'void':
+      whole.append(path)
+  return columns, whole
+
+
+@functools.cache
+def compared_fields(service):
+  """Fields of an event of service that are compared as columns and whole, see _compared_fields"""
+  field = log.Event.schema.fields[service]
+  typ = field.proto.slot.type
+  if typ.which() == 'struct':
+    columns, whole = _compared_fields(field.schema, service)
+  elif typ.which() in CAPNP_DTYPES and typ.which() not in ('enum', 'text', 'data'):
+    columns, whole = [(service, CAPNP_DTYPES[typ.which()], False)], []
+  else:
+    columns, whole = [], [service]
+  return [("logMonoTime", np.uint64, False), ("valid", np.bool_, False), *columns], whole
+
+
+def _within_tolerance(a, b, tolerance):
+  # stricter than structural_diff: anything that isn't clearly the same, like two large ints within tolerance, is diffed structurally
+  if a.dtype.kind != 'f':
+    return a == b
+
+  a, b = a.astype(np.float64), b.astype(np.float64)
+  with np.errstate(invalid='ignore', over='ignore'):
+    d = np.abs(a - b)
+    return (a == b) | (np.isnan(a) & np.isnan(b)) | (np.isfinite(d) & (d <= np.maximum(tolerance, tolerance * np.maximum(np.abs(a), np.abs(b)))))
+
+
+def _to_python(v):
+  if hasattr(v, 'to_dict'):
+    return v.to_dict()
+  if isinstance(v, (capnp.lib.capnp._DynamicListReader, capnp.lib.capnp._DynamicListBuilder)):
+    return [_to_python(x) for x in v]
+  return v
+
+
+def _values(structs, msgs, path):
+  # getting a nested struct is about as slow as getting a field, so each struct is only gotten once, for all its fields
+  if path not in structs:
+    parent, _, name = path.rpartition('.')
+    structs[path] = list(map(attrgetter(name), _values(structs, msgs, parent) if parent else msgs))
+  return structs[path]
+
+
+def within_tolerance(msgs1, msgs2, service, tolerance):
+  """
+    Which message pairs of a service are the same within tolerance, checked a field at a time across all pairs.
+    Pairs that aren't might still be, if the difference is in a way that's only clear from a structural diff.
+  """
+  n = len(msgs1)
+  columns, whole = compared_fields(service)
+  same = np.ones(n, dtype=bool)
+  structs1, structs2 = {}, {}
+  for path, dtype, is_list in columns:
+    parent, _, name = path.rpartition('.')
+    getter = attrgetter(name)
+    parents1 = _values(structs1, msgs1, parent) if parent else msgs1
+    parents2 = _values(structs2, msgs2, parent) if parent else msgs2
+    if not is_list:
+      a = np.fromiter(map(getter, parents1), dtype, count=n)
+      b = np.fromiter(map(getter, parents2), dtype, count=n)
+      same &= _within_tolerance(a, b, tolerance)
+      continue
+
+    lists1, lists2 = list(map(getter, parents1)), list(map(getter, parents2))
+    lens1 = np.fromiter(map(len, lists1), np.int64, count=n)
+    lens2 = np.fromiter(map(len, lists2), np.int64, count=n)
+    same &= lens1 == lens2
+    idxs = np.flatnonzero(same)
+    a = np.fromiter(itertools.chain.from_iterable(lists1[i] for i in idxs), dtype, count=lens1[idxs].sum())
+    b = np.fromiter(itertools.chain.from_iterable(lists2[i] for i in idxs), dtype, count=lens1[idxs].sum())
+    same[np.repeat(idxs, lens1[idxs])[~_within_tolerance(a, b, tolerance)]] = False
+
+  for path in whole:
+    getter = attrgetter(path)
+    for i in np.flatnonzero(same):
+      if _to_python(getter(msgs1[i])) != _to_python(getter(msgs2[i])):
+        same[i] = False
+  return same
+
+
+def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=None, vectorized=True):
   if ignore_fields is None:
     ignore_fields = []
   if ignore_msgs is None:
@@ -56,8 +191,9 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     cnt2 = Counter(m.which() for m in log2)
     raise Exception(f"logs are not same length: {len(log1)} VS {len(log2)}\n\t\t{cnt1}\n\t\t{cnt2}")
 
-  diff = []
-  for msg1, msg2 in zip(log1, log2, strict=True):
+  # pairs that differ byte for byte, by service
+  changed = defaultdict(list)
+  for i, (msg1, msg2) in enumerate(zip(log1, log2, strict=True)):
     if msg1.which() != msg2.which():
       raise Exception("msgs not aligned between logs")
 
@@ -65,27 +201,20 @@ def compare_logs(log1, log2, ignore_fields=None, ignore_msgs=None, tolerance=Non
     msg2 = remove_ignored_fields(msg2, ignore_fields)
 
     if msg1.to_bytes() != msg2.to_bytes():
-      msg1_dict = msg1.as_reader().to_dict(verbose=True)
-      msg2_dict = msg2.as_reader().to_dict(verbose=True)
-
-      dd = dictdiffer.diff(msg1_dict, msg2_dict, ignore=ignore_fields)
-
-      # Dictdiffer only supports relative tolerance, we also want to check for absolute
-      # TODO: add this to dictdiffer
-      def outside_tolerance(diff):
-        try:
-          if diff[0] == "change":
-            a, b = diff[2]
-            finite = math.isfinite(a) and math.isfinite(b)
-            if finite and isinstance(a, numbers.Number) and isinstance(b, numbers.Number):
-              return abs(a - b) > max(tolerance, tolerance * max(abs(a), abs(b)))
-        except TypeError:
-          pass
-        return True
-
-      dd = list(filter(outside_tolerance, dd))
-
-      diff.extend(dd)
+      changed[msg1.which()].append((i, msg1.as_reader(), msg2.as_reader()))
+
+  # most of these are usually within tolerance, only the rest need the much slower structural diff
+  to_diff = []
+  for service, pairs in changed.items():
+    if vectorized:
+      _, msgs1, msgs2 = zip(*pairs, strict=True)
+      same = within_tolerance(msgs1, msgs2, service, tolerance)
+      pairs = [p for p, s in zip(pairs, same, strict=True) if not s]
+    to_diff += pairs
+
+  diff = []
+  for _, msg1, msg2 in sorted(to_diff, key=lambda p: p[0]):
+    diff.extend(structural_diff(msg1, msg2, ignore_fields, tolerance))
   return diff
 
 
@@ -139,11 +268,30 @@ def format_diff(results, log_paths, ref_commit):
 
 
 if __name__ == "__main__":
-  log1 = list(LogReader(sys.argv[1]))
-  log2 = list(LogReader(sys.argv[2]))
-  ignore_fields = sys.argv[3:] or ["logMonoTime"]
-  results = {"segment": {"proc": compare_logs(log1, log2, ignore_fields)}}
-  log_paths = {"segment": {"proc": {"ref": sys.argv[1], "new": sys.argv[2]}}}
+  parser = argparse.ArgumentParser(description="Compare two logs, e.g. a reference log and a new one from process replay")
+  parser.add_argument("log1")
+  parser.add_argument("log2")
+  parser.add_argument("ignore_fields", nargs="*", default=["logMonoTime"])
+  parser.add_argument("--benchmark", action="store_true", help="Time the structural and vectorized comparison and check they agree")
+  args = parser.parse_args()
+
+  log1 = list(LogReader(args.log1))
+  log2 = list(LogReader(args.log2))
+
+  if args.benchmark:
+    times, diffs = {}, {}
+    for vectorized in (False, True):
+      st = time.monotonic()
+      diffs[vectorized] = compare_logs(log1, log2, args.ignore_fields, vectorized=vectorized)
+      times[vectorized] = time.monotonic() - st
+    # as text, since diffs with a NaN aren't equal to themselves
+    assert list(map(repr, diffs[False])) == list(map(repr, diffs[True])), "vectorized comparison doesn't match structural comparison"
+    print(f"{len(log1)} msgs, {len(diffs[True])} diffs")
+    print(f"structural: {times[False]:.2f} s, vectorized: {times[True]:.2f} s ({times[False] / times[True]:.1f}x)")
+    sys.exit(0)
+
+  results = {"segment": {"proc": compare_logs(log1, log2, args.ignore_fields)}}
+  log_paths = {"segment": {"proc": {"ref": args.log1, "new": args.log2}}}
   diff_short, diff_long, failed = format_diff(results, log_paths, None)
 
   print(diff_long)
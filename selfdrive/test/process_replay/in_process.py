@@ -0,0 +1,179 @@
+import importlib.util
+import threading
+import time
+from typing import Any
+
+import capnp
+
+import cereal.messaging as messaging
+
+# python daemons whose main loop only talks to the outside through SubMaster, PubMaster, sub_sock and drain_sock
+IN_PROCESS_DAEMONS = {
+  "locationd": "openpilot.selfdrive.locationd.locationd",
+  "paramsd": "openpilot.selfdrive.locationd.paramsd",
+  "calibrationd": "openpilot.selfdrive.locationd.calibrationd",
+  "torqued": "openpilot.selfdrive.locationd.torqued",
+  "lagd": "openpilot.selfdrive.locationd.lagd",
+  "radard": "openpilot.selfdrive.controls.radard",
+  "plannerd": "openpilot.selfdrive.controls.plannerd",
+  "controlsd": "openpilot.selfdrive.controls.controlsd",
+}
+
+
+class _StopDaemon(BaseException):
+  # BaseException so the daemon's own exception handling doesn't catch it
+  pass
+
+
+def _no_socket(*args, **kwargs) -> None:
+  return None
+
+
+class InProcessSubMaster(messaging.SubMaster):
+  def __init__(self, daemon: 'InProcessDaemon', *args, **kwargs):
+    # SubMaster's state is set up as usual, just without opening a msgq socket per service or a poller.
+    # swapping them on the module is safe since daemons only run while the replay waits on them
+    sub_sock, poller = messaging.sub_sock, messaging.Poller
+    messaging.sub_sock, messaging.Poller = _no_socket, _no_socket
+    try:
+      super().__init__(*args, **kwargs)
+    finally:
+      messaging.sub_sock, messaging.Poller = sub_sock, poller
+    self._daemon = daemon
+
+  def update(self, timeout: int = 100) -> None:
+    # the sockets are conflated, only the latest message of each service gets through
+    latest = {}
+    for msg in self._daemon.wait_for_step():
+      if msg.which() in self.data:
+        latest[msg.which()] = msg
+    self.update_msgs(time.monotonic(), list(latest.values()))
+
+
+class InProcessPubMaster:
+  def __init__(self, daemon: 'InProcessDaemon', services: list[str]):
+    self._daemon = daemon
+    self.services = services
+
+  def send(self, s: str, dat: bytes | capnp.lib.capnp._DynamicStructBuilder) -> None:
+    # copied since the daemon may keep writing to its builder, and logMonoTime gets replaced later on
+    msg = messaging.log_from_bytes(dat).as_builder() if isinstance(dat, bytes) else dat.copy()
+    self._daemon.outputs.append(msg)
+
+  def wait_for_readers_to_update(self, s: str, timeout: int, dt: float = 0.05) -> bool:
+    return True
+
+  def all_readers_updated(self, s: str) -> bool:
+    return True
+
+
+class InProcessSubSocket:
+  def __init__(self, endpoint: str):
+    self.endpoint = endpoint
+    self.queue: list[capnp._DynamicStructReader] = []
+
+  def drain(self) -> list[capnp._DynamicStructReader]:
+    msgs, self.queue = self.queue, []
+    return msgs
+
+
+class InProcessMessaging:
+  def __init__(self, daemon: 'InProcessDaemon'):
+    """Stands in for cereal.messaging in a daemon's module, everything not overridden is the real thing"""
+    self._daemon = daemon
+
+  def __getattr__(self, name: str) -> Any:
+    return getattr(messaging, name)
+
+  def SubMaster(self, *args, **kwargs) -> InProcessSubMaster:
+    return InProcessSubMaster(self._daemon, *args, **kwargs)
+
+  def PubMaster(self, services: list[str]) -> InProcessPubMaster:
+    return InProcessPubMaster(self._daemon, services)
+
+  def sub_sock(self, endpoint: str, *args, **kwargs) -> InProcessSubSocket:
+    sock = InProcessSubSocket(endpoint)
+    self._daemon.sub_sockets.append(sock)
+    return sock
+
+  def drain_sock(self, sock: InProcessSubSocket, wait_for_one: bool = False) -> list[capnp._DynamicStructReader]:
+    return sock.drain()
+
+
+class InProcessDaemon:
+  def __init__(self, name: str, timeout: float):
+    """
+      Runs a python daemon's main() on a thread of this process. Its SubMaster.update() hands control
+      back to the replay between steps, so the daemon and replay never run at the same time.
+    """
+    self.name = name
+    self.timeout = timeout
+    self.outputs: list[capnp._DynamicStructBuilder] = []
+    self.sub_sockets: list[InProcessSubSocket] = []
+    self.thread: threading.Thread | None = None
+
+    self._batch: list[capnp._DynamicStructReader] = []
+    self._idle = threading.Event()
+    self._ready = threading.Event()
+    self._stopping = False
+    self._exited = False
+    self._error: BaseException | None = None
+
+  def start(self) -> None:
+    # a fresh copy of the module, so module level state and what's patched here don't leak between replays
+    spec = importlib.util.find_spec(IN_PROCESS_DAEMONS[self.name])
+    assert spec is not None and spec.loader is not None
+    module: Any = importlib.util.module_from_spec(spec)
+    spec.loader.exec_module(module)
+    module.messaging = InProcessMessaging(self)
+    if hasattr(module, "config_realtime_process"):
+      # sets the core affinity and disables gc, which would be for the whole replay
+      module.config_realtime_process = lambda *args, **kwargs: None
+
+    self.thread = threading.Thread(target=self._run, args=(module.main,), name=self.name, daemon=True)
+    self.thread.start()
+    self._wait_for_idle()
+
+  def _run(self, main) -> None:
+    try:
+      main()
+    except _StopDaemon:
+      pass
+    except BaseException as e:
+      self._error = e
+    finally:
+      self._exited = True
+      self._idle.set()
+
+  def _wait_for_idle(self) -> None:
+    if not self._idle.wait(self.timeout):
+      raise TimeoutError(f"timed out testing process {repr(self.name)}")
+    if self._error is not None:
+      raise RuntimeError(f"{self.name} crashed") from self._error
+    if self._exited:
+      raise RuntimeError(f"{self.name} exited")
+
+  def wait_for_step(self) -> list[capnp._DynamicStructReader]:
+    """Called from the daemon's thread, blocks until the replay has the next messages for it"""
+    self._idle.set()
+    self._ready.wait()
+    self._ready.clear()
+    if self._stopping:
+      raise _StopDaemon
+    return self._batch
+
+  def step(self, msgs: list[capnp._DynamicStructReader]) -> None:
+    """Gives msgs to the daemon and returns once it's done with them"""
+    self._batch = msgs
+    for sock in self.sub_sockets:
+      sock.queue.extend(m for m in msgs if m.which() == sock.endpoint)
+
+    self._idle.clear()
+    self._ready.set()
+    self._wait_for_idle()
+
+  def stop(self) -> None:
+    if self.thread is not None and not self._exited:
+      self._stopping = True
+      self._ready.set()
+      self.thread.join(self.timeout)
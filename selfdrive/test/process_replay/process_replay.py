@@ -8,7 +8,7 @@ from collections import Counter
 from dataclasses import dataclass, field
 from itertools import islice
 from typing import Any
-from collections.abc import Callable, Iterable
+from collections.abc import Callable, Iterable, Iterator
 from tqdm import tqdm
 import capnp
 from openpilot.system.hardware.hw import Paths
@@ -27,6 +27,7 @@ from openpilot.system.manager.process_config import managed_processes
 from openpilot.selfdrive.test.process_replay.vision_meta import meta_from_camera_state, available_streams
 from openpilot.selfdrive.test.process_replay.migration import migrate_all
 from openpilot.selfdrive.test.process_replay.capture import ProcessOutputCapture
+from openpilot.selfdrive.test.process_replay.in_process import IN_PROCESS_DAEMONS, InProcessDaemon
 from openpilot.tools.lib.logreader import LogIterable
 from openpilot.tools.lib.framereader import FrameReader
 
@@ -313,6 +314,74 @@ class ProcessContainer:
     return output_msgs
 
 
+class InProcessContainer(ProcessContainer):
+  def __init__(self, cfg: ProcessConfig):
+    """Same as ProcessContainer, but for python daemons that are run in this process and given messages directly, without msgq"""
+    assert cfg.proc_name in IN_PROCESS_DAEMONS, f"{cfg.proc_name} can't be replayed in process"
+    assert len(cfg.vision_pubs) == 0 and not cfg.main_pub_drained
+    self.prefix = OpenpilotPrefix(create_dirs_on_enter=False, clean_dirs_on_exit=False)
+    self.cfg = copy.deepcopy(cfg)
+    self.msg_queue: list[capnp._DynamicStructReader] = []
+    self.cnt = 0
+    self.daemon = InProcessDaemon(cfg.proc_name, cfg.timeout)
+    self.environ_config: dict[str, Any] | None = None
+    self.capture: ProcessOutputCapture | None = None
+
+  def start(
+    self, params_config: dict[str, Any], environ_config: dict[str, Any],
+    all_msgs: LogIterable, frs: dict[str, FrameReader] | None,
+    fingerprint: str | None, capture_output: bool
+  ):
+    with self.prefix:
+      self.prefix.create_dirs()
+      self._setup_env(params_config, environ_config)
+
+      if self.cfg.config_callback is not None:
+        params = Params()
+        self.cfg.config_callback(params, self.cfg, all_msgs)
+
+      # the daemon waits for what the init callback puts in params, there are no sockets to pass it
+      if self.cfg.init_callback is not None:
+        self.cfg.init_callback(None, None, all_msgs, fingerprint)
+
+      self.daemon.start()
+
+  def stop(self):
+    with self.prefix:
+      self.daemon.stop()
+      self.prefix.clean_dirs()
+      self._clean_env()
+
+  def get_output_msgs(self, start_time: int):
+    # in the order they'd be drained from each socket
+    outputs = [m for m in self.daemon.outputs if m.which() in self.cfg.subs]
+    outputs.sort(key=lambda m: self.cfg.subs.index(m.which()))
+    self.daemon.outputs = []
+
+    output_msgs = []
+    for m in outputs:
+      m.logMonoTime = start_time + int(self.cfg.processing_time * 1e9)
+      output_msgs.append(m.as_reader())
+    return output_msgs
+
+  def run_step(self, msg: capnp._DynamicStructReader, frs: dict[str, FrameReader] | None) -> list[capnp._DynamicStructReader]:
+    output_msgs = []
+    end_of_cycle = True
+    if self.cfg.should_recv_callback is not None:
+      end_of_cycle = self.cfg.should_recv_callback(msg, self.cfg, self.cnt)
+
+    self.msg_queue.append(msg)
+    if end_of_cycle:
+      with self.prefix:
+        # get output msgs from previous inputs
+        output_msgs = self.get_output_msgs(msg.logMonoTime)
+        self.daemon.step(self.msg_queue)
+      self.msg_queue = []
+      self.cnt += 1
+
+    return output_msgs
+
+
 def card_fingerprint_callback(rc, pm, msgs, fingerprint):
   print("start fingerprinting")
   params = Params()
@@ -609,21 +678,30 @@ def replay_process_with_name(name: str | Iterable[str], lr: LogIterable, *args,
   return replay_process(cfgs, lr, *args, **kwargs)
 
 
+def _get_cfgs(cfg: ProcessConfig | Iterable[ProcessConfig]) -> list[ProcessConfig]:
+  if isinstance(cfg, Iterable):
+    return list(cfg)
+  return [cfg]
+
+
+def _migrate_for_replay(cfgs: list[ProcessConfig], lr: LogIterable) -> list[capnp._DynamicStructReader]:
+  msgs: list[capnp._DynamicStructReader] = migrate_all(lr,
+                                                       manager_states=True,
+                                                       panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
+                                                       camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
+  return msgs
+
+
 def replay_process(
   cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] = None,
   fingerprint: str = None, return_all_logs: bool = False, custom_params: dict[str, Any] = None,
-  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False
+  captured_output_store: dict[str, dict[str, str]] = None, disable_progress: bool = False, in_process: bool = False,
+  replay_stats: dict[str, dict[str, float]] = None
 ) -> list[capnp._DynamicStructReader]:
-  if isinstance(cfg, Iterable):
-    cfgs = list(cfg)
-  else:
-    cfgs = [cfg]
-
-  all_msgs = migrate_all(lr,
-                         manager_states=True,
-                         panda_states=any("pandaStates" in cfg.pubs for cfg in cfgs),
-                         camera_states=any(len(cfg.vision_pubs) != 0 for cfg in cfgs))
-  process_logs = _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress)
+  cfgs = _get_cfgs(cfg)
+  all_msgs = _migrate_for_replay(cfgs, lr)
+  process_logs = list(_replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, captured_output_store, disable_progress,
+                                            in_process, replay_stats))
 
   if return_all_logs:
     keys = {m.which() for m in process_logs}
@@ -637,10 +715,24 @@ def replay_process(
   return log_msgs
 
 
+def replay_process_iter(
+  cfg: ProcessConfig | Iterable[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] = None,
+  fingerprint: str = None, custom_params: dict[str, Any] = None, disable_progress: bool = False, in_process: bool = False
+) -> Iterator[capnp._DynamicStructReader]:
+  """Same as replay_process, but yields the process output as it's produced instead of collecting it"""
+  cfgs = _get_cfgs(cfg)
+  all_msgs = _migrate_for_replay(cfgs, lr)
+  yield from _replay_multi_process(cfgs, all_msgs, frs, fingerprint, custom_params, None, disable_progress, in_process)
+
+
 def _replay_multi_process(
   cfgs: list[ProcessConfig], lr: LogIterable, frs: dict[str, FrameReader] | None, fingerprint: str | None,
-  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool
-) -> list[capnp._DynamicStructReader]:
+  custom_params: dict[str, Any] | None, captured_output_store: dict[str, dict[str, str]] | None, disable_progress: bool,
+  in_process: bool = False, replay_stats: dict[str, dict[str, float]] | None = None
+) -> Iterator[capnp._DynamicStructReader]:
+  if in_process and captured_output_store is not None:
+    raise ValueError("output can only be captured from processes that aren't replayed in process")
+
   if fingerprint is not None:
     params_config = generate_params_config(lr=lr, fingerprint=fingerprint, custom_params=custom_params)
     env_config = generate_environ_config(fingerprint=fingerprint)
@@ -659,11 +751,11 @@ def _replay_multi_process(
     assert all(st in frs for st in required_vision_pubs), f"frs for this process must contain following vision streams: {required_vision_pubs}"
 
   all_msgs = sorted(lr, key=lambda msg: msg.logMonoTime)
-  log_msgs = []
-  containers = []
+  containers: list[ProcessContainer] = []
   try:
     for cfg in cfgs:
-      container = ProcessContainer(cfg)
+      # python daemons run in this process when asked to, everything else still gets its own process
+      container = InProcessContainer(cfg) if in_process and cfg.proc_name in IN_PROCESS_DAEMONS else ProcessContainer(cfg)
       containers.append(container)
       container.start(params_config, env_config, all_msgs, frs, fingerprint, captured_output_store is not None)
 
@@ -672,35 +764,58 @@ def _replay_multi_process(
     lr_pubs = all_pubs - all_subs
     pubs_to_containers = {pub: [container for container in containers if pub in container.pubs] for pub in all_pubs}
 
-    pub_msgs = [msg for msg in all_msgs if msg.which() in lr_pubs]
-    # external queue for messages taken from logs; internal queue for messages generated by processes, which will be republished
-    external_pub_queue: list[capnp._DynamicStructReader] = pub_msgs.copy()
-    internal_pub_queue: list[capnp._DynamicStructReader] = []
-    # heap for maintaining the order of messages generated by processes, where each element: (logMonoTime, index in internal_pub_queue)
-    internal_pub_index_heap: list[tuple[int, int]] = []
-
-    pbar = tqdm(total=len(external_pub_queue), disable=disable_progress)
-    while len(external_pub_queue) != 0 or (len(internal_pub_index_heap) != 0 and not all(c.has_empty_queue for c in containers)):
-      if len(internal_pub_index_heap) == 0 or (len(external_pub_queue) != 0 and external_pub_queue[0].logMonoTime < internal_pub_index_heap[0][0]):
-        msg = external_pub_queue.pop(0)
+    # external messages are taken from the sorted logs in order; messages generated by processes, which will be republished,
+    # are kept in a heap of (logMonoTime, sequence number, msg) until they're sent, the sequence number keeps ties in generation order
+    external_pubs = (msg for msg in all_msgs if msg.which() in lr_pubs)
+    next_external = next(external_pubs, None)
+    internal_pub_heap: list[tuple[int, int, capnp._DynamicStructReader]] = []
+    internal_pub_count = 0
+    last_time = None
+    # per process: messages and frames it was given, and the time spent stepping it
+    step_stats = {container.cfg.proc_name: [0, 0, 0.] for container in containers}
+
+    pbar = tqdm(total=sum(1 for msg in all_msgs if msg.which() in lr_pubs), disable=disable_progress)
+    while next_external is not None or (len(internal_pub_heap) != 0 and not all(c.has_empty_queue for c in containers)):
+      if len(internal_pub_heap) == 0 or (next_external is not None and next_external.logMonoTime < internal_pub_heap[0][0]):
+        assert next_external is not None
+        msg = next_external
+        next_external = next(external_pubs, None)
         pbar.update(1)
       else:
-        _, index = heapq.heappop(internal_pub_index_heap)
-        msg = internal_pub_queue[index]
+        _, _, msg = heapq.heappop(internal_pub_heap)
 
       target_containers = pubs_to_containers[msg.which()]
       for container in target_containers:
+        step_start = time.monotonic()
         output_msgs = container.run_step(msg, frs)
+        stats = step_stats[container.cfg.proc_name]
+        stats[0] += 1
+        stats[1] += msg.which() in container.cfg.vision_pubs
+        stats[2] += time.monotonic() - step_start
         for m in output_msgs:
           if m.which() in all_pubs:
-            internal_pub_queue.append(m)
-            heapq.heappush(internal_pub_index_heap, (m.logMonoTime, len(internal_pub_queue) - 1))
-        log_msgs.extend(output_msgs)
+            heapq.heappush(internal_pub_heap, (m.logMonoTime, internal_pub_count, m))
+            internal_pub_count += 1
+        if len(output_msgs) > 0:
+          last_time = output_msgs[-1].logMonoTime
+        yield from output_msgs
 
     # flush last set of messages from each process
     for container in containers:
-      last_time = log_msgs[-1].logMonoTime if len(log_msgs) > 0 else int(time.monotonic() * 1e9)
-      log_msgs.extend(container.get_output_msgs(last_time))
+      output_msgs = container.get_output_msgs(last_time if last_time is not None else int(time.monotonic() * 1e9))
+      if len(output_msgs) > 0:
+        last_time = output_msgs[-1].logMonoTime
+      yield from output_msgs
+
+    if replay_stats is not None:
+      for proc_name, (msg_count, frame_count, seconds) in step_stats.items():
+        replay_stats[proc_name] = {
+          "msgs": msg_count,
+          "frames": frame_count,
+          "seconds": seconds,
+          "msgs_per_s": msg_count / seconds if seconds > 0 else 0.,
+          "frames_per_s": frame_count / seconds if seconds > 0 else 0.,
+        }
   finally:
     for container in containers:
       container.stop()
@@ -709,8 +824,6 @@ def _replay_multi_process(
         out, err = container.capture.read_outerr()
         captured_output_store[container.cfg.proc_name] = {"out": out, "err": err}
 
-  return log_msgs
-
 
 def generate_params_config(lr=None, CP=None, fingerprint=None, custom_params=None) -> dict[str, Any]:
   params_dict = {
@@ -10,14 +10,14 @@ from collections.abc import Iterable
 from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, FAKEDATA, ProcessConfig, replay_process, get_process_config, \
                                                                    check_openpilot_enabled, check_most_messages_valid, get_custom_params_from_lr
 from openpilot.selfdrive.test.update_ci_routes import upload_route
-from openpilot.tools.lib.framereader import FrameReader
+from openpilot.tools.lib.framereader import DiskCachedFrameReader, FrameReader
 from openpilot.tools.lib.logreader import LogReader, LogIterable, save_log
 from openpilot.tools.lib.openpilotci import get_url
 
 
 def regen_segment(
   lr: LogIterable, frs: dict[str, Any] = None,
-  processes: Iterable[ProcessConfig] = CONFIGS, disable_tqdm: bool = False
+  processes: Iterable[ProcessConfig] = CONFIGS, disable_tqdm: bool = False, replay_stats: dict[str, dict[str, float]] = None
 ) -> list[capnp._DynamicStructReader]:
   all_msgs = sorted(lr, key=lambda m: m.logMonoTime)
   custom_params = get_custom_params_from_lr(all_msgs)
@@ -25,34 +25,49 @@ def regen_segment(
   print("Replayed processes:", [p.proc_name for p in processes])
   print("\n\n", "*"*30, "\n\n", sep="")
 
-  output_logs = replay_process(processes, all_msgs, frs, return_all_logs=True, custom_params=custom_params, disable_progress=disable_tqdm)
+  output_logs = replay_process(processes, all_msgs, frs, return_all_logs=True, custom_params=custom_params, disable_progress=disable_tqdm,
+                               replay_stats=replay_stats)
 
   return output_logs
 
 
+def format_replay_stats(replay_stats: dict[str, dict[str, float]]) -> str:
+  lines = [f"{'process':<20} {'msgs':>8} {'msgs/s':>10} {'frames':>8} {'frames/s':>10}"]
+  for proc_name, stats in sorted(replay_stats.items(), key=lambda x: -x[1]["seconds"]):
+    lines.append(f"{proc_name:<20} {stats['msgs']:>8} {stats['msgs_per_s']:>10.1f} {stats['frames']:>8} {stats['frames_per_s']:>10.1f}")
+  return "\n".join(lines)
+
+
 def setup_data_readers(
-    route: str, sidx: int, needs_driver_cam: bool = True, needs_road_cam: bool = True, dummy_driver_cam: bool = False
+    route: str, sidx: int, needs_driver_cam: bool = True, needs_road_cam: bool = True, dummy_driver_cam: bool = False,
+    frame_cache: str | None = None
 ) -> tuple[LogReader, dict[str, Any]]:
+  def frame_reader(fn: str) -> FrameReader:
+    # with a cache dir, frames decoded by any regen are reused, e.g. the dummy driver camera or other workers
+    url = get_url(route, str(sidx), fn)
+    return DiskCachedFrameReader(url, frame_cache) if frame_cache is not None else FrameReader(url, pix_fmt='nv12')
+
   lr = LogReader(f"{route}/{sidx}/r")
   frs = {}
   if needs_road_cam:
-    frs['roadCameraState'] = FrameReader(get_url(route, str(sidx), "fcamera.hevc"))
+    frs['roadCameraState'] = frame_reader("fcamera.hevc")
     if next((True for m in lr if m.which() == "wideRoadCameraState"), False):
-      frs['wideRoadCameraState'] = FrameReader(get_url(route, str(sidx), "ecamera.hevc"))
+      frs['wideRoadCameraState'] = frame_reader("ecamera.hevc")
   if needs_driver_cam:
     if dummy_driver_cam:
-      frs['driverCameraState'] = FrameReader(get_url(route, str(sidx), "fcamera.hevc")) # Use fcam as dummy
+      frs['driverCameraState'] = frame_reader("fcamera.hevc") # Use fcam as dummy
     else:
       device_type = next(str(msg.initData.deviceType) for msg in lr if msg.which() == "initData")
       assert device_type != "neo", "Driver camera not supported on neo segments. Use dummy dcamera."
-      frs['driverCameraState'] = FrameReader(get_url(route, str(sidx), "dcamera.hevc"))
+      frs['driverCameraState'] = frame_reader("dcamera.hevc")
 
   return lr, frs
 
 
 def regen_and_save(
   route: str, sidx: int, processes: str | Iterable[str] = "all", outdir: str = FAKEDATA,
-  upload: bool = False, disable_tqdm: bool = False, dummy_driver_cam: bool = False
+  upload: bool = False, disable_tqdm: bool = False, dummy_driver_cam: bool = False, frame_cache: str | None = None,
+  replay_stats: dict[str, dict[str, float]] = None
 ) -> str:
   if not isinstance(processes, str) and not hasattr(processes, "__iter__"):
     raise ValueError("whitelist_proc must be a string or iterable")
@@ -72,8 +87,10 @@ def regen_and_save(
   lr, frs = setup_data_readers(route, sidx,
                                needs_driver_cam="driverCameraState" in all_vision_pubs,
                                needs_road_cam="roadCameraState" in all_vision_pubs or "wideRoadCameraState" in all_vision_pubs,
-                               dummy_driver_cam=dummy_driver_cam)
-  output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm)
+                               dummy_driver_cam=dummy_driver_cam, frame_cache=frame_cache)
+  if replay_stats is None:
+    replay_stats = {}
+  output_logs = regen_segment(lr, frs, replayed_processes, disable_tqdm=disable_tqdm, replay_stats=replay_stats)
 
   log_dir = os.path.join(outdir, time.strftime("%Y-%m-%d--%H-%M-%S--0", time.gmtime()))
   rel_log_dir = os.path.relpath(log_dir)
@@ -84,6 +101,7 @@ def regen_and_save(
 
   print("\n\n", "*"*30, "\n\n", sep="")
   print("New route:", rel_log_dir, "\n")
+  print(format_replay_stats(replay_stats), "\n")
 
   if not check_openpilot_enabled(output_logs):
     raise Exception("Route did not engage for long enough")
@@ -105,6 +123,7 @@ if __name__ == "__main__":
   parser.add_argument("--upload", action="store_true", help="Upload the new segment to the CI bucket")
   parser.add_argument("--outdir", help="log output dir", default=FAKEDATA)
   parser.add_argument("--dummy-dcamera", action='store_true', help="Use dummy blank driver camera")
+  parser.add_argument("--frame-cache", help="Keep decoded frames in this dir, so later regens of the segment don't decode them again")
   parser.add_argument("--whitelist-procs", type=comma_separated_list, default=all_procs,
                       help="Comma-separated whitelist of processes to regen (e.g. controlsd,radard)")
   parser.add_argument("--blacklist-procs", type=comma_separated_list, default=[],
@@ -115,4 +134,5 @@ if __name__ == "__main__":
 
   blacklist_set = set(args.blacklist_procs)
   processes = [p for p in args.whitelist_procs if p not in blacklist_set]
-  regen_and_save(args.route, args.seg, processes=processes, upload=args.upload, outdir=args.outdir, dummy_driver_cam=args.dummy_dcamera)
+  regen_and_save(args.route, args.seg, processes=processes, upload=args.upload, outdir=args.outdir, dummy_driver_cam=args.dummy_dcamera,
+                 frame_cache=args.frame_cache)
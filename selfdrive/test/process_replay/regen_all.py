@@ -4,36 +4,53 @@ import concurrent.futures
 import os
 import random
 import traceback
+from collections import defaultdict
 from tqdm import tqdm
 
 from openpilot.common.prefix import OpenpilotPrefix
-from openpilot.selfdrive.test.process_replay.regen import regen_and_save
+from openpilot.selfdrive.test.process_replay.regen import format_replay_stats, regen_and_save
 from openpilot.selfdrive.test.process_replay.test_processes import FAKEDATA, source_segments as segments
 from openpilot.tools.lib.route import SegmentName
 
 
-def regen_job(segment, upload, disable_tqdm):
+def regen_job(segment, upload, disable_tqdm, frame_cache):
+  replay_stats: dict[str, dict[str, float]] = {}
   with OpenpilotPrefix():
     sn = SegmentName(segment[1])
     fake_dongle_id = 'regen' + ''.join(random.choice('0123456789ABCDEF') for _ in range(11))
     try:
       relr = regen_and_save(sn.route_name.canonical_name, sn.segment_num, upload=upload,
-                            outdir=os.path.join(FAKEDATA, fake_dongle_id), disable_tqdm=disable_tqdm, dummy_driver_cam=True)
+                            outdir=os.path.join(FAKEDATA, fake_dongle_id), disable_tqdm=disable_tqdm, dummy_driver_cam=True,
+                            frame_cache=frame_cache, replay_stats=replay_stats)
       relr = '|'.join(relr.split('/')[-2:])
-      return f'  ("{segment[0]}", "{relr}"), '
+      return f'  ("{segment[0]}", "{relr}"), ', replay_stats
     except Exception as e:
       err = f"  {segment} failed: {str(e)}"
       err += traceback.format_exc()
       err += "\n\n"
-      return err
+      return err, replay_stats
+
+
+def merge_replay_stats(all_stats: list[dict[str, dict[str, float]]]) -> dict[str, dict[str, float]]:
+  totals: dict[str, dict[str, float]] = defaultdict(lambda: {"msgs": 0, "frames": 0, "seconds": 0.})
+  for replay_stats in all_stats:
+    for proc_name, stats in replay_stats.items():
+      for k in ("msgs", "frames", "seconds"):
+        totals[proc_name][k] += stats[k]
+
+  for stats in totals.values():
+    stats["msgs_per_s"] = stats["msgs"] / stats["seconds"] if stats["seconds"] > 0 else 0.
+    stats["frames_per_s"] = stats["frames"] / stats["seconds"] if stats["seconds"] > 0 else 0.
+  return dict(totals)
 
 
 if __name__ == "__main__":
   all_cars = {car for car, _ in segments}
 
   parser = argparse.ArgumentParser(description="Generate new segments from old ones")
-  parser.add_argument("-j", "--jobs", type=int, default=1)
+  parser.add_argument("-j", "--jobs", type=int, default=max((os.cpu_count() or 1) - 2, 1))
   parser.add_argument("--no-upload", action="store_true")
+  parser.add_argument("--frame-cache", help="Keep decoded frames in this dir, shared between jobs and later runs")
   parser.add_argument("--whitelist-cars", type=str, nargs="*", default=all_cars,
                       help="Whitelist given cars from the test (e.g. HONDA)")
   parser.add_argument("--blacklist-cars", type=str, nargs="*", default=[],
@@ -45,10 +62,15 @@ if __name__ == "__main__":
   tested_segments = [(car, segment) for car, segment in segments if car in tested_cars]
 
   with concurrent.futures.ProcessPoolExecutor(max_workers=args.jobs) as pool:
-    p = pool.map(regen_job, tested_segments, [not args.no_upload] * len(tested_segments), [args.jobs > 1] * len(tested_segments))
+    p = pool.map(regen_job, tested_segments, [not args.no_upload] * len(tested_segments), [args.jobs > 1] * len(tested_segments),
+                 [args.frame_cache] * len(tested_segments))
     msg = "Copy these new segments into test_processes.py:"
-    for seg in tqdm(p, desc="Generating segments", total=len(tested_segments)):
+    all_stats = []
+    for seg, replay_stats in tqdm(p, desc="Generating segments", total=len(tested_segments)):
       msg += "\n" + str(seg)
+      all_stats.append(replay_stats)
+    print()
     print()
+    print(format_replay_stats(merge_replay_stats(all_stats)))
     print()
     print(msg)
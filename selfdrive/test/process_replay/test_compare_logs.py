@@ -0,0 +1,71 @@
+import math
+
+from cereal import log
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs
+
+TOLERANCE = 1e-6
+
+
+def car_state(v_ego=1.0, gear='drive'):
+  msg = log.Event.new_message(logMonoTime=1)
+  msg.init('carState')
+  msg.carState.vEgo = v_ego
+  msg.carState.gearShifter = gear
+  return msg
+
+
+def accelerometer(sensor, v):
+  msg = log.Event.new_message(logMonoTime=2)
+  msg.init('accelerometer').init(sensor).v = v
+  return msg
+
+
+def live_calibration(rpy):
+  msg = log.Event.new_message(logMonoTime=3)
+  msg.init('liveCalibration').rpyCalib = rpy
+  return msg
+
+
+# pairs of events that are the same within TOLERANCE
+SAME = [
+  (car_state(1.0), car_state(1.0 + 1e-9)),
+  (car_state(math.nan), car_state(math.nan)),
+  (accelerometer('acceleration', [1., 2., 3.]), accelerometer('acceleration', [1., 2., 3.])),
+  (live_calibration([1., 2., 3.]), live_calibration([1., 2., 3. + 1e-9])),
+]
+
+# and ones that aren't
+DIFFERENT = [
+  (car_state(1.0), car_state(2.0)),
+  (car_state(math.nan), car_state(1.0)),
+  (car_state(gear='drive'), car_state(gear='park')),
+  (accelerometer('acceleration', [1., 2., 3.]), accelerometer('gyro', [1., 2., 3.])),
+  (accelerometer('acceleration', [1., 2., 3.]), accelerometer('acceleration', [1., 2., 4.])),
+  (live_calibration([1., 2., 3.]), live_calibration([1., 2.])),
+  (live_calibration([1., 2., 3.]), live_calibration([1., 2., 3.1])),
+]
+
+
+def compare(pairs, **kwargs):
+  log1 = [m1.as_reader() for m1, _ in pairs]
+  log2 = [m2.as_reader() for _, m2 in pairs]
+  # as text, since diffs with a NaN aren't equal to themselves
+  return [repr(d) for d in compare_logs(log1, log2, tolerance=TOLERANCE, **kwargs)]
+
+
+class TestCompareLogs:
+  def test_same(self):
+    for vectorized in (False, True):
+      assert compare(SAME, vectorized=vectorized) == []
+
+  def test_vectorized_matches_structural(self):
+    pairs = SAME + DIFFERENT + SAME
+    diff = compare(pairs, vectorized=False)
+    assert len(diff) >= len(DIFFERENT)
+    assert compare(pairs, vectorized=True) == diff
+
+  def test_each_difference_found(self):
+    for pair in DIFFERENT:
+      diff = compare([pair], vectorized=False)
+      assert len(diff) > 0, pair
+      assert compare([pair], vectorized=True) == diff
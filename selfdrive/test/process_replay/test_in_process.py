@@ -0,0 +1,42 @@
+import copy
+import time
+from parameterized import parameterized
+
+from openpilot.selfdrive.test.process_replay.compare_logs import compare_logs
+from openpilot.selfdrive.test.process_replay.in_process import IN_PROCESS_DAEMONS, InProcessMessaging
+from openpilot.selfdrive.test.process_replay.process_replay import CONFIGS, replay_process
+from openpilot.system.manager.process_config import managed_processes
+from openpilot.tools.lib.logreader import LogReader
+from openpilot.tools.lib.openpilotci import get_url
+
+TEST_SEGMENT = "regen218A4DCFAA1|2025-04-08--22-57-51--0"  # TOYOTA.TOYOTA_PRIUS
+# compared against the daemon running as its own process, so it has to be one
+TEST_CASES = [(cfg.proc_name, copy.deepcopy(cfg)) for cfg in CONFIGS if cfg.proc_name in IN_PROCESS_DAEMONS and cfg.proc_name in managed_processes]
+
+
+def test_submaster_no_sockets(mocker):
+  sub_sock = mocker.patch('cereal.messaging.sub_sock')
+  sm = InProcessMessaging(None).SubMaster(['carState', 'liveParameters'], poll='carState')
+  assert sm.services == ['carState', 'liveParameters']
+  assert not sm.updated['carState']
+  sub_sock.assert_not_called()
+
+
+class TestInProcessReplay:
+  @classmethod
+  def setup_class(cls):
+    cls.lr = list(LogReader(get_url(*TEST_SEGMENT.rsplit("--", 1), "rlog.zst")))
+
+  @parameterized.expand(TEST_CASES)
+  def test_matches_process(self, proc_name, cfg):
+    t = time.monotonic()
+    expected = replay_process(cfg, self.lr, disable_progress=True)
+    t_process = time.monotonic() - t
+    t = time.monotonic()
+    output = replay_process(cfg, self.lr, disable_progress=True, in_process=True)
+    t_in_process = time.monotonic() - t
+    print(f"{proc_name}: {t_process:.2f}s as a process, {t_in_process:.2f}s in process ({t_process / t_in_process:.1f}x)")
+
+    assert len(output) == len(expected)
+    diff = compare_logs(expected, output, cfg.ignore, tolerance=cfg.tolerance)
+    assert len(diff) == 0, f"{proc_name} differs when replayed in process: {diff[:10]}"
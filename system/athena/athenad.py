@@ -2,6 +2,7 @@
 from __future__ import annotations
 
 import base64
+import bisect
 import hashlib
 import io
 import json
@@ -19,9 +20,11 @@ from datetime import datetime
 from functools import partial, total_ordering
 from queue import Queue
 from typing import cast
+from urllib.parse import urlencode
 from collections.abc import Callable
 
 import requests
+import zstandard as zstd
 from requests.adapters import HTTPAdapter, DEFAULT_POOLBLOCK
 from jsonrpc import JSONRPCResponseManager, dispatcher
 from websocket import (ABNF, WebSocket, WebSocketException, WebSocketTimeoutException,
@@ -31,7 +34,8 @@ import cereal.messaging as messaging
 from cereal import log
 from cereal.services import SERVICE_LIST
 from openpilot.common.api import Api
-from openpilot.common.file_helpers import CallbackReader, get_upload_stream
+from openpilot.common.file_helpers import CallbackReader, LOG_COMPRESSION_LEVEL, get_upload_stream
+from openpilot.common.inotify import Inotify, IN_CLOSE_WRITE, IN_DELETE, IN_IGNORED, IN_MOVED_FROM, IN_MOVED_TO, IN_Q_OVERFLOW
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware import HARDWARE, PC
@@ -47,12 +51,27 @@ LOCAL_PORT_WHITELIST = {22, }  # SSH
 
 LOG_ATTR_NAME = 'user.upload'
 LOG_ATTR_VALUE_MAX_UNIX_TIME = int.to_bytes(2147483647, 4, sys.byteorder)
+LOG_RESEND_AGE = 3600  # seconds, logs sent without a response are sent again after this
+LOG_SCAN_INTERVAL = 10  # seconds, how often the swaglog directory is listed without inotify
+LOG_RESPONSE_TIMEOUT = 100  # seconds
+LOG_BATCH_MAX_BYTES = 1024 * 1024  # uncompressed
+LOG_BATCH_MAX_FILES = 100
+LOG_BATCHES_IN_FLIGHT = 4
+LOG_COMPRESSION = os.getenv('ATHENA_LOG_COMPRESSION', '1') == '1'
+LOG_COMPRESSION_UNSUPPORTED = (-32601, -32602)  # JSON-RPC method not found and invalid params, from servers without logs_zst
+SWAGLOG_EVENTS = IN_CLOSE_WRITE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM
 RECONNECT_TIMEOUT_S = 70
 
 RETRY_DELAY = 10  # seconds
 MAX_RETRY_COUNT = 30  # Try for at most 5 minutes if upload fails immediately
 MAX_AGE = 31 * 24 * 3600  # seconds
 WS_FRAME_SIZE = 4096
+WS_COMPRESSION_HEADER = 'X-Athena-Compression'
+WS_COMPRESSION_MIN_SIZE = 1024  # bytes, smaller messages aren't worth compressing
+WS_COMPRESSION_LEVEL = 3
+WS_HIGH_PRIORITY_BURST = 4  # high priority messages sent in a row before a waiting low priority one gets a turn
+ZSTD_MAGIC = b'\x28\xb5\x2f\xfd'
+UPLOAD_BLOCK_SIZE = 4 * 1024 * 1024
 DEVICE_STATE_UPDATE_INTERVAL = 1.0  # in seconds
 DEFAULT_UPLOAD_PRIORITY = 99  # higher number = lower priority
 
@@ -106,11 +125,16 @@ class UploadItem:
   progress: float = 0
   allow_cellular: bool = False
   priority: int = DEFAULT_UPLOAD_PRIORITY
+  speed: float = 0  # bytes per second sent by the current attempt
+  # resume point of a block upload, the blocks stored so far and the bytes of the upload stream they hold
+  upload_blocks: int = 0
+  upload_offset: int = 0
 
   @classmethod
   def from_dict(cls, d: dict) -> UploadItem:
     return cls(d["path"], d["url"], d["headers"], d["created_at"], d["id"], d["retry_count"], d["current"],
-               d["progress"], d["allow_cellular"], d["priority"])
+               d["progress"], d["allow_cellular"], d["priority"], d.get("speed", 0), d.get("upload_blocks", 0),
+               d.get("upload_offset", 0))
 
   def __lt__(self, other):
     if not isinstance(other, UploadItem):
@@ -123,11 +147,62 @@ class UploadItem:
     return self.priority == other.priority
 
 
+class SendQueue(Queue):
+  """A queue of messages for ws_send, which is woken up when any of them gets one"""
+  def __init__(self, ready: threading.Event):
+    super().__init__()
+    self.ready = ready
+
+  def _put(self, item):
+    super()._put(item)
+    self.ready.set()
+
+
+class SendScheduler:
+  """
+    Picks the next message for ws_send. High priority messages go first, but after WS_HIGH_PRIORITY_BURST of them in
+    a row a waiting low priority message is sent, so a busy high priority queue doesn't starve the other one.
+  """
+  def __init__(self, high: Queue[str], low: Queue[str], ready: threading.Event):
+    self.high = high
+    self.low = low
+    self.ready = ready
+    self.burst = 0
+
+  def _get(self, q: Queue[str]) -> str | None:
+    try:
+      return q.get_nowait()
+    except queue.Empty:
+      return None
+
+  def get(self, timeout: float) -> str | None:
+    deadline = time.monotonic() + timeout
+    while True:
+      # cleared before looking, so a message put after this wakes up the wait below
+      self.ready.clear()
+
+      data = None
+      if self.burst < WS_HIGH_PRIORITY_BURST or self.low.empty():
+        data = self._get(self.high)
+      if data is not None:
+        self.burst += 1
+        return data
+      self.burst = 0
+      data = self._get(self.low)
+      if data is not None:
+        return data
+
+      remaining = deadline - time.monotonic()
+      if remaining <= 0 or not self.ready.wait(remaining):
+        return None
+
+
 dispatcher["echo"] = lambda s: s
+send_ready = threading.Event()
 recv_queue: Queue[str] = queue.Queue()
-send_queue: Queue[str] = queue.Queue()
+send_queue: Queue[str] = SendQueue(send_ready)
 upload_queue: Queue[UploadItem] = queue.PriorityQueue()
-low_priority_send_queue: Queue[str] = queue.Queue()
+low_priority_send_queue: Queue[str] = SendQueue(send_ready)
 log_recv_queue: Queue[str] = queue.Queue()
 cancelled_uploads: set[str] = set()
 
@@ -159,7 +234,9 @@ class UploadQueueCache:
   @staticmethod
   def cache(upload_queue: Queue[UploadItem]) -> None:
     try:
+      # uploads in progress with stored blocks are kept too, so they resume after a restart
       queue: list[UploadItem | None] = list(upload_queue.queue)
+      queue += [replace(i, current=False, speed=0) for i in list(cur_upload_items.values()) if i is not None and i.upload_blocks]
       items = [asdict(i) for i in queue if i is not None and (i.id not in cancelled_uploads)]
       Params().put("AthenadUploadQueue", items)
     except Exception:
@@ -228,20 +305,24 @@ def retry_upload(tid: int, end_event: threading.Event, increase_count: bool = Tr
       item,
       retry_count=new_retry_count,
       progress=0,
+      speed=0,
       current=False
     )
+    cur_upload_items[tid] = None
     upload_queue.put_nowait(item)
     UploadQueueCache.cache(upload_queue)
 
-    cur_upload_items[tid] = None
-
     for _ in range(RETRY_DELAY):
       time.sleep(1)
       if end_event.is_set():
         break
+  elif item is not None and item.upload_blocks:
+    # out of retries, don't resume it after a restart either
+    cur_upload_items[tid] = None
+    UploadQueueCache.cache(upload_queue)
 
 
-def cb(sm, item, tid, end_event: threading.Event, sz: int, cur: int) -> None:
+def cb(sm, item, tid, end_event: threading.Event, start_time: float, progress: float, sent: int) -> None:
   # Abort transfer if connection changed to metered after starting upload
   # or if athenad is shutting down to re-connect the websocket
   if not item.allow_cellular:
@@ -253,7 +334,13 @@ def cb(sm, item, tid, end_event: threading.Event, sz: int, cur: int) -> None:
   if end_event.is_set():
     raise AbortTransferException
 
-  cur_upload_items[tid] = replace(item, progress=cur / sz if sz else 1)
+  dt = time.monotonic() - start_time
+  cur_upload_items[tid] = replace(cur_upload_items[tid] or item, progress=progress, speed=sent / dt if dt > 0 else 0)
+
+
+def block_cb(item, tid, upload_blocks: int, upload_offset: int) -> None:
+  cur_upload_items[tid] = replace(cur_upload_items[tid] or item, upload_blocks=upload_blocks, upload_offset=upload_offset)
+  UploadQueueCache.cache(upload_queue)
 
 
 def upload_handler(end_event: threading.Event) -> None:
@@ -293,12 +380,14 @@ def upload_handler(end_event: threading.Event) -> None:
 
         cloudlog.event("athena.upload_handler.upload_start", fn=fn, sz=sz, network_type=network_type, metered=metered, retry_count=item.retry_count)
 
-        with _do_upload(item, partial(cb, sm, item, tid, end_event)) as response:
+        with _do_upload(item, partial(cb, sm, item, tid, end_event, time.monotonic()), partial(block_cb, item, tid)) as response:
           if response.status_code not in (200, 201, 401, 403, 412):
             cloudlog.event("athena.upload_handler.retry", status_code=response.status_code, fn=fn, sz=sz, network_type=network_type, metered=metered)
             retry_upload(tid, end_event)
           else:
             cloudlog.event("athena.upload_handler.success", fn=fn, sz=sz, network_type=network_type, metered=metered)
+            # nothing left to resume
+            cur_upload_items[tid] = replace(cur_upload_items[tid] or item, upload_blocks=0, upload_offset=0)
 
         UploadQueueCache.cache(upload_queue)
       except (requests.exceptions.Timeout, requests.exceptions.ConnectionError, requests.exceptions.SSLError):
@@ -314,7 +403,87 @@ def upload_handler(end_event: threading.Event) -> None:
       cloudlog.exception("athena.upload_handler.exception")
 
 
-def _do_upload(upload_item: UploadItem, callback: Callable = None) -> requests.Response:
+def is_block_upload(upload_item: UploadItem, path: str) -> bool:
+  # Azure block blobs can be stored a block at a time, which lets big uploads resume where they left off
+  blob_type = next((v for k, v in upload_item.headers.items() if k.lower() == 'x-ms-blob-type'), None)
+  try:
+    return blob_type == 'BlockBlob' and os.path.getsize(path) > UPLOAD_BLOCK_SIZE
+  except OSError:
+    return False
+
+
+def block_id(idx: int) -> str:
+  # ids must be base64 and all the same length within a blob
+  return base64.b64encode(f"{idx:08d}".encode()).decode()
+
+
+def add_query(url: str, **query: str) -> str:
+  return url + ('&' if '?' in url else '?') + urlencode(query)
+
+
+def read_block(stream, size: int) -> bytes:
+  block = b""
+  while len(block) < size:
+    chunk = stream.read(size - len(block))
+    if not chunk:
+      break
+    block += chunk
+  return block
+
+
+def _do_block_upload(upload_item: UploadItem, path: str, compress: bool, callback: Callable | None,
+                     block_callback: Callable | None) -> requests.Response:
+  """
+    Uploads path in UPLOAD_BLOCK_SIZE blocks with Put Block, then commits them with Put Block List. Compression is done
+    as the file is read. Each stored block is reported to block_callback, a later attempt skips over those.
+  """
+  blocks, offset = upload_item.upload_blocks, upload_item.upload_offset
+  if offset != blocks * UPLOAD_BLOCK_SIZE:
+    blocks = offset = 0
+
+  headers = {k: v for k, v in upload_item.headers.items() if k.lower() != 'x-ms-blob-type'}
+  raw_size = os.path.getsize(path)
+  sent = 0
+  with open(path, "rb") as f:
+    stream = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL).stream_reader(f, size=raw_size) if compress else f
+    # compression is deterministic, so the stored blocks are the start of the stream this makes again
+    if compress:
+      while offset - stream.tell() > 0 and stream.read(min(offset - stream.tell(), UPLOAD_BLOCK_SIZE)):
+        pass
+    else:
+      f.seek(offset)
+
+    while block := read_block(stream, UPLOAD_BLOCK_SIZE):
+      def block_progress(block_sent: int, sent: int = sent) -> None:
+        if callback:
+          callback(f.tell() / raw_size if raw_size else 1, sent + block_sent)
+
+      response = UPLOAD_SESS.put(add_query(upload_item.url, comp="block", blockid=block_id(blocks)),
+                                 data=CallbackReader(io.BytesIO(block), block_progress),
+                                 headers={**headers, 'Content-Length': str(len(block))},
+                                 timeout=30)
+      if response.status_code not in (200, 201):
+        return response
+      response.close()
+
+      blocks += 1
+      offset += len(block)
+      sent += len(block)
+      # a short block is the last one, it's stored again along with the block list if that fails
+      if block_callback and len(block) == UPLOAD_BLOCK_SIZE:
+        block_callback(blocks, offset)
+
+  block_list = "".join(f"<Latest>{block_id(i)}</Latest>" for i in range(blocks))
+  body = f'<?xml version="1.0" encoding="utf-8"?><BlockList>{block_list}</BlockList>'.encode()
+  response = UPLOAD_SESS.put(add_query(upload_item.url, comp="blocklist"), data=body,
+                             headers={**headers, 'Content-Length': str(len(body))}, timeout=30)
+  if response.status_code == 400 and block_callback:
+    # stored blocks are dropped if they aren't committed within a week, start over
+    block_callback(0, 0)
+  return response
+
+
+def _do_upload(upload_item: UploadItem, callback: Callable = None, block_callback: Callable = None) -> requests.Response:
   path = upload_item.path
   compress = False
 
@@ -323,11 +492,19 @@ def _do_upload(upload_item: UploadItem, callback: Callable = None) -> requests.R
     path = strip_zst_extension(path)
     compress = True
 
+  if is_block_upload(upload_item, path):
+    return _do_block_upload(upload_item, path, compress, callback, block_callback)
+
   stream = None
   try:
     stream, content_length = get_upload_stream(path, compress)
+
+    def progress(cur: int) -> None:
+      if callback:
+        callback(cur / content_length if content_length else 1, cur)
+
     response = UPLOAD_SESS.put(upload_item.url,
-                               data=CallbackReader(stream, callback, content_length) if callback else stream,
+                               data=CallbackReader(stream, progress) if callback else stream,
                                headers={**upload_item.headers, 'Content-Length': str(content_length)},
                                timeout=30)
     return response
@@ -579,7 +756,6 @@ def takeSnapshot() -> str | dict[str, str] | None:
 
 
 def get_logs_to_send_sorted() -> list[str]:
-  # TODO: scan once then use inotify to detect file creation/deletion
   curr_time = int(time.time())  # noqa: TID251
   logs = []
   for log_entry in os.listdir(Paths.swaglog_root()):
@@ -592,72 +768,182 @@ def get_logs_to_send_sorted() -> list[str]:
     except (ValueError, TypeError):
       pass
     # assume send failed and we lost the response if sent more than one hour ago
-    if not time_sent or curr_time - time_sent > 3600:
+    if not time_sent or curr_time - time_sent > LOG_RESEND_AGE:
       logs.append(log_entry)
   # excluding most recent (active) log file
   return sorted(logs)[:-1]
 
 
+class SwaglogQueue:
+  """
+    Swaglog files waiting to be forwarded, newest first. The swaglog directory is listed once, then files are added
+    as logmessaged closes them, from inotify events. Where inotify isn't available it's rescanned every
+    LOG_SCAN_INTERVAL seconds instead. Files that were sent but never acknowledged come back with the hourly rescan.
+  """
+  def __init__(self):
+    self.root = Paths.swaglog_root()
+    self.logs: list[str] = []
+    self.inotify: Inotify | None = None
+    self.last_scan = float('-inf')
+
+  def close(self) -> None:
+    if self.inotify is not None:
+      self.inotify.close()
+      self.inotify = None
+
+  def __len__(self) -> int:
+    return len(self.logs)
+
+  def add(self, log_entry: str) -> None:
+    i = bisect.bisect_left(self.logs, log_entry)
+    if i == len(self.logs) or self.logs[i] != log_entry:
+      self.logs.insert(i, log_entry)
+
+  def remove(self, log_entry: str) -> None:
+    i = bisect.bisect_left(self.logs, log_entry)
+    if i < len(self.logs) and self.logs[i] == log_entry:
+      del self.logs[i]
+
+  def pop(self) -> str:
+    return self.logs.pop()
+
+  def scan(self) -> None:
+    self.last_scan = time.monotonic()
+    if self.inotify is None:
+      try:
+        self.inotify = Inotify()
+        self.inotify.add_watch(self.root, SWAGLOG_EVENTS)
+      except OSError:
+        self.close()
+    self.logs = get_logs_to_send_sorted()
+
+  def update(self) -> None:
+    interval = LOG_RESEND_AGE if self.inotify is not None else LOG_SCAN_INTERVAL
+    if time.monotonic() - self.last_scan > interval:
+      self.scan()
+      return
+
+    if self.inotify is None:
+      return
+    for event in self.inotify.read():
+      if event.mask & (IN_Q_OVERFLOW | IN_IGNORED):
+        # events were lost or the directory is gone, start over
+        self.close()
+        self.scan()
+        return
+      if event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO):
+        self.add(event.name)
+      elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+        self.remove(event.name)
+
+
+@dataclass
+class LogBatch:
+  id: str
+  logs: list[str]
+  sent_at: float
+  compressed: bool
+
+
+def read_log_batch(logs: SwaglogQueue) -> tuple[list[str], str]:
+  """Takes the newest logs off the queue, up to LOG_BATCH_MAX_BYTES, marking them as sent. Returns their names and contents"""
+  entries: list[str] = []
+  data: list[str] = []
+  size = 0
+  curr_time = int.to_bytes(int(time.time()), 4, sys.byteorder)  # noqa: TID251
+  while len(logs) and size < LOG_BATCH_MAX_BYTES and len(entries) < LOG_BATCH_MAX_FILES:
+    log_entry = logs.pop()
+    log_path = os.path.join(Paths.swaglog_root(), log_entry)
+    try:
+      setxattr(log_path, LOG_ATTR_NAME, curr_time)
+      with open(log_path) as f:
+        contents = f.read()
+    except OSError:
+      continue  # file could be deleted by log rotation
+    if contents and not contents.endswith("\n"):
+      contents += "\n"
+    entries.append(log_entry)
+    data.append(contents)
+    size += len(contents)
+  return entries, "".join(data)
+
+
+def forward_logs(logs: SwaglogQueue, compress: bool) -> LogBatch | None:
+  entries, data = read_log_batch(logs)
+  if not entries:
+    return None
+
+  params: dict[str, str] = {"logs": data}
+  if compress:
+    # under its own name, so a server that only knows logs rejects the request instead of storing the compressed bytes
+    compressed = zstd.ZstdCompressor(level=LOG_COMPRESSION_LEVEL).compress(data.encode())
+    params = {"logs_zst": base64.b64encode(compressed).decode()}
+
+  # a single log keeps its file name as the id, like before logs were batched
+  batch = LogBatch(entries[0], entries, time.monotonic(), compress)
+  jsonrpc = {
+    "method": "forwardLogs",
+    "params": params,
+    "jsonrpc": "2.0",
+    "id": batch.id,
+  }
+  cloudlog.debug(f"athena.log_handler.forward_request {batch.id} {len(entries)} {len(data)}")
+  low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
+  return batch
+
+
 def log_handler(end_event: threading.Event) -> None:
   if PC:
     return
 
-  log_files = []
-  last_scan = 0.
-  while not end_event.is_set():
-    try:
-      curr_scan = time.monotonic()
-      if curr_scan - last_scan > 10:
-        log_files = get_logs_to_send_sorted()
-        last_scan = curr_scan
+  logs = SwaglogQueue()
+  in_flight: dict[str, LogBatch] = {}
+  compress = LOG_COMPRESSION
+  try:
+    while not end_event.is_set():
+      try:
+        logs.update()
 
-      # send one log
-      curr_log = None
-      if len(log_files) > 0:
-        log_entry = log_files.pop() # newest log file
-        cloudlog.debug(f"athena.log_handler.forward_request {log_entry}")
-        try:
-          curr_time = int(time.time())  # noqa: TID251
-          log_path = os.path.join(Paths.swaglog_root(), log_entry)
-          setxattr(log_path, LOG_ATTR_NAME, int.to_bytes(curr_time, 4, sys.byteorder))
-          with open(log_path) as f:
-            jsonrpc = {
-              "method": "forwardLogs",
-              "params": {
-                "logs": f.read()
-              },
-              "jsonrpc": "2.0",
-              "id": log_entry
-            }
-            low_priority_send_queue.put_nowait(json.dumps(jsonrpc))
-            curr_log = log_entry
-        except OSError:
-          pass  # file could be deleted by log rotation
+        # give up on responses that never came, those logs are sent again after LOG_RESEND_AGE
+        now = time.monotonic()
+        for batch_id in [k for k, b in in_flight.items() if now - b.sent_at > LOG_RESPONSE_TIMEOUT]:
+          del in_flight[batch_id]
+
+        while len(in_flight) < LOG_BATCHES_IN_FLIGHT:
+          batch = forward_logs(logs, compress)
+          if batch is None:
+            break
+          in_flight[batch.id] = batch
 
-      # wait for response up to ~100 seconds
-      # always read queue at least once to process any old responses that arrive
-      for _ in range(100):
-        if end_event.is_set():
-          break
         try:
           log_resp = json.loads(log_recv_queue.get(timeout=1))
-          log_entry = log_resp.get("id")
-          log_success = "result" in log_resp and log_resp["result"].get("success")
-          cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
-          if log_entry and log_success:
-            log_path = os.path.join(Paths.swaglog_root(), log_entry)
+        except queue.Empty:
+          continue
+
+        log_entry = log_resp.get("id")
+        log_success = "result" in log_resp and log_resp["result"].get("success")
+        cloudlog.debug(f"athena.log_handler.forward_response {log_entry} {log_success}")
+        batch = in_flight.pop(log_entry, None)
+        if batch is not None and batch.compressed and log_resp.get("error", {}).get("code") in LOG_COMPRESSION_UNSUPPORTED:
+          # server doesn't take compressed logs, send them again as they are.
+          # other errors don't turn compression off, those logs are sent again compressed after LOG_RESEND_AGE
+          cloudlog.event("athena.log_handler.compression_unsupported", error=log_resp["error"])
+          compress = False
+          for entry in batch.logs:
+            logs.add(entry)
+          continue
+
+        if log_entry and log_success:
+          for entry in (batch.logs if batch is not None else [log_entry]):
             try:
-              setxattr(log_path, LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
+              setxattr(os.path.join(Paths.swaglog_root(), entry), LOG_ATTR_NAME, LOG_ATTR_VALUE_MAX_UNIX_TIME)
             except OSError:
               pass  # file could be deleted by log rotation
-          if curr_log == log_entry:
-            break
-        except queue.Empty:
-          if curr_log is None:
-            break
 
-    except Exception:
-      cloudlog.exception("athena.log_handler.exception")
+      except Exception:
+        cloudlog.exception("athena.log_handler.exception")
+  finally:
+    logs.close()
 
 
 def stat_handler(end_event: threading.Event) -> None:
@@ -743,6 +1029,9 @@ def ws_recv(ws: WebSocket, end_event: threading.Event) -> None:
     try:
       opcode, data = ws.recv_data(control_frame=True)
       if opcode in (ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY):
+        if opcode == ABNF.OPCODE_BINARY and data.startswith(ZSTD_MAGIC):
+          data = zstd.ZstdDecompressor().decompressobj().decompress(data)
+          opcode = ABNF.OPCODE_TEXT
         if opcode == ABNF.OPCODE_TEXT:
           data = data.decode("utf-8")
         recv_queue.put_nowait(data)
@@ -759,20 +1048,32 @@ def ws_recv(ws: WebSocket, end_event: threading.Event) -> None:
       end_event.set()
 
 
+def ws_compression(ws: WebSocket) -> bool:
+  # the server says it takes zstd compressed binary messages in its handshake response
+  headers = ws.getheaders() if hasattr(ws, "getheaders") else None
+  return (headers or {}).get(WS_COMPRESSION_HEADER.lower()) == "zstd"
+
+
+def encode_message(data: str, compressor: zstd.ZstdCompressor | None) -> tuple[bytes, int]:
+  payload = data.encode("utf-8")
+  if compressor is not None and len(payload) >= WS_COMPRESSION_MIN_SIZE:
+    return compressor.compress(payload), ABNF.OPCODE_BINARY
+  return payload, ABNF.OPCODE_TEXT
+
+
 def ws_send(ws: WebSocket, end_event: threading.Event) -> None:
+  scheduler = SendScheduler(send_queue, low_priority_send_queue, send_ready)
+  compressor = zstd.ZstdCompressor(level=WS_COMPRESSION_LEVEL) if ws_compression(ws) else None
   while not end_event.is_set():
     try:
-      try:
-        data = send_queue.get_nowait()
-      except queue.Empty:
-        data = low_priority_send_queue.get(timeout=1)
-      for i in range(0, len(data), WS_FRAME_SIZE):
-        frame = data[i:i+WS_FRAME_SIZE]
-        last = i + WS_FRAME_SIZE >= len(data)
-        opcode = ABNF.OPCODE_TEXT if i == 0 else ABNF.OPCODE_CONT
-        ws.send_frame(ABNF.create_frame(frame, opcode, last))
-    except queue.Empty:
-      pass
+      data = scheduler.get(timeout=1)
+      if data is None:
+        continue
+      payload, opcode = encode_message(data, compressor)
+      for i in range(0, len(payload), WS_FRAME_SIZE):
+        frame = payload[i:i+WS_FRAME_SIZE]
+        last = i + WS_FRAME_SIZE >= len(payload)
+        ws.send_frame(ABNF.create_frame(frame, opcode if i == 0 else ABNF.OPCODE_CONT, last))
     except Exception:
       cloudlog.exception("athenad.ws_send.exception")
       end_event.set()
@@ -831,6 +1132,7 @@ def main(exit_event: threading.Event = None):
       cloudlog.event("athenad.main.connecting_ws", ws_uri=ws_uri, retries=conn_retries)
       ws = create_connection(ws_uri,
                              cookie="jwt=" + api.get_token(),
+                             header=[f"{WS_COMPRESSION_HEADER}: zstd"],
                              enable_multithread=True,
                              timeout=30.0)
       cloudlog.event("athenad.main.connected_ws", ws_uri=ws_uri, retries=conn_retries,
@@ -0,0 +1,123 @@
+#!/usr/bin/env python3
+"""
+Sends typical athena messages through ws_send to a local websocket echo server, with and without compression,
+and measures how much goes over the wire and how long high priority messages wait behind a low priority backlog.
+
+  python -m openpilot.system.athena.tests.benchmark_ws --link-kbps 1000
+"""
+import argparse
+import json
+import queue
+import random
+import threading
+import time
+
+from websocket import create_connection
+
+from openpilot.system.athena import athenad
+from openpilot.system.athena.tests.helpers import WebsocketEchoServer
+
+
+def swaglog_lines(n: int) -> str:
+  lines = []
+  for i in range(n):
+    lines.append(json.dumps({
+      "msg": random.choice(["uploader.upload_success", "athena.log_handler.forward_request", "thermald.fan_speed"]),
+      "ctx": {"dongle_id": "0000000000000000", "version": "0.9.8", "dirty": False, "device": "tici"},
+      "level": "INFO", "levelnum": 20, "created": 1700000000 + i * 0.01, "filename": "athenad.py", "lineno": random.randrange(1000),
+    }) + "\n")
+  return "".join(lines)
+
+
+def messages() -> dict[str, list[str]]:
+  return {
+    "getMessage": [json.dumps({"result": {"deviceState": {"cpuTempC": [random.uniform(40, 60) for _ in range(8)],
+                                                          "networkType": "wifi", "freeSpacePercent": random.uniform(0, 100),
+                                                          "memoryUsagePercent": random.randrange(100)}},
+                               "jsonrpc": "2.0", "id": i}) for i in range(100)],
+    "forwardLogs": [json.dumps({"method": "forwardLogs", "params": {"logs": swaglog_lines(2000)}, "jsonrpc": "2.0", "id": f"swaglog.{i:010}"})
+                    for i in range(10)],
+  }
+
+
+def connect(server: WebsocketEchoServer):
+  ws = create_connection(server.url, header=[f"{athenad.WS_COMPRESSION_HEADER}: zstd"], enable_multithread=True, timeout=1)
+  end_event = threading.Event()
+  threads = [threading.Thread(target=athenad.ws_send, args=(ws, end_event)), threading.Thread(target=athenad.ws_recv, args=(ws, end_event))]
+  for t in threads:
+    t.start()
+
+  def close():
+    # ws_recv notices within the socket timeout
+    end_event.set()
+    for t in threads:
+      t.join()
+    ws.close()
+    server.close()
+  return close
+
+
+def bench_compression(compression: bool, link_kbps: float) -> None:
+  for name, msgs in messages().items():
+    server = WebsocketEchoServer(compression)
+    close = connect(server)
+    try:
+      t = time.monotonic()
+      for m in msgs:
+        athenad.low_priority_send_queue.put_nowait(m)
+      for _ in msgs:
+        athenad.recv_queue.get(timeout=30)
+      dt = time.monotonic() - t
+    finally:
+      close()
+
+    raw = sum(len(m) for m in msgs)
+    wire = sum(len(m) for _, m in server.messages)
+    print(f"  {name:12s} {len(msgs):4d} msgs  {raw / 1e6:7.2f} MB -> {wire / 1e6:7.2f} MB on the wire ({raw / wire:5.1f}x)  " +
+          f"{dt * 1e3:7.1f} ms locally  {wire * 8 / link_kbps / 1e3:7.2f} s at {link_kbps:g} kbit/s")
+
+
+def bench_priority(backlog: int) -> None:
+  server = WebsocketEchoServer(True)
+  close = connect(server)
+  logs = messages()["forwardLogs"]
+  latencies = []
+  try:
+    # a high priority request every 50 ms while a backlog of log batches is going out
+    for i in range(backlog):
+      athenad.low_priority_send_queue.put_nowait(logs[i % len(logs)])
+    for i in range(20):
+      t = time.monotonic()
+      athenad.send_queue.put_nowait(json.dumps({"result": i, "jsonrpc": "2.0", "id": i}))
+      while True:
+        resp = athenad.recv_queue.get(timeout=30)
+        if json.loads(resp).get("result") == i:
+          break
+      latencies.append(time.monotonic() - t)
+      time.sleep(0.05)
+  finally:
+    close()
+    while not athenad.recv_queue.empty():
+      try:
+        athenad.recv_queue.get_nowait()
+      except queue.Empty:
+        break
+
+  latencies.sort()
+  print(f"  high priority round trip with {backlog} log batches queued: " +
+        f"median {latencies[len(latencies) // 2] * 1e3:.1f} ms, max {latencies[-1] * 1e3:.1f} ms")
+
+
+if __name__ == "__main__":
+  parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+  parser.add_argument("--link-kbps", type=float, default=1000, help="uplink speed to estimate transfer times for")
+  parser.add_argument("--backlog", type=int, default=50, help="low priority messages queued for the priority benchmark")
+  args = parser.parse_args()
+
+  random.seed(0)
+  for compression in (False, True):
+    print(f"compression {'on' if compression else 'off'}:")
+    bench_compression(compression, args.link_kbps)
+  print("priority:")
+  bench_priority(0)
+  bench_priority(args.backlog)
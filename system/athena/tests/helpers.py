@@ -1,5 +1,11 @@
+import base64
+import hashlib
 import http.server
+import re
 import socket
+import struct
+import threading
+from urllib.parse import parse_qs, urlparse
 
 
 class MockResponse:
@@ -68,3 +74,138 @@ class HTTPRequestHandler(http.server.SimpleHTTPRequestHandler):
     self.rfile.read(length)
     self.send_response(201, "Created")
     self.end_headers()
+
+
+class BlockBlobRequestHandler(http.server.BaseHTTPRequestHandler):
+  """Stores uploads like Azure block blobs. Requests numbered in failures get a 500, or no response if it's "drop"."""
+  failures: dict[int, str] = {}
+  requests: list[tuple[str, str | None]] = []
+  blocks: dict[str, dict[str, bytes]] = {}
+  blobs: dict[str, bytes] = {}
+
+  @classmethod
+  def reset(cls, failures=None):
+    cls.failures = failures or {}
+    cls.requests = []
+    cls.blocks = {}
+    cls.blobs = {}
+
+  def do_PUT(self):
+    url = urlparse(self.path)
+    query = parse_qs(url.query)
+    comp = query.get('comp', [None])[0]
+    data = self.rfile.read(int(self.headers['Content-Length']))
+
+    failure = self.failures.get(len(self.requests))
+    self.requests.append((comp, query.get('blockid', [None])[0]))
+    if failure == "drop":
+      self.close_connection = True
+      return
+    if failure is not None:
+      self.send_response(500)
+      self.end_headers()
+      return
+
+    status = 201
+    if comp == 'block':
+      self.blocks.setdefault(url.path, {})[query['blockid'][0]] = data
+    elif comp == 'blocklist':
+      stored = self.blocks.pop(url.path, {})
+      ids = re.findall(r"<Latest>(.*?)</Latest>", data.decode())
+      if all(i in stored for i in ids):
+        self.blobs[url.path] = b"".join(stored[i] for i in ids)
+      else:
+        status = 400
+    else:
+      self.blobs[url.path] = data
+    self.send_response(status)
+    self.end_headers()
+
+
+class WebsocketEchoServer:
+  """Websocket server that sends every message back as it got it. Says it takes zstd messages if compression is set."""
+  GUID = b"258EAFA5-E914-47DA-95CA-C5AB0DC85B11"
+
+  def __init__(self, compression: bool = True):
+    self.compression = compression
+    self.messages: list[tuple[int, bytes]] = []
+    self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    self.socket.bind(('127.0.0.1', 0))
+    self.socket.listen(1)
+    self.url = f"ws://127.0.0.1:{self.socket.getsockname()[1]}/"
+    self.thread = threading.Thread(target=self.run, daemon=True)
+    self.thread.start()
+
+  def close(self):
+    self.socket.close()
+
+  @staticmethod
+  def _recv(conn, n: int) -> bytes:
+    buf = b""
+    while len(buf) < n:
+      chunk = conn.recv(n - len(buf))
+      if not chunk:
+        raise ConnectionError
+      buf += chunk
+    return buf
+
+  def _handshake(self, conn):
+    request = b""
+    while b"\r\n\r\n" not in request:
+      request += conn.recv(4096)
+    headers = dict(line.split(": ", 1) for line in request.decode().split("\r\n")[1:] if ": " in line)
+    accept = base64.b64encode(hashlib.sha1(headers["Sec-WebSocket-Key"].encode() + self.GUID).digest()).decode()
+    response = f"HTTP/1.1 101 Switching Protocols\r\nUpgrade: websocket\r\nConnection: Upgrade\r\nSec-WebSocket-Accept: {accept}\r\n"
+    if self.compression and headers.get("X-Athena-Compression") == "zstd":
+      response += "X-Athena-Compression: zstd\r\n"
+    conn.sendall((response + "\r\n").encode())
+
+  def _recv_frame(self, conn) -> tuple[bool, int, bytes]:
+    b0, b1 = self._recv(conn, 2)
+    length = b1 & 0x7f
+    if length == 126:
+      length = struct.unpack(">H", self._recv(conn, 2))[0]
+    elif length == 127:
+      length = struct.unpack(">Q", self._recv(conn, 8))[0]
+    mask = self._recv(conn, 4) if b1 & 0x80 else b""
+    payload = self._recv(conn, length)
+    if mask:
+      payload = (int.from_bytes(payload, "big") ^ int.from_bytes((mask * (length // 4 + 1))[:length], "big")).to_bytes(length, "big")
+    return bool(b0 & 0x80), b0 & 0x0f, payload
+
+  @staticmethod
+  def _send_frame(conn, opcode: int, payload: bytes):
+    if len(payload) < 126:
+      header = struct.pack(">BB", 0x80 | opcode, len(payload))
+    elif len(payload) < 1 << 16:
+      header = struct.pack(">BBH", 0x80 | opcode, 126, len(payload))
+    else:
+      header = struct.pack(">BBQ", 0x80 | opcode, 127, len(payload))
+    conn.sendall(header + payload)
+
+  def run(self):
+    try:
+      conn, _ = self.socket.accept()
+    except OSError:
+      return
+    with conn:
+      try:
+        self._handshake(conn)
+        opcode, message = 0, b""
+        while True:
+          fin, frame_opcode, payload = self._recv_frame(conn)
+          if frame_opcode == 0x8:  # close
+            self._send_frame(conn, 0x8, payload[:2])
+            break
+          if frame_opcode == 0x9:  # ping
+            self._send_frame(conn, 0xa, payload)
+            continue
+          if frame_opcode != 0x0:
+            opcode, message = frame_opcode, b""
+          message += payload
+          if fin:
+            self.messages.append((opcode, message))
+            self._send_frame(conn, opcode, message)
+      except (ConnectionError, OSError):
+        pass
@@ -1,4 +1,5 @@
 import pytest
+import base64
 from functools import wraps
 import json
 import multiprocessing
@@ -8,10 +9,11 @@ import shutil
 import time
 import threading
 import queue
+import zstandard as zstd
 from dataclasses import asdict, replace
 from datetime import datetime, timedelta
 
-from websocket import ABNF
+from websocket import ABNF, create_connection
 from websocket._exceptions import WebSocketConnectionClosedException
 
 from cereal import messaging
@@ -20,7 +22,8 @@ from openpilot.common.params import Params
 from openpilot.common.timeout import Timeout
 from openpilot.system.athena import athenad
 from openpilot.system.athena.athenad import MAX_RETRY_COUNT, UPLOAD_SESS, dispatcher
-from openpilot.system.athena.tests.helpers import HTTPRequestHandler, MockWebsocket, MockApi, EchoSocket
+from openpilot.system.athena.tests.helpers import BlockBlobRequestHandler, HTTPRequestHandler, MockWebsocket, MockApi, EchoSocket, \
+                                                 WebsocketEchoServer
 from openpilot.selfdrive.test.helpers import http_server_context
 from openpilot.system.hardware.hw import Paths
 
@@ -56,6 +59,12 @@ def host():
   with http_server_context(handler=HTTPRequestHandler, setup=seed_athena_server) as (host, port):
     yield f"http://{host}:{port}"
 
+@pytest.fixture
+def block_blob_host():
+  BlockBlobRequestHandler.reset()
+  with http_server_context(handler=BlockBlobRequestHandler) as (host, port):
+    yield f"http://{host}:{port}"
+
 class TestAthenadMethods:
   @classmethod
   def setup_class(cls):
@@ -198,6 +207,69 @@ class TestAthenadMethods:
     resp = athenad._do_upload(item)
     assert resp.status_code == 201
 
+  @pytest.mark.parametrize("compress", [True, False])
+  def test_do_upload_blocks(self, mocker, block_blob_host, compress):
+    mocker.patch.object(athenad, "UPLOAD_BLOCK_SIZE", 64 * 1024)
+    data = os.urandom(300 * 1024)
+    fn = self._create_file('qlog', data=data)
+    item = athenad.UploadItem(path=fn + ('.zst' if compress else ''), url=f"{block_blob_host}/qlog.zst?sig=sig", headers={'x-ms-blob-type': 'BlockBlob'},
+                              created_at=int(time.time()*1000), id='')  # noqa: TID251
+
+    # third block fails, the first two are kept
+    BlockBlobRequestHandler.reset({2: "error"})
+    stored = []
+    resp = athenad._do_upload(item, block_callback=lambda *args: stored.append(args))
+    assert resp.status_code == 500
+    assert stored == [(1, 64 * 1024), (2, 128 * 1024)]
+
+    # resumes from the third block, the connection drops before the block list is committed
+    BlockBlobRequestHandler.failures = {len(BlockBlobRequestHandler.requests) + 3: "drop"}
+    item = replace(item, upload_blocks=2, upload_offset=128 * 1024)
+    with pytest.raises(requests.exceptions.ConnectionError):
+      athenad._do_upload(item)
+
+    item = replace(item, upload_blocks=4, upload_offset=256 * 1024)
+    resp = athenad._do_upload(item)
+    assert resp.status_code == 201
+
+    block_ids = [block_id for comp, block_id in BlockBlobRequestHandler.requests if comp == 'block']
+    sent = [athenad.block_id(i) for i in range(3)] + [athenad.block_id(i) for i in range(2, 5)] + [athenad.block_id(4)]
+    if not compress:
+      assert block_ids == sent
+    blob = BlockBlobRequestHandler.blobs['/qlog.zst']
+    assert (zstd.ZstdDecompressor().decompress(blob) if compress else blob) == data
+
+  def test_do_upload_blocks_expired(self, mocker, block_blob_host):
+    mocker.patch.object(athenad, "UPLOAD_BLOCK_SIZE", 256)
+    fn = self._create_file('qlog', data=os.urandom(1024))
+    item = athenad.UploadItem(path=fn, url=f"{block_blob_host}/qlog", headers={'x-ms-blob-type': 'BlockBlob'}, created_at=int(time.time()*1000),  # noqa: TID251
+                              id='', upload_blocks=2, upload_offset=512)
+
+    # blocks that were never committed are gone, so the block list is rejected and the upload starts over next time
+    stored = []
+    resp = athenad._do_upload(item, block_callback=lambda *args: stored.append(args))
+    assert resp.status_code == 400
+    assert stored[-1] == (0, 0)
+
+  @with_upload_handler
+  def test_upload_handler_resume(self, mocker, block_blob_host):
+    mocker.patch.object(athenad, "UPLOAD_BLOCK_SIZE", 64 * 1024)
+    BlockBlobRequestHandler.reset({1: "error"})
+    fn = self._create_file('qlog', data=os.urandom(200 * 1024))
+    item = athenad.UploadItem(path=fn, url=f"{block_blob_host}/qlog", headers={'x-ms-blob-type': 'BlockBlob'}, created_at=int(time.time()*1000),  # noqa: TID251
+                              id='id', allow_cellular=True)
+
+    athenad.upload_queue.put_nowait(item)
+    self._wait_for_upload()
+    with Timeout(5, 'upload not retried'):
+      while athenad.upload_queue.qsize() == 0:
+        time.sleep(0.1)
+
+    # the resume point is kept, also across restarts
+    retry = athenad.upload_queue.queue[0]
+    assert (retry.retry_count, retry.upload_blocks, retry.upload_offset) == (1, 1, 64 * 1024)
+    assert Params().get("AthenadUploadQueue")[0]['upload_blocks'] == 1
+
   def test_upload_file_to_url(self, host):
     fn = self._create_file('qlog.zst')
 
@@ -446,3 +518,123 @@ class TestAthenadMethods:
     # ensure the list is all logs except most recent
     sl = athenad.get_logs_to_send_sorted()
     assert sl == fl[:-1]
+
+  def test_send_scheduler(self):
+    ready = threading.Event()
+    high, low = athenad.SendQueue(ready), athenad.SendQueue(ready)
+    scheduler = athenad.SendScheduler(high, low, ready)
+    for i in range(2):
+      low.put_nowait(f"low {i}")
+    for i in range(10):
+      high.put_nowait(f"high {i}")
+
+    # high priority first, without starving low priority
+    sent = [scheduler.get(timeout=0) for _ in range(12)]
+    assert sent == [f"high {i}" for i in range(4)] + ["low 0"] + [f"high {i}" for i in range(4, 8)] + ["low 1", "high 8", "high 9"]
+    assert scheduler.get(timeout=0) is None
+
+    # wakes up as soon as something is queued
+    threading.Timer(0.1, high.put_nowait, args=("high",)).start()
+    t = time.monotonic()
+    assert scheduler.get(timeout=5) == "high"
+    assert time.monotonic() - t < 1
+
+  @pytest.mark.parametrize("compression", [True, False])
+  def test_ws_send_compression(self, compression):
+    server = WebsocketEchoServer(compression)
+    ws = create_connection(server.url, header=[f"{athenad.WS_COMPRESSION_HEADER}: zstd"], enable_multithread=True, timeout=5)
+    end_event = threading.Event()
+    threads = [threading.Thread(target=athenad.ws_send, args=(ws, end_event)), threading.Thread(target=athenad.ws_recv, args=(ws, end_event))]
+    for thread in threads:
+      thread.start()
+    try:
+      small = json.dumps({"method": "echo", "params": ["hi"], "jsonrpc": "2.0", "id": 0})
+      large = json.dumps({"result": {"logs": "log line\n" * 10000}, "jsonrpc": "2.0", "id": 1})
+      athenad.send_queue.put_nowait(small)
+      athenad.low_priority_send_queue.put_nowait(large)
+
+      # messages come back the same, big ones compressed if the server takes it
+      assert athenad.recv_queue.get(timeout=5) == small
+      assert athenad.recv_queue.get(timeout=5) == large
+      opcodes = [opcode for opcode, _ in server.messages]
+      assert opcodes == [ABNF.OPCODE_TEXT, ABNF.OPCODE_BINARY if compression else ABNF.OPCODE_TEXT]
+      if compression:
+        assert len(server.messages[1][1]) < len(large) / 10
+    finally:
+      end_event.set()
+      for thread in threads:
+        thread.join()
+      ws.close()
+      server.close()
+
+  def _forwarded_logs(self, compressed=False):
+    req = json.loads(athenad.low_priority_send_queue.get(timeout=5))
+    assert req["method"] == "forwardLogs"
+    assert list(req["params"]) == (["logs_zst"] if compressed else ["logs"])
+    if compressed:
+      return req["id"], zstd.ZstdDecompressor().decompress(base64.b64decode(req["params"]["logs_zst"])).decode()
+    return req["id"], req["params"]["logs"]
+
+  def test_log_handler_error(self, mocker):
+    mocker.patch.object(athenad, "PC", False)
+    mocker.patch.object(athenad, "LOG_BATCHES_IN_FLIGHT", 1)
+    for i in range(2):
+      self._create_file(f'swaglog.{i:010}', Paths.swaglog_root(), f'log {i}\n'.encode())
+
+    end_event = threading.Event()
+    thread = threading.Thread(target=athenad.log_handler, args=(end_event,))
+    thread.start()
+    try:
+      log_id, logs = self._forwarded_logs(compressed=True)
+      assert logs == 'log 0\n'
+
+      # any other error than the server not knowing logs_zst keeps the logs compressed
+      athenad.log_recv_queue.put_nowait(json.dumps({'error': {'code': -32000, 'message': 'Server error'}, 'id': log_id, 'jsonrpc': '2.0'}))
+      with open(os.path.join(Paths.swaglog_root(), 'swaglog.0000000002'), 'w') as f:
+        f.write('log 2')
+      log_id, logs = self._forwarded_logs(compressed=True)
+      assert logs == 'log 2\n'
+    finally:
+      end_event.set()
+      thread.join()
+
+  def test_log_handler(self, mocker):
+    mocker.patch.object(athenad, "PC", False)
+    mocker.patch.object(athenad, "LOG_BATCHES_IN_FLIGHT", 1)
+    mocker.patch.object(athenad, "LOG_BATCH_MAX_FILES", 2)
+    for i in range(4):
+      self._create_file(f'swaglog.{i:010}', Paths.swaglog_root(), f'log {i}\n'.encode())
+
+    end_event = threading.Event()
+    thread = threading.Thread(target=athenad.log_handler, args=(end_event,))
+    thread.start()
+    try:
+      # newest first, leaving out the active log, several logs per request
+      log_id, logs = self._forwarded_logs(compressed=True)
+      assert log_id == 'swaglog.0000000002'
+      assert logs == 'log 2\nlog 1\n'
+      athenad.log_recv_queue.put_nowait(json.dumps({'result': {'success': 1}, 'id': log_id, 'jsonrpc': '2.0'}))
+
+      # logs are picked up as they're closed
+      log_id, logs = self._forwarded_logs(compressed=True)
+      assert logs == 'log 0\n'
+      with open(os.path.join(Paths.swaglog_root(), 'swaglog.0000000004'), 'w') as f:
+        f.write('log 4')
+
+      # compressed logs are sent again uncompressed if the server doesn't take them
+      athenad.log_recv_queue.put_nowait(json.dumps({'error': {'code': -32602}, 'id': log_id, 'jsonrpc': '2.0'}))
+      sent = []
+      while len(sent) < 2:
+        log_id, logs = self._forwarded_logs()
+        sent += logs.splitlines()
+        athenad.log_recv_queue.put_nowait(json.dumps({'result': {'success': 1}, 'id': log_id, 'jsonrpc': '2.0'}))
+      assert sorted(sent) == ['log 0', 'log 4']
+
+      # acknowledged logs are marked as sent for good
+      fns = [os.path.join(Paths.swaglog_root(), f'swaglog.{i:010}') for i in (0, 1, 2, 4)]
+      with Timeout(5, 'logs not marked as sent'):
+        while any(athenad.getxattr(fn, athenad.LOG_ATTR_NAME) != athenad.LOG_ATTR_VALUE_MAX_UNIX_TIME for fn in fns):
+          time.sleep(0.1)
+    finally:
+      end_event.set()
+      thread.join()
@@ -3,13 +3,18 @@ import time
 import threading
 import logging
 import json
+import http.server
+import pytest
+import zstandard as zstd
 from pathlib import Path
 from openpilot.system.hardware.hw import Paths
 
 from openpilot.common.swaglog import cloudlog
-from openpilot.system.loggerd.uploader import main, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+import openpilot.system.loggerd.uploader as uploader
+from openpilot.system.loggerd.uploader import main, Uploader, UPLOAD_ATTR_NAME, UPLOAD_ATTR_VALUE
+from openpilot.selfdrive.test.helpers import http_server_context
 
-from openpilot.system.loggerd.tests.loggerd_tests_common import UploaderTestCase
+from openpilot.system.loggerd.tests.loggerd_tests_common import MockResponse, UploaderTestCase
 
 
 class FakeLogHandler(logging.Handler):
@@ -35,6 +40,37 @@ log_handler = FakeLogHandler()
 cloudlog.addHandler(log_handler)
 
 
+class UploadRequestHandler(http.server.BaseHTTPRequestHandler):
+  # status and body chunked uploads are turned down with, if they are
+  CHUNKED_REJECTION: tuple[int, bytes] | None = None
+  bodies: list[tuple[bytes, bool]] = []
+
+  def do_PUT(self):
+    chunked = self.headers.get("Transfer-Encoding") == "chunked"
+    if chunked and self.CHUNKED_REJECTION is not None:
+      status, body = self.CHUNKED_REJECTION
+      self.send_response(status)
+      self.send_header("Content-Length", str(len(body)))
+      self.end_headers()
+      self.wfile.write(body)
+      return
+
+    body = b""
+    if chunked:
+      while (size := int(self.rfile.readline().strip(), 16)) > 0:
+        body += self.rfile.read(size)
+        self.rfile.readline()
+      self.rfile.readline()
+    else:
+      body = self.rfile.read(int(self.headers["Content-Length"]))
+    self.bodies.append((body, chunked))
+    self.send_response(201)
+    self.end_headers()
+
+  def log_message(self, *args):
+    pass
+
+
 class TestUploader(UploaderTestCase):
   def setup_method(self):
     super().setup_method()
@@ -163,6 +199,104 @@ class TestUploader(UploaderTestCase):
       uploaded = UPLOAD_ATTR_NAME in os.listxattr(fn) and os.getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
       assert not uploaded, "File upload when locked"
 
+  def test_upload_files_added_while_running(self):
+    self.start_thread()
+
+    time.sleep(0.25)
+    f_paths = self.gen_files(lock=True, boot=False)
+    time.sleep(0.25)
+    assert len(log_handler.upload_order) == 0, "File uploaded while locked"
+
+    # segment closed
+    for f_path in f_paths:
+      f_path.with_suffix(f_path.suffix + ".lock").unlink()
+    time.sleep(1)
+    self.join_thread()
+
+    assert log_handler.upload_order == self.gen_order([self.seg_num], [], boot=False), "Files not uploaded after unlock"
+
+  def test_upload_in_parallel(self):
+    uploader.UPLOAD_WORKERS = 3
+    seg_nums = [0, 1, 2, 10, 20]
+    for i in seg_nums:
+      self.seg_dir = self.seg_format.format(i)
+      self.gen_files(boot=False)
+
+    self.start_thread()
+    time.sleep(1)
+    self.join_thread()
+
+    exp_order = self.gen_order(seg_nums, [], boot=False)
+    assert sorted(log_handler.upload_order) == sorted(exp_order), "Files not uploaded exactly once"
+
+  def test_index_falls_back_to_rescanning(self, mocker):
+    index = uploader.UploadIndex(Paths.log_root(), [], {"qlog": 0, "qlog.zst": 0})
+    index.scan()
+    if index.inotify is None:
+      pytest.skip("inotify isn't available")
+    try:
+      # e.g. out of watches, the new route directory is still picked up
+      mocker.patch.object(index.inotify, "add_watch", side_effect=OSError(28, "No space left on device"))
+      f_path = self.make_file_with_data(self.seg_dir, "qlog", 1)
+      index.update()
+      assert index.inotify is None
+      assert str(f_path) in index.files
+    finally:
+      index.close()
+
+  def upload_to_server(self, mocker, chunked_rejection: tuple[int, bytes] | None = None, retry_chunked: bool = False) -> list[tuple[bytes, bool]]:
+    f_path = self.make_file_with_data(self.seg_dir, "qlog", 1)
+    UploadRequestHandler.CHUNKED_REJECTION = chunked_rejection
+    UploadRequestHandler.bodies = []
+    with http_server_context(handler=UploadRequestHandler) as (host, port):
+      class LocalApi:
+        def __init__(self, dongle_id):
+          pass
+
+        def get(self, *args, **kwargs):
+          return MockResponse(json.dumps({"url": f"http://{host}:{port}/qlog.zst", "headers": {}}), 200)
+
+        def get_token(self):
+          return "fake-token"
+
+      mocker.patch.object(uploader, "Api", LocalApi)
+      mocker.patch.object(uploader, "fake_upload", False)
+      up = Uploader("0000000000000000", Paths.log_root())
+      try:
+        assert up.upload("qlog", f"{self.seg_dir}/qlog.zst", str(f_path), 1, False)
+        if retry_chunked:
+          # not chunked again until CHUNKED_RETRY_INTERVAL is up
+          assert up.upload("qlog", f"{self.seg_dir}/qlog.zst", str(f_path), 1, False)
+          up.chunked_retry_time -= uploader.CHUNKED_RETRY_INTERVAL
+          UploadRequestHandler.CHUNKED_REJECTION = None
+          assert up.upload("qlog", f"{self.seg_dir}/qlog.zst", str(f_path), 1, False)
+      finally:
+        up.close()
+
+    for body, _ in UploadRequestHandler.bodies:
+      assert zstd.ZstdDecompressor().decompressobj().decompress(body) == f_path.read_bytes()
+    return UploadRequestHandler.bodies
+
+  def test_upload_compressed_streaming(self, mocker):
+    bodies = self.upload_to_server(mocker)
+    assert [chunked for _, chunked in bodies] == [True]
+
+  @pytest.mark.parametrize("rejection", [(411, b""), (501, b""), (400, b"<Code>MissingContentLengthHeader</Code>")])
+  def test_upload_compressed_chunked_unsupported(self, mocker, rejection):
+    bodies = self.upload_to_server(mocker, rejection)
+    assert [chunked for _, chunked in bodies] == [False]
+
+  def test_upload_compressed_chunked_retried(self, mocker):
+    bodies = self.upload_to_server(mocker, (411, b""), retry_chunked=True)
+    assert [chunked for _, chunked in bodies] == [False, False, True]
+
+  def test_chunked_unsupported(self):
+    assert uploader.chunked_unsupported(MockResponse("", 411))
+    assert uploader.chunked_unsupported(MockResponse("<Code>MissingContentLengthHeader</Code>", 400))
+    # a 400 for anything else is about the upload, not how it was sent
+    assert not uploader.chunked_unsupported(MockResponse("<Code>InvalidHeaderValue</Code>", 400))
+    assert not uploader.chunked_unsupported(MockResponse("", 403))
+
   def test_no_upload_with_xattr(self):
     self.gen_files(lock=False, xattr=UPLOAD_ATTR_VALUE)
 
@@ -1,18 +1,22 @@
 #!/usr/bin/env python3
 import json
 import os
+import heapq
 import random
 import requests
 import threading
 import time
 import traceback
 import datetime
-from collections.abc import Iterator
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import NamedTuple
 
 from cereal import log
 import cereal.messaging as messaging
 from openpilot.common.api import Api
-from openpilot.common.file_helpers import get_upload_stream
+from openpilot.common.file_helpers import get_compressed_upload_chunks, get_upload_stream
+from openpilot.common.inotify import Inotify, IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_DELETE_SELF, IN_IGNORED, IN_ISDIR, \
+                                      IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW
 from openpilot.common.params import Params
 from openpilot.common.realtime import set_core_affinity
 from openpilot.system.hardware.hw import Paths
@@ -29,6 +33,27 @@ MAX_UPLOAD_SIZES = {
   "qcam": 5*1e6,
 }
 
+UPLOAD_WORKERS = int(os.getenv("UPLOADER_WORKERS", "3"))
+
+# bytes/s all uploads together may use, by network type. no cap on wifi and ethernet
+MAX_UPLOAD_RATES = {
+  NetworkType.cell2G: 16e3,
+  NetworkType.cell3G: 128e3,
+  NetworkType.cell4G: 1e6,
+  NetworkType.cell5G: 2.5e6,
+}
+
+# how servers that need a Content-Length reject chunked uploads, a 400 only counts if it says so
+CHUNKED_UNSUPPORTED_STATUS = (411, 501)
+# chunked uploads are tried again this long after they were turned down
+CHUNKED_RETRY_INTERVAL = 3600.
+
+# without inotify, the log root is rescanned this often
+RESCAN_INTERVAL = 60.
+
+ROOT_EVENTS = IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_ONLYDIR
+LOGDIR_EVENTS = IN_CLOSE_WRITE | IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM | IN_DELETE_SELF | IN_ONLYDIR
+
 allow_sleep = bool(os.getenv("UPLOADER_SLEEP", "1"))
 force_wifi = os.getenv("FORCEWIFI") is not None
 fake_upload = os.getenv("FAKEUPLOAD") is not None
@@ -45,6 +70,73 @@ class FakeResponse:
     self.request = FakeRequest()
 
 
+class RateLimiter:
+  """Token bucket shared by all uploads, so together they stay under rate bytes/s. No limit while rate is None"""
+  def __init__(self):
+    self.rate: float | None = None
+    self.tokens = 0.
+    self.last = time.monotonic()
+    self.lock = threading.Lock()
+
+  def consume(self, n: int) -> None:
+    with self.lock:
+      now = time.monotonic()
+      if self.rate is None:
+        self.tokens, self.last = 0., now
+        return
+      # allow bursts of up to a second
+      self.tokens = min(self.tokens + (now - self.last) * self.rate, self.rate) - n
+      self.last = now
+      wait = -self.tokens / self.rate
+    if wait > 0:
+      time.sleep(wait)
+
+
+class UploadStats:
+  def __init__(self):
+    self.start_time = time.monotonic()
+    self.first_byte_time: float | None = None
+    self.bytes_sent = 0
+
+  def sent(self, n: int) -> None:
+    if self.first_byte_time is None:
+      self.first_byte_time = time.monotonic()
+    self.bytes_sent += n
+
+
+def chunked_unsupported(response) -> bool:
+  if response.status_code in CHUNKED_UNSUPPORTED_STATUS:
+    return True
+  # e.g. Azure's MissingContentLengthHeader, other 400s are about the upload itself
+  return response.status_code == 400 and "contentlength" in response.text.lower().replace("-", "")
+
+
+class ThrottledReader:
+  """File to upload with a known length, read at the rate limiter's pace"""
+  def __init__(self, f, size: int, rate_limiter: RateLimiter, stats: UploadStats):
+    self.f = f
+    self.size = size
+    self.rate_limiter = rate_limiter
+    self.stats = stats
+
+  def __len__(self) -> int:
+    return self.size
+
+  def read(self, size: int = -1) -> bytes:
+    dat: bytes = self.f.read(size)
+    if dat:
+      self.rate_limiter.consume(len(dat))
+      self.stats.sent(len(dat))
+    return dat
+
+
+def throttled_chunks(chunks, rate_limiter: RateLimiter, stats: UploadStats):
+  for chunk in chunks:
+    rate_limiter.consume(len(chunk))
+    stats.sent(len(chunk))
+    yield chunk
+
+
 def get_directory_sort(d: str) -> list[str]:
   # ensure old format is sorted sooner
   o = ["0", ] if d.startswith("2024-") else ["1", ]
@@ -73,6 +165,209 @@ def clear_locks(root: str) -> None:
       cloudlog.exception("clear_locks failed")
 
 
+class UploadFile(NamedTuple):
+  sort_key: tuple
+  name: str
+  key: str
+  fn: str
+  logdir: str
+  ctime: float
+
+
+class UploadIndex:
+  """
+    Files in the log root that are waiting to be uploaded, in upload order. The log root is listed once, then kept
+    up to date from inotify events, or rescanned every RESCAN_INTERVAL seconds where inotify isn't available.
+    Directories with a lock file are left out until the lock is removed.
+  """
+  def __init__(self, root: str, immediate_folders: list[str], immediate_priority: dict[str, int]):
+    self.root = root
+    self.immediate_folders = immediate_folders
+    self.immediate_priority = immediate_priority
+
+    # files being uploaded right now, which aren't handed out again
+    self.busy: set[str] = set()
+
+    self.inotify: Inotify | None = None
+    self.last_scan = float('-inf')
+    self._reset()
+
+  def _reset(self) -> None:
+    self.files: dict[str, UploadFile] = {}
+    self.logdirs: dict[str, set[str]] = {}
+    self.locked: set[str] = set()
+    self.watches: dict[int, str] = {}
+    # files in immediate folders, qlogs, and qcameras overall and by route. Removed files stay in these until they come up
+    self.immediate: list[UploadFile] = []
+    self.qlogs: list[UploadFile] = []
+    self.qcameras: list[UploadFile] = []
+    self.qcameras_by_route: dict[str, list[UploadFile]] = {}
+
+  def close(self) -> None:
+    if self.inotify is not None:
+      self.inotify.close()
+      self.inotify = None
+
+  def _add_file(self, logdir: str, name: str) -> None:
+    key = os.path.join(logdir, name)
+    fn = os.path.join(self.root, key)
+    # skip files already uploaded
+    try:
+      ctime = os.path.getctime(fn)
+      is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
+    except OSError:
+      cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
+      # deleter could have deleted, so skip
+      return
+    if is_uploaded:
+      return
+
+    f = UploadFile((get_directory_sort(logdir), self.immediate_priority.get(name, 1000), name), name, key, fn, logdir, ctime)
+    if any(folder in fn for folder in self.immediate_folders):
+      heapq.heappush(self.immediate, f)
+    elif name == "qcamera.ts":
+      heapq.heappush(self.qcameras, f)
+      heapq.heappush(self.qcameras_by_route.setdefault(logdir.rsplit('--', 1)[0], []), f)
+    elif name in self.immediate_priority:
+      heapq.heappush(self.qlogs, f)
+    else:
+      # only uploaded on request, through athena
+      return
+    self.files[fn] = f
+    self.logdirs.setdefault(logdir, set()).add(fn)
+
+  def remove(self, fn: str) -> None:
+    f = self.files.pop(fn, None)
+    if f is not None:
+      self.logdirs[f.logdir].discard(fn)
+
+  def _remove_logdir(self, logdir: str) -> None:
+    self.locked.discard(logdir)
+    for fn in self.logdirs.pop(logdir, set()):
+      del self.files[fn]
+
+  def _scan_logdir(self, logdir: str) -> None:
+    self._remove_logdir(logdir)
+    try:
+      names = os.listdir(os.path.join(self.root, logdir))
+    except OSError:
+      return
+
+    if any(name.endswith(".lock") for name in names):
+      self.locked.add(logdir)
+      return
+
+    for name in names:
+      self._add_file(logdir, name)
+
+  def _watch_logdir(self, logdir: str) -> bool:
+    """Whether changes are still watched for, False once this falls back to rescanning"""
+    if self.inotify is None:
+      return False
+    try:
+      self.watches[self.inotify.add_watch(os.path.join(self.root, logdir), LOGDIR_EVENTS)] = logdir
+    except FileNotFoundError:
+      pass
+    except OSError:
+      # e.g. out of watches
+      cloudlog.exception("uploader_inotify_watch_failed")
+      self.close()
+      return False
+    return True
+
+  def scan(self) -> None:
+    self.close()
+    self._reset()
+    self.last_scan = time.monotonic()
+    try:
+      self.inotify = Inotify()
+      self.watches[self.inotify.add_watch(self.root, ROOT_EVENTS)] = ""
+    except OSError:
+      self.close()
+
+    for logdir in listdir_by_creation(self.root):
+      self._watch_logdir(logdir)
+      self._scan_logdir(logdir)
+
+  def update(self) -> None:
+    if self.inotify is None:
+      if time.monotonic() - self.last_scan > RESCAN_INTERVAL:
+        self.scan()
+      return
+
+    for event in self.inotify.read():
+      if event.mask & IN_Q_OVERFLOW:
+        self.scan()
+        return
+
+      logdir = self.watches.get(event.wd)
+      if event.mask & IN_IGNORED:
+        self.watches.pop(event.wd, None)
+      elif logdir is None:
+        continue
+      elif logdir == "":
+        # route directory created or deleted in the log root
+        if event.mask & IN_ISDIR and event.mask & (IN_CREATE | IN_MOVED_TO):
+          watched = self._watch_logdir(event.name)
+          self._scan_logdir(event.name)
+          if not watched:
+            # fell back to rescanning
+            return
+        elif event.mask & IN_ISDIR and event.mask & (IN_DELETE | IN_MOVED_FROM):
+          self._remove_logdir(event.name)
+      elif event.mask & IN_DELETE_SELF:
+        self._remove_logdir(logdir)
+      elif event.name.endswith(".lock"):
+        if event.mask & (IN_CREATE | IN_MOVED_TO | IN_DELETE | IN_MOVED_FROM):
+          self._scan_logdir(logdir)
+      elif event.mask & (IN_DELETE | IN_MOVED_FROM):
+        self.remove(os.path.join(self.root, logdir, event.name))
+      elif event.mask & (IN_CLOSE_WRITE | IN_MOVED_TO) and logdir not in self.locked:
+        self._add_file(logdir, event.name)
+
+  def _first(self, heap: list[UploadFile], ok=None) -> UploadFile | None:
+    """First file in heap that's still waiting to be uploaded and ok, dropping removed files on the way"""
+    skipped = []
+    try:
+      while heap:
+        f = heap[0]
+        if self.files.get(f.fn) is not f:
+          heapq.heappop(heap)
+        elif not os.path.exists(f.fn):
+          heapq.heappop(heap)
+          self.remove(f.fn)
+        elif f.fn not in self.busy and (ok is None or ok(f)):
+          return f
+        else:
+          skipped.append(heapq.heappop(heap))
+      return None
+    finally:
+      for f in skipped:
+        heapq.heappush(heap, f)
+
+  def next(self, metered: bool, requested_routes: list[str]) -> UploadFile | None:
+    # limit uploading on metered connections
+    def immediate_ok(f: UploadFile) -> bool:
+      dt = datetime.timedelta(hours=12)
+      return not (f.logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(f.ctime)) < dt)
+
+    f = self._first(self.immediate, immediate_ok if metered else None)
+    if f is not None:
+      return f
+
+    candidates = [self._first(self.qlogs)]
+    if not metered:
+      candidates.append(self._first(self.qcameras))
+    else:
+      # only qcameras of routes that were looked at recently
+      for r in requested_routes:
+        prefix = r.split('|')[-1]
+        for route, heap in self.qcameras_by_route.items():
+          if route.startswith(prefix) or prefix.startswith(route):
+            candidates.append(self._first(heap, lambda f, prefix=prefix: f.logdir.startswith(prefix)))
+    return min((c for c in candidates if c is not None), default=None)
+
+
 class Uploader:
   def __init__(self, dongle_id: str, root: str):
     self.dongle_id = dongle_id
@@ -86,60 +381,30 @@ class Uploader:
 
     self.immediate_folders = ["crash/", "boot/"]
     self.immediate_priority = {"qlog": 0, "qlog.zst": 0, "qcamera.ts": 1}
+    self.index = UploadIndex(root, self.immediate_folders, self.immediate_priority)
 
-  def list_upload_files(self, metered: bool) -> Iterator[tuple[str, str, str]]:
-    r = self.params.get("AthenadRecentlyViewedRoutes")
-    requested_routes = [] if r is None else [route for route in r.split(",") if route]
+    # independent files are uploaded in parallel, sharing the bandwidth cap of the current network
+    self.workers = UPLOAD_WORKERS
+    self.pool = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix="uploader")
+    self.in_flight: dict[str, Future] = {}
+    self.rate_limiter = RateLimiter()
+    # compressed files are streamed with chunked transfer encoding, unless the server recently turned that down
+    self.chunked_retry_time = float('-inf')
 
-    for logdir in listdir_by_creation(self.root):
-      path = os.path.join(self.root, logdir)
-      try:
-        names = os.listdir(path)
-      except OSError:
-        continue
-
-      if any(name.endswith(".lock") for name in names):
-        continue
-
-      for name in sorted(names, key=lambda n: self.immediate_priority.get(n, 1000)):
-        key = os.path.join(logdir, name)
-        fn = os.path.join(path, name)
-        # skip files already uploaded
-        try:
-          ctime = os.path.getctime(fn)
-          is_uploaded = getxattr(fn, UPLOAD_ATTR_NAME) == UPLOAD_ATTR_VALUE
-        except OSError:
-          cloudlog.event("uploader_getxattr_failed", key=key, fn=fn)
-          # deleter could have deleted, so skip
-          continue
-        if is_uploaded:
-          continue
-
-        # limit uploading on metered connections
-        if metered:
-          dt = datetime.timedelta(hours=12)
-          if logdir in self.immediate_folders and (datetime.datetime.now() - datetime.datetime.fromtimestamp(ctime)) < dt:
-            continue
-
-          if name == "qcamera.ts" and not any(logdir.startswith(r.split('|')[-1]) for r in requested_routes):
-            continue
-
-        yield name, key, fn
+  def close(self) -> None:
+    self.pool.shutdown(wait=True)
+    self.index.close()
 
   def next_file_to_upload(self, metered: bool) -> tuple[str, str, str] | None:
-    upload_files = list(self.list_upload_files(metered))
-
-    for name, key, fn in upload_files:
-      if any(f in fn for f in self.immediate_folders):
-        return name, key, fn
-
-    for name, key, fn in upload_files:
-      if name in self.immediate_priority:
-        return name, key, fn
+    r = self.params.get("AthenadRecentlyViewedRoutes")
+    requested_routes = [] if r is None else [route for route in r.split(",") if route]
 
-    return None
+    self.index.update()
+    self.index.busy = set(self.in_flight)
+    f = self.index.next(metered, requested_routes)
+    return None if f is None else (f.name, f.key, f.fn)
 
-  def do_upload(self, key: str, fn: str):
+  def do_upload(self, key: str, fn: str, stats: UploadStats | None = None):
     url_resp = self.api.get("v1.4/" + self.dongle_id + "/upload_url/", timeout=10, path=key, access_token=self.api.get_token())
     if url_resp.status_code == 412:
       return url_resp
@@ -152,11 +417,22 @@ class Uploader:
     if fake_upload:
       return FakeResponse()
 
+    if stats is None:
+      stats = UploadStats()
+    compress = key.endswith('.zst') and not fn.endswith('.zst')
+    if compress and time.monotonic() >= self.chunked_retry_time:
+      chunks = throttled_chunks(get_compressed_upload_chunks(fn), self.rate_limiter, stats)
+      response = requests.put(url, data=chunks, headers=headers, timeout=10)
+      if not chunked_unsupported(response):
+        return response
+      cloudlog.event("uploader_chunked_unsupported", key=key, status_code=response.status_code)
+      self.chunked_retry_time = time.monotonic() + CHUNKED_RETRY_INTERVAL
+      stats.bytes_sent, stats.first_byte_time = 0, None
+
     stream = None
     try:
-      compress = key.endswith('.zst') and not fn.endswith('.zst')
-      stream, _ = get_upload_stream(fn, compress)
-      response = requests.put(url, data=stream, headers=headers, timeout=10)
+      stream, size = get_upload_stream(fn, compress)
+      response = requests.put(url, data=ThrottledReader(stream, size, self.rate_limiter, stats), headers=headers, timeout=10)
       return response
     finally:
       if stream:
@@ -178,25 +454,28 @@ class Uploader:
       cloudlog.event("uploader_too_large", key=key, fn=fn, sz=sz)
       success = True
     else:
-      start_time = time.monotonic()
+      stats = UploadStats()
 
       stat = None
       last_exc = None
       try:
-        stat = self.do_upload(key, fn)
+        stat = self.do_upload(key, fn, stats)
       except Exception as e:
         last_exc = (e, traceback.format_exc())
 
       if stat is not None and stat.status_code in (200, 201, 401, 403, 412):
         self.last_filename = fn
-        dt = time.monotonic() - start_time
+        dt = time.monotonic() - stats.start_time
         if stat.status_code == 412:
           cloudlog.event("upload_ignored", key=key, fn=fn, sz=sz, network_type=network_type, metered=metered)
         else:
-          content_length = int(stat.request.headers.get("Content-Length", 0))
+          content_length = stats.bytes_sent or int(stat.request.headers.get("Content-Length", 0))
           speed = (content_length / 1e6) / dt
+          # time from asking for the upload url until the first byte of the file was sent
+          latency = None if stats.first_byte_time is None else stats.first_byte_time - stats.start_time
           cloudlog.event("upload_success", key=key, fn=fn, sz=sz, content_length=content_length,
-                         network_type=network_type, metered=metered, speed=speed)
+                         network_type=network_type, metered=metered, speed=speed, dt=dt, latency=latency,
+                         in_flight=len(self.in_flight), rate_cap=self.rate_limiter.rate)
         success = True
       else:
         success = False
@@ -213,17 +492,41 @@ class Uploader:
 
 
   def step(self, network_type: int, metered: bool) -> bool | None:
-    d = self.next_file_to_upload(metered)
-    if d is None:
-      return None
+    """
+      Collects finished uploads and starts new ones while there are free workers. None if there's nothing to
+      upload, False if an upload failed, in which case nothing new is started.
+    """
+    self.rate_limiter.rate = MAX_UPLOAD_RATES.get(network_type)
+
+    results = []
+    for fn, fut in list(self.in_flight.items()):
+      if fut.done():
+        del self.in_flight[fn]
+        success = fut.exception() is None and fut.result()
+        if success:
+          self.index.remove(fn)
+        results.append(success)
+
+    # back off before retrying
+    if not all(results):
+      return False
 
-    name, key, fn = d
+    while len(self.in_flight) < self.workers:
+      d = self.next_file_to_upload(metered)
+      if d is None:
+        break
 
-    # qlogs and bootlogs need to be compressed before uploading
-    if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
-      key += ".zst"
+      name, key, fn = d
 
-    return self.upload(name, key, fn, network_type, metered)
+      # qlogs and bootlogs need to be compressed before uploading
+      if key.endswith(('qlog', 'rlog')) or (key.startswith('boot/') and not key.endswith('.zst')):
+        key += ".zst"
+
+      self.in_flight[fn] = self.pool.submit(self.upload, name, key, fn, network_type, metered)
+
+    if not results and not self.in_flight:
+      return None
+    return True
 
 
 def main(exit_event: threading.Event = None) -> None:
@@ -248,25 +551,28 @@ def main(exit_event: threading.Event = None) -> None:
   uploader = Uploader(dongle_id, Paths.log_root())
 
   backoff = 0.1
-  while not exit_event.is_set():
-    sm.update(0)
-    offroad = params.get_bool("IsOffroad")
-    network_type = sm['deviceState'].networkType if not force_wifi else NetworkType.wifi
-    if network_type == NetworkType.none:
+  try:
+    while not exit_event.is_set():
+      sm.update(0)
+      offroad = params.get_bool("IsOffroad")
+      network_type = sm['deviceState'].networkType if not force_wifi else NetworkType.wifi
+      if network_type == NetworkType.none:
+        if allow_sleep:
+          time.sleep(60 if offroad else 5)
+        continue
+
+      success = uploader.step(sm['deviceState'].networkType.raw, sm['deviceState'].networkMetered)
+      if success is None:
+        backoff = 60 if offroad else 5
+      elif success:
+        backoff = 0.1
+      else:
+        cloudlog.info("upload backoff %r", backoff)
+        backoff = min(backoff*2, 120)
       if allow_sleep:
-        time.sleep(60 if offroad else 5)
-      continue
-
-    success = uploader.step(sm['deviceState'].networkType.raw, sm['deviceState'].networkMetered)
-    if success is None:
-      backoff = 60 if offroad else 5
-    elif success:
-      backoff = 0.1
-    else:
-      cloudlog.info("upload backoff %r", backoff)
-      backoff = min(backoff*2, 120)
-    if allow_sleep:
-      time.sleep(backoff + random.uniform(0, backoff))
+        time.sleep(backoff + random.uniform(0, backoff))
+  finally:
+    uploader.close()
 
 
 if __name__ == "__main__":
@@ -1,19 +1,30 @@
 import os
 import subprocess
 import json
+import threading
 from collections.abc import Iterator
 from collections import OrderedDict
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BufferedReader
 
 import numpy as np
+from openpilot.common.file_helpers import atomic_write_in_dir
+from openpilot.system.hardware.hw import Paths
 from openpilot.tools.lib.filereader import FileReader, resolve_name
+from openpilot.tools.lib.url_file import URLFile, hash_256
 from openpilot.tools.lib.exceptions import DataUnreadableError
-from openpilot.tools.lib.vidindex import hevc_index
+from openpilot.tools.lib.vidindex import VideoFileInvalid, hevc_dimensions, hevc_index
 
 
 HEVC_SLICE_B = 0
 HEVC_SLICE_P = 1
 HEVC_SLICE_I = 2
 
+VIDEO_INDEX_VERSION = 1
+
+# opt in to a bigger budget for decoded GOPs than the cache_size frames of FrameReaders that aren't given one
+DEFAULT_CACHE_BYTES = int(os.environ["FRAMEREADER_CACHE_MB"]) * 1024 * 1024 if "FRAMEREADER_CACHE_MB" in os.environ else None
+
 
 class LRUCache:
   def __init__(self, capacity: int):
@@ -33,6 +44,33 @@ class LRUCache:
     return key in self._cache
 
 
+class GOPCache:
+  """LRU of decoded GOPs, by GOP start frame, bounded by the bytes their frames take up"""
+  def __init__(self, capacity_bytes: int, min_gops: int = 1):
+    self._cache: OrderedDict[int, np.ndarray] = OrderedDict()
+    self.capacity_bytes = capacity_bytes
+    self.min_gops = min_gops
+    self.nbytes = 0
+
+  def get(self, gop: int) -> np.ndarray | None:
+    if gop not in self._cache:
+      return None
+    self._cache.move_to_end(gop)
+    return self._cache[gop]
+
+  def put(self, gop: int, frames: np.ndarray) -> None:
+    if gop in self._cache:
+      self.nbytes -= self._cache.pop(gop).nbytes
+    self._cache[gop] = frames
+    self.nbytes += frames.nbytes
+    # always keep the newest min_gops GOPs, even if they alone are over budget
+    while self.nbytes > self.capacity_bytes and len(self._cache) > self.min_gops:
+      self.nbytes -= self._cache.popitem(last=False)[1].nbytes
+
+  def __contains__(self, gop: int) -> bool:
+    return gop in self._cache
+
+
 def assert_hvec(fn: str) -> None:
   with FileReader(fn) as f:
     header = f.read(4)
@@ -84,20 +122,52 @@ def get_index_data(fn: str, index_data: dict|None = None):
     index_data = get_video_index(fn)
     if index_data is None:
       raise DataUnreadableError(f"Failed to index {fn!r}")
-  stream = index_data["probe"]["streams"][0]
-  return index_data["index"], index_data["global_prefix"], stream["width"], stream["height"]
+  if "probe" in index_data:
+    stream = index_data["probe"]["streams"][0]
+    return index_data["index"], index_data["global_prefix"], stream["width"], stream["height"]
+  return index_data["index"], index_data["global_prefix"], index_data["width"], index_data["height"]
+
+def _video_index_cache_path(fn: str) -> str:
+  key = fn
+  if os.path.isfile(fn):
+    # local files can be rewritten in place, uploaded ones can't
+    st = os.stat(fn)
+    key = f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+  return os.path.join(Paths.download_cache_root(), f"vidindex_v{VIDEO_INDEX_VERSION}_{hash_256(key)}.npz")
+
+def get_video_index(fn, cache: bool = True):
+  """The video's frame index, parameter sets and size, built on first use and cached next to the download cache"""
+  path = _video_index_cache_path(resolve_name(fn))
+  if cache and os.path.isfile(path):
+    with np.load(path) as dat:
+      return {
+        'index': dat['index'],
+        'global_prefix': dat['global_prefix'].tobytes(),
+        'width': int(dat['width']),
+        'height': int(dat['height']),
+      }
 
-def get_video_index(fn):
   assert_hvec(fn)
   frame_types, dat_len, prefix = hevc_index(fn)
   index = np.array(frame_types + [(0xFFFFFFFF, dat_len)], dtype=np.uint32)
-  probe = ffprobe(fn, "hevc")
-  return {
+  try:
+    width, height = hevc_dimensions(prefix)
+  except (VideoFileInvalid, IndexError):
+    stream = ffprobe(fn, "hevc")["streams"][0]
+    width, height = stream["width"], stream["height"]
+  index_data = {
     'index': index,
     'global_prefix': prefix,
-    'probe': probe
+    'width': width,
+    'height': height,
   }
 
+  if cache:
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+      np.savez(f, index=index, global_prefix=np.frombuffer(prefix, dtype=np.uint8), width=width, height=height)
+  return index_data
+
 
 class FfmpegDecoder:
   def __init__(self, fn: str, index_data: dict|None = None,
@@ -107,6 +177,29 @@ class FfmpegDecoder:
     self.frame_count = len(self.index) - 1          # sentinel row at the end
     self.iframes = np.where(self.index[:, 0] == HEVC_SLICE_I)[0]
     self.pix_fmt = pix_fmt
+    self.frame_bytes = self.h * self.w * 3 if pix_fmt == "rgb24" else self.h * self.w * 3 // 2
+
+    # kept open for the decoder's lifetime, so GOPs aren't reopened (and for URLs, reconnected) one by one
+    self._f: URLFile | BufferedReader | None = None
+    self._f_lock = threading.Lock()
+
+  def __getstate__(self):
+    state = self.__dict__.copy()
+    state['_f'] = None
+    del state['_f_lock']
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._f_lock = threading.Lock()
+
+  def _read(self, off_b: int, off_e: int) -> bytes:
+    with self._f_lock:
+      if self._f is None:
+        self._f = FileReader(self.fn)
+      self._f.seek(off_b)
+      dat = self._f.read(off_e - off_b)
+    return bytes(self.prefix) + dat
 
   def _gop_bounds(self, frame_idx: int):
     f_b = frame_idx
@@ -123,15 +216,25 @@ class FfmpegDecoder:
   def get_gop_start(self, frame_idx: int):
     return self.iframes[np.searchsorted(self.iframes, frame_idx, side="right") - 1]
 
+  def get_next_gop_start(self, frame_idx: int) -> int | None:
+    i = np.searchsorted(self.iframes, frame_idx, side="right")
+    return int(self.iframes[i]) if i < len(self.iframes) else None
+
+  def decode_gop(self, gop: int) -> np.ndarray:
+    """All frames of the GOP starting at frame gop, in one array"""
+    f_b, f_e, off_b, off_e = self._gop_bounds(gop)
+    frames = decompress_video_data(self._read(off_b, off_e), self.w, self.h, self.pix_fmt)
+    if len(frames) != f_e - f_b:
+      raise DataUnreadableError(f"{self.fn}: decoded {len(frames)} frames from GOP at {f_b}, expected {f_e - f_b}")
+    return frames
+
   def get_iterator(self, start_fidx: int = 0, end_fidx: int|None = None,
                    frame_skip: int = 1) -> Iterator[tuple[int, np.ndarray]]:
     end_fidx = end_fidx or self.frame_count
     fidx = start_fidx
     while fidx < end_fidx:
       f_b, f_e, off_b, off_e = self._gop_bounds(fidx)
-      with FileReader(self.fn) as f:
-        f.seek(off_b)
-        raw = self.prefix + f.read(off_e - off_b)
+      raw = self._read(off_b, off_e)
       # number of frames to discard inside this GOP before the wanted one
       for i, frm in enumerate(decompress_video_data(raw, self.w, self.h, self.pix_fmt)):
         fidx = f_b + i
@@ -150,24 +253,112 @@ def FrameIterator(fn: str, index_data: dict|None=None,
 
 class FrameReader:
   def __init__(self, fn: str, index_data: dict|None = None,
-               cache_size: int = 30, pix_fmt: str = "rgb24"):
+               cache_size: int = 30, pix_fmt: str = "rgb24",
+               cache_bytes: int|None = None, readahead: bool = True, decode_threads: int = 2):
+    """
+      Decodes whole GOPs and keeps them in an LRU bounded by cache_bytes, which defaults to enough for
+      cache_size frames, or FRAMEREADER_CACHE_MB if it's set. With readahead, the GOP after the one
+      being read is decoded in the background, on one of decode_threads threads.
+    """
     self.decoder = FfmpegDecoder(fn, index_data, pix_fmt)
     self.iframes = self.decoder.iframes
-    self._cache: LRUCache = LRUCache(cache_size)
     self.w, self.h, self.frame_count, = self.decoder.w, self.decoder.h, self.decoder.frame_count
     self.pix_fmt = pix_fmt
 
-    self.it: Iterator[tuple[int, np.ndarray]] | None = None
-    self.fidx = -1
+    if cache_bytes is None:
+      cache_bytes = cache_size * self.decoder.frame_bytes if DEFAULT_CACHE_BYTES is None else DEFAULT_CACHE_BYTES
+    # the GOP decoded ahead mustn't push out the one being read
+    self._cache = GOPCache(cache_bytes, min_gops=2 if readahead else 1)
+    self.readahead = readahead
+    self.decode_threads = decode_threads
+    self._init_decoding()
+
+  def _init_decoding(self):
+    self._lock = threading.Lock()
+    self._pending: dict[int, Future] = {}
+    self._pool: ThreadPoolExecutor | None = None
+
+  def __getstate__(self):
+    # decoded frames are kept, threads and in flight decodes aren't
+    state = self.__dict__.copy()
+    for k in ('_lock', '_pending', '_pool'):
+      del state[k]
+    return state
+
+  def __setstate__(self, state):
+    self.__dict__.update(state)
+    self._init_decoding()
+
+  def _decode(self, gop: int) -> np.ndarray:
+    # a failed decode isn't kept pending either, so the next get_gop tries again instead of re-raising
+    try:
+      frames = self.decoder.decode_gop(gop)
+      with self._lock:
+        self._cache.put(gop, frames)
+      return frames
+    finally:
+      with self._lock:
+        self._pending.pop(gop, None)
+
+  def _submit(self, gop: int) -> Future | None:
+    # must hold self._lock
+    if gop in self._cache:
+      return None
+    if gop not in self._pending:
+      if self._pool is None:
+        self._pool = ThreadPoolExecutor(max_workers=self.decode_threads, thread_name_prefix="framereader")
+      self._pending[gop] = self._pool.submit(self._decode, gop)
+    return self._pending[gop]
+
+  def get_gop(self, gop: int) -> np.ndarray:
+    with self._lock:
+      frames = self._cache.get(gop)
+      fut = self._submit(gop) if frames is None else None
+      if self.readahead:
+        next_gop = self.decoder.get_next_gop_start(gop)
+        if next_gop is not None:
+          self._submit(next_gop)
+    if fut is not None:
+      frames = fut.result()
+    assert frames is not None
+    return frames
 
   def get(self, fidx:int):
-    if fidx in self._cache:  # If frame is cached, return it
-      return self._cache[fidx]
-    read_start = self.decoder.get_gop_start(fidx)
-    if not self.it or fidx < self.fidx or read_start != self.decoder.get_gop_start(self.fidx):  # If the frame is in a different GOP, reset the iterator
-      self.it = self.decoder.get_iterator(read_start)
-      self.fidx = -1
-    while self.fidx < fidx:
-      self.fidx, frame = next(self.it)
-      self._cache[self.fidx] = frame
-    return self._cache[fidx]
+    gop = int(self.decoder.get_gop_start(fidx))
+    return self.get_gop(gop)[fidx - gop]
+
+
+class DiskCachedFrameReader(FrameReader):
+  def __init__(self, fn: str, cache_dir: str, index_data: dict|None = None, pix_fmt: str = "nv12"):
+    """
+      FrameReader that keeps every decoded frame in a file in cache_dir, memory mapped, so other readers of
+      the same video, in this or any other process, don't decode it again. The file is sparse and only
+      takes up space for the frames that were read. Frames are the same whoever decodes them, so readers
+      don't need to coordinate writes.
+    """
+    # a GOP is written to the file as soon as it's decoded, so only the one being copied is kept in memory
+    super().__init__(fn, index_data, pix_fmt=pix_fmt, cache_bytes=0, readahead=False)
+    frame_shape = (self.h, self.w, 3) if pix_fmt == "rgb24" else (self.h * self.w * 3 // 2,)
+    path = os.path.join(cache_dir, f"{hash_256(fn)}_{pix_fmt}")
+    os.makedirs(cache_dir, exist_ok=True)
+    self._frames = self._open(path, (self.frame_count, *frame_shape))
+    self._decoded = self._open(path + ".decoded", (self.frame_count,))
+
+  @staticmethod
+  def _open(path: str, shape: tuple[int, ...]) -> np.memmap:
+    fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+    try:
+      size = int(np.prod(shape))
+      if os.fstat(fd).st_size < size:
+        os.ftruncate(fd, size)
+    finally:
+      os.close(fd)
+    return np.memmap(path, dtype=np.uint8, mode="r+", shape=shape)
+
+  def get(self, fidx: int):
+    if not self._decoded[fidx]:
+      gop = int(self.decoder.get_gop_start(fidx))
+      frames = self.get_gop(gop)
+      self._frames[gop:gop + len(frames)] = frames
+      self._decoded[gop:gop + len(frames)] = 1
+    return self._frames[fidx]
@@ -1,4 +1,14 @@
 import numpy as np
+from operator import attrgetter
+
+from cereal import log as capnp_log
+
+# numpy dtype of each capnp type that msgs_to_columns can write into a column
+CAPNP_DTYPES = {
+  'bool': np.bool_, 'int8': np.int8, 'int16': np.int16, 'int32': np.int32, 'int64': np.int64,
+  'uint8': np.uint8, 'uint16': np.uint16, 'uint32': np.uint32, 'uint64': np.uint64,
+  'float32': np.float32, 'float64': np.float64, 'enum': np.uint16, 'text': object, 'data': object,
+}
 
 
 def flatten_type_dict(d, sep="/", prefix=None):
@@ -76,6 +86,101 @@ def msgs_to_time_series(msgs):
   return values
 
 
+
+def _field_getter(service, path):
+  """Getter, numpy dtype and whether it's a list for a "/" separated field of a service"""
+  if service not in capnp_log.Event.schema.union_fields:
+    raise ValueError(f"unknown service {service}")
+
+  schema = capnp_log.Event.schema.fields[service].schema
+  names = path.split("/")
+  for i, name in enumerate(names):
+    if name not in schema.fields:
+      raise ValueError(f"{service} has no field {path}")
+    field = schema.fields[name]
+    typ = field.proto.slot.type if field.proto.which() == 'slot' else None
+    if typ is None or typ.which() == 'struct':
+      if i == len(names) - 1:
+        raise ValueError(f"{service}/{path} is a struct, request its fields instead")
+      schema = field.schema
+    elif i < len(names) - 1:
+      raise ValueError(f"{service}/{'/'.join(names[:i + 1])} is not a struct")
+
+  is_list = typ.which() == 'list'
+  kind = typ.list.elementType.which() if is_list else typ.which()
+  if kind not in CAPNP_DTYPES:
+    raise ValueError(f"{service}/{path} is a {'list of ' if is_list else ''}{kind}, which can't be a column")
+
+  getter = attrgetter(".".join([service, *names]))
+  if kind == 'enum' and is_list:
+    def enum_list_getter(msg):
+      return [e.raw for e in getter(msg)]
+    return enum_list_getter, CAPNP_DTYPES[kind], is_list
+  elif kind == 'enum':
+    getter = attrgetter(".".join([service, *names, "raw"]))
+  return getter, CAPNP_DTYPES[kind], is_list
+
+
+class _ServiceColumns:
+  def __init__(self, service, paths, capacity):
+    self.service = service
+    self.fields = {path: _field_getter(service, path) for path in paths}
+    self.capacity = max(capacity, 1)
+    self.n = 0
+    # list columns are 2D, their width is only known from the first message
+    self.columns = {"t": np.empty(self.capacity, np.float64), "_valid": np.empty(self.capacity, np.bool_)}
+    for path, (_, dtype, is_list) in self.fields.items():
+      self.columns[path] = None if is_list else np.empty(self.capacity, dtype)
+
+  def _grow(self):
+    self.capacity *= 2
+    for name, col in self.columns.items():
+      if col is not None:
+        self.columns[name] = np.resize(col, (self.capacity, *col.shape[1:]))
+
+  def add(self, msg):
+    if self.n == self.capacity:
+      self._grow()
+
+    n = self.n
+    columns = self.columns
+    columns["t"][n] = msg.logMonoTime / 1.0e9
+    columns["_valid"][n] = msg.valid
+    for path, (getter, dtype, is_list) in self.fields.items():
+      value = getter(msg)
+      if is_list:
+        value = list(value)
+        col = columns[path]
+        if col is None:
+          col = columns[path] = np.empty((self.capacity, len(value)), dtype)
+        elif len(value) != col.shape[1]:
+          raise ValueError(f"{self.service}/{path} has lists of {col.shape[1]} and {len(value)} elements, only fixed size lists can be columns")
+        col[n] = value
+      else:
+        columns[path][n] = value
+    self.n += 1
+
+  def finish(self):
+    order = np.argsort(self.columns["t"][:self.n], kind="stable")
+    return {name: col[:self.n][order] for name, col in self.columns.items()}
+
+
+def msgs_to_columns(msgs, fields, counts=None):
+  """
+    Like msgs_to_time_series, but only for the requested fields of each service, {service: [field, ...]}.
+    Fields use the same "/" separated names, and are written into typed numpy arrays as messages are read
+    instead of going through dicts. Lists must be fixed size and become 2D arrays, enums are their raw values.
+    counts, the number of messages of each service if it's known, presizes the arrays.
+  """
+  counts = counts or {}
+  services = {service: _ServiceColumns(service, paths, counts.get(service, 1024)) for service, paths in fields.items()}
+  for msg in msgs:
+    columns = services.get(msg.which())
+    if columns is not None:
+      columns.add(msg)
+
+  return {service: columns.finish() for service, columns in services.items() if columns.n > 0}
+
 if __name__ == "__main__":
   import sys
   from openpilot.tools.lib.logreader import LogReader
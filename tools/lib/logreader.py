@@ -1,32 +1,51 @@
 #!/usr/bin/env python3
 import bz2
+import concurrent.futures
 from functools import partial
 import multiprocessing
 import capnp
 import enum
+import hashlib
+import io
+import itertools
+import json
+import numpy as np
 import os
 import pathlib
+import pickle
+import struct
 import sys
 import tqdm
 import urllib.parse
 import warnings
 import zstandard as zstd
 
+from collections import deque
 from collections.abc import Iterable, Iterator
-from typing import cast
+from dataclasses import dataclass, field
+from typing import IO, Any, cast
 from urllib.parse import parse_qs, urlparse
 
 from cereal import log as capnp_log
+from openpilot.common.file_helpers import atomic_write_in_dir
 from openpilot.common.swaglog import cloudlog
+from openpilot.system.hardware.hw import Paths
 from openpilot.tools.lib.filereader import FileReader
 from openpilot.tools.lib.file_sources import comma_api_source, internal_source, openpilotci_source, comma_car_segments_source, Source
 from openpilot.tools.lib.route import SegmentRange, FileName
-from openpilot.tools.lib.log_time_series import msgs_to_time_series
+from openpilot.tools.lib.log_time_series import msgs_to_columns, msgs_to_time_series
+from openpilot.tools.lib.url_file import hash_256
 
 LogMessage = type[capnp._DynamicStructReader]
 LogIterable = Iterable[LogMessage]
 RawLogIterable = Iterable[bytes]
 
+ZSTD_MAGIC = b'\x28\xB5\x2F\xFD'
+BZ2_MAGIC = b'BZh9'
+STREAM_CHUNK_SIZE = 256 * 1024  # bytes read and decompressed at a time when streaming
+LOG_INDEX_VERSION = 1  # bump when LogIndexEntry or how it's built changes
+LOG_COLUMNS_VERSION = 1  # bump when msgs_to_columns output changes
+
 
 def save_log(dest, log_msgs, compress=True):
   dat = b"".join(msg.as_builder().to_bytes() for msg in log_msgs)
@@ -40,7 +59,7 @@ def save_log(dest, log_msgs, compress=True):
     f.write(dat)
 
 
-def decompress_stream(data: bytes):
+def decompress_stream(data: bytes) -> bytes:
   dctx = zstd.ZstdDecompressor()
   decompressed_data = b""
 
@@ -87,26 +106,30 @@ class CachedEventReader:
     return getattr(self._evt, name)
 
 
+def decompress_log(dat: bytes, ext: str | None = None) -> bytes:
+  if ext == ".bz2" or dat.startswith(BZ2_MAGIC):
+    return bz2.decompress(dat)
+  elif ext == ".zst" or dat.startswith(ZSTD_MAGIC):
+    # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
+    return decompress_stream(dat)
+  return dat
+
+
+def read_log_bytes(fn: str) -> bytes:
+  """Downloads and decompresses a log, the bytes are what _LogFileReader takes as dat"""
+  with FileReader(fn) as f:
+    return decompress_log(f.read(), _get_ext(fn))
+
+
 class _LogFileReader:
   def __init__(self, fn, only_union_types=False, sort_by_time=False, dat=None):
     self.data_version = None
     self._only_union_types = only_union_types
 
-    ext = None
     if not dat:
-      _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
-      if ext not in ('', '.bz2', '.zst'):
-        # old rlogs weren't compressed
-        raise ValueError(f"unknown extension {ext}")
-
-      with FileReader(fn) as f:
-        dat = f.read()
-
-    if ext == ".bz2" or dat.startswith(b'BZh9'):
-      dat = bz2.decompress(dat)
-    elif ext == ".zst" or dat.startswith(b'\x28\xB5\x2F\xFD'):
-      # https://github.com/facebook/zstd/blob/dev/doc/zstd_compression_format.md#zstandard-frames
-      dat = decompress_stream(dat)
+      dat = read_log_bytes(fn)
+    else:
+      dat = decompress_log(dat)
 
     ents = capnp_log.Event.read_multiple_bytes(dat)
 
@@ -132,6 +155,254 @@ class _LogFileReader:
         yield ent
 
 
+def _get_ext(fn: str) -> str:
+  _, ext = os.path.splitext(urllib.parse.urlparse(fn).path)
+  if ext not in ('', '.bz2', '.zst'):
+    # old rlogs weren't compressed
+    raise ValueError(f"unknown extension {ext}")
+  return ext
+
+
+class _ChunkedReader(io.RawIOBase):
+  def __init__(self, f, chunk_size: int):
+    """Serves the small reads decompressors do from big sequential reads of f, so they don't each become a range request"""
+    super().__init__()
+    self._f = f
+    self._chunk_size = chunk_size
+    self._buf = b''
+    self._pos = 0
+
+  def _fill(self, n: int) -> None:
+    while len(self._buf) - self._pos < n:
+      chunk = self._f.read(self._chunk_size)
+      if not chunk:
+        break
+      self._buf = self._buf[self._pos:] + chunk
+      self._pos = 0
+
+  def readable(self) -> bool:
+    return True
+
+  def readinto(self, b) -> int:
+    ret = self.read(len(b))
+    b[:len(ret)] = ret
+    return len(ret)
+
+  def peek(self, n: int) -> bytes:
+    self._fill(n)
+    return self._buf[self._pos:self._pos + n]
+
+  def read(self, n: int = -1) -> bytes:
+    if n is None or n < 0:
+      ret: bytes = self._buf[self._pos:] + self._f.read()
+      self._buf, self._pos = b'', 0
+      return ret
+    self._fill(n)
+    ret = self._buf[self._pos:self._pos + n]
+    self._pos += len(ret)
+    return ret
+
+
+def stream_decompress(f, ext: str = '') -> Iterator[bytes]:
+  """Incrementally decompresses a bz2, zstd or uncompressed file object into chunks of at most STREAM_CHUNK_SIZE bytes"""
+  reader = _ChunkedReader(f, STREAM_CHUNK_SIZE)
+  head = reader.peek(len(ZSTD_MAGIC))
+  dec: bz2.BZ2File | zstd.ZstdDecompressionReader | _ChunkedReader
+  if ext == ".bz2" or head.startswith(BZ2_MAGIC):
+    dec = bz2.BZ2File(reader)
+  elif ext == ".zst" or head.startswith(ZSTD_MAGIC):
+    # the stubs only take typing.IO, which io.RawIOBase doesn't nominally implement
+    dec = zstd.ZstdDecompressor().stream_reader(cast(IO[bytes], reader), read_across_frames=True)
+  else:
+    dec = reader
+
+  while chunk := dec.read(STREAM_CHUNK_SIZE):
+    yield chunk
+
+
+def _message_sizes(buf) -> list[int]:
+  """Sizes of the complete capnp messages at the start of buf, from their segment tables"""
+  sizes = []
+  end = 0
+  while end + 4 <= len(buf):
+    num_segments = struct.unpack_from("<I", buf, end)[0] + 1
+    header_size = (4 + 4 * num_segments + 7) & ~7
+    if end + header_size > len(buf):
+      break
+    size = header_size + 8 * sum(struct.unpack_from(f"<{num_segments}I", buf, end + 4))
+    if end + size > len(buf):
+      break
+    sizes.append(size)
+    end += size
+  return sizes
+
+
+def frame_messages(chunks: Iterable[bytes]) -> Iterator[bytes]:
+  """Regroups a stream of concatenated capnp messages into chunks that hold only whole messages"""
+  buf = bytearray()
+  for chunk in chunks:
+    buf += chunk
+
+    end = sum(_message_sizes(buf))
+    if end > 0:
+      yield bytes(buf[:end])
+      del buf[:end]
+
+  # a truncated last message, let capnp report it
+  if buf:
+    yield bytes(buf)
+
+
+class _LogFileStreamReader:
+  def __init__(self, fn, only_union_types=False):
+    """Decompresses and decodes as it's iterated, memory is bounded by the chunk size and the largest message, not the file size"""
+    self._fn = fn
+    self._only_union_types = only_union_types
+    self._ext = _get_ext(fn)
+
+  def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
+    with FileReader(self._fn) as f:
+      for dat in frame_messages(stream_decompress(f, self._ext)):
+        try:
+          for e in capnp_log.Event.read_multiple_bytes(dat):
+            ent = CachedEventReader(e)
+            if self._only_union_types:
+              try:
+                ent.which()
+              except capnp.lib.capnp.KjException:
+                continue
+            yield ent
+        except capnp.KjException:
+          warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+          return
+
+
+@dataclass
+class LogIndexEntry:
+  # where each event of the type is in the decompressed log
+  offsets: list[int] = field(default_factory=list)
+  sizes: list[int] = field(default_factory=list)
+  min_mono_time: int = 0
+  max_mono_time: int = 0
+
+
+def build_log_index(fn: str) -> dict[str, LogIndexEntry]:
+  """Reads a log once and returns message type -> LogIndexEntry, events that aren't a known union type aren't indexed"""
+  index: dict[str, LogIndexEntry] = {}
+  offset = 0
+  with FileReader(fn) as f:
+    for dat in frame_messages(stream_decompress(f, _get_ext(fn))):
+      pos = offset
+      try:
+        for e, size in zip(capnp_log.Event.read_multiple_bytes(dat), _message_sizes(dat), strict=False):
+          try:
+            which = e.which()
+          except capnp.KjException:
+            pos += size
+            continue
+
+          mono_time = e.logMonoTime
+          entry = index.get(which)
+          if entry is None:
+            entry = index[which] = LogIndexEntry(min_mono_time=mono_time, max_mono_time=mono_time)
+          entry.offsets.append(pos)
+          entry.sizes.append(size)
+          entry.min_mono_time = min(entry.min_mono_time, mono_time)
+          entry.max_mono_time = max(entry.max_mono_time, mono_time)
+          pos += size
+      except capnp.KjException:
+        warnings.warn("Corrupted events detected", RuntimeWarning, stacklevel=1)
+        break
+      offset += len(dat)
+  return index
+
+
+def _log_cache_path(fn: str, prefix: str, extra: str = "") -> str:
+  """Where to cache something derived from a log, next to the download cache"""
+  key = fn
+  if os.path.isfile(fn):
+    # local files can be rewritten in place, uploaded ones can't
+    st = os.stat(fn)
+    key = f"{os.path.abspath(fn)}:{st.st_size}:{st.st_mtime_ns}"
+  # hash_256 drops URL queries, extra is hashed on its own so it isn't dropped with them
+  name = f"{prefix}_{hash_256(key)}"
+  if extra:
+    name += f"_{hashlib.sha256(extra.encode()).hexdigest()}"
+  return os.path.join(Paths.download_cache_root(), name)
+
+
+def get_log_index(fn: str) -> dict[str, LogIndexEntry]:
+  """The log's index, built on first use and cached next to the download cache"""
+  path = _log_cache_path(fn, f"logindex_v{LOG_INDEX_VERSION}")
+  try:
+    with open(path, "rb") as f:
+      return cast(dict[str, LogIndexEntry], pickle.load(f))
+  except (OSError, EOFError, pickle.UnpicklingError):
+    pass
+
+  index = build_log_index(fn)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+    pickle.dump(index, f, protocol=pickle.HIGHEST_PROTOCOL)
+  return index
+
+
+def _read_ranges(chunks: Iterable[bytes], ranges: list[tuple[int, int]]) -> Iterator[bytes]:
+  """Yields the (offset, size) ranges of a stream, ranges must be sorted. Stops reading the stream after the last one"""
+  buf = bytearray()
+  buf_start = 0
+  i = 0
+  for chunk in chunks:
+    buf += chunk
+    while i < len(ranges) and sum(ranges[i]) <= buf_start + len(buf):
+      start = ranges[i][0] - buf_start
+      yield bytes(buf[start:start + ranges[i][1]])
+      i += 1
+    if i == len(ranges):
+      return
+
+    # nothing before the next range is needed
+    drop = min(ranges[i][0] - buf_start, len(buf))
+    del buf[:drop]
+    buf_start += drop
+
+
+class _LogFileIndexedReader:
+  def __init__(self, fn, msg_type: str, entry: LogIndexEntry, sort_by_time=False):
+    """Reads only the events in entry. Uncompressed logs are seeked to them, compressed logs
+    have to be decompressed up to the last one but only those events are decoded"""
+    self._fn = fn
+    self._msg_type = msg_type
+    self._sort_by_time = sort_by_time
+
+    # events next to each other are read and decoded together
+    self._ranges: list[tuple[int, int]] = []
+    for offset, size in zip(entry.offsets, entry.sizes, strict=True):
+      if self._ranges and sum(self._ranges[-1]) == offset:
+        self._ranges[-1] = (self._ranges[-1][0], self._ranges[-1][1] + size)
+      else:
+        self._ranges.append((offset, size))
+
+  def _read(self) -> Iterator[bytes]:
+    ext = _get_ext(self._fn)
+    with FileReader(self._fn) as f:
+      if ext == "" and not f.read(len(ZSTD_MAGIC)).startswith((BZ2_MAGIC, ZSTD_MAGIC)):
+        for offset, size in self._ranges:
+          f.seek(offset)
+          yield f.read(size)
+        return
+
+      f.seek(0)
+      yield from _read_ranges(stream_decompress(f, ext), self._ranges)
+
+  def __iter__(self) -> Iterator[capnp._DynamicStructReader]:
+    ents = (CachedEventReader(e, self._msg_type) for dat in self._read() for e in capnp_log.Event.read_multiple_bytes(dat))
+    if self._sort_by_time:
+      yield from sorted(ents, key=lambda x: x.logMonoTime)
+    else:
+      yield from ents
+
+
 class ReadMode(enum.StrEnum):
   RLOG = "r"  # only read rlogs
   QLOG = "q"  # only read qlogs
@@ -243,7 +514,12 @@ class LogReader:
     return identifiers
 
   def __init__(self, identifier: str | list[str], default_mode: ReadMode = ReadMode.RLOG,
-               sources: list[Source] = None, sort_by_time=False, only_union_types=False):
+               sources: list[Source] = None, sort_by_time=False, only_union_types=False, streaming=False, use_index=False,
+               prefetch: int = 0):
+    if streaming and sort_by_time:
+      raise ValueError("sort_by_time needs whole segments in memory, it can't be combined with streaming")
+    if streaming and prefetch:
+      raise ValueError("prefetching reads whole segments ahead, it can't be combined with streaming")
     if sources is None:
       sources = [internal_source, comma_api_source, openpilotci_source, comma_car_segments_source]
 
@@ -255,19 +531,52 @@ class LogReader:
 
     self.sort_by_time = sort_by_time
     self.only_union_types = only_union_types
+    self.streaming = streaming
+    self.use_index = use_index
+    self.prefetch = prefetch  # segments downloaded and decompressed ahead in worker threads while iterating
 
     self.__lrs: dict[int, _LogFileReader] = {}
+    self.__indexes: dict[int, dict[str, LogIndexEntry]] = {}
     self.reset()
 
   def _get_lr(self, i):
+    if self.streaming:
+      # not kept, each iteration reads the segment again and it's released once iterated
+      return _LogFileStreamReader(self.logreader_identifiers[i], only_union_types=self.only_union_types)
     if i not in self.__lrs:
       self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time, only_union_types=self.only_union_types)
     return self.__lrs[i]
 
   def __iter__(self):
+    if self.prefetch > 0 and len(self.logreader_identifiers) > 1:
+      yield from self._iter_prefetch()
+      return
+
     for i in range(len(self.logreader_identifiers)):
       yield from self._get_lr(i)
 
+  def _iter_prefetch(self):
+    # downloading and decompressing release the GIL, so threads overlap them with decoding here without copying the bytes
+    num_segs = len(self.logreader_identifiers)
+    with concurrent.futures.ThreadPoolExecutor(min(self.prefetch, num_segs)) as executor:
+      def read_ahead(i):
+        if i >= num_segs or i in self.__lrs:
+          return None
+        return executor.submit(read_log_bytes, self.logreader_identifiers[i])
+
+      pending = deque(read_ahead(i) for i in range(self.prefetch))
+      try:
+        for i in range(num_segs):
+          result = pending.popleft()
+          pending.append(read_ahead(i + self.prefetch))
+          if result is not None:
+            self.__lrs[i] = _LogFileReader(self.logreader_identifiers[i], sort_by_time=self.sort_by_time,
+                                           only_union_types=self.only_union_types, dat=result.result())
+          yield from self.__lrs[i]
+      finally:
+        # stopped early, don't start downloads nobody will read
+        executor.shutdown(cancel_futures=True)
+
   def _run_on_segment(self, func, i):
     return func(self._get_lr(i))
 
@@ -288,8 +597,27 @@ class LogReader:
   def from_bytes(dat):
     return _LogFileReader("", dat=dat)
 
+  def get_index(self, i) -> dict[str, LogIndexEntry]:
+    if i not in self.__indexes:
+      self.__indexes[i] = get_log_index(self.logreader_identifiers[i])
+    return self.__indexes[i]
+
+  def _filter_segment(self, i, msg_type: str):
+    # a segment that's already in memory is quicker to go through than to read again
+    if i in self.__lrs:
+      return (m for m in self._get_lr(i) if m.which() == msg_type)
+
+    entry = self.get_index(i).get(msg_type)
+    if entry is None:
+      return iter(())
+    return _LogFileIndexedReader(self.logreader_identifiers[i], msg_type, entry, sort_by_time=self.sort_by_time)
+
   def filter(self, msg_type: str):
-    return (getattr(m, m.which()) for m in filter(lambda m: m.which() == msg_type, self))
+    if self.use_index:
+      msgs = (m for i in range(len(self.logreader_identifiers)) for m in self._filter_segment(i, msg_type))
+    else:
+      msgs = (m for m in self if m.which() == msg_type)
+    return (getattr(m, msg_type) for m in msgs)
 
   def first(self, msg_type: str):
     return next(self.filter(msg_type), None)
@@ -298,6 +626,46 @@ class LogReader:
   def time_series(self):
     return msgs_to_time_series(self)
 
+  def _segment_columns(self, i, fields: dict[str, list[str]], cache: bool):
+    fn = self.logreader_identifiers[i]
+    path = _log_cache_path(fn, f"logcolumns_v{LOG_COLUMNS_VERSION}", json.dumps(fields, sort_keys=True)) + ".npz"
+    if cache and os.path.isfile(path):
+      with np.load(path) as dat:
+        ret: dict[str, dict[str, np.ndarray]] = {}
+        for name in dat.files:
+          service, field_name = name.split("/", 1)
+          ret.setdefault(service, {})[field_name] = dat[name]
+        return ret
+
+    if self.use_index:
+      index = self.get_index(i)
+      counts = {service: len(index[service].offsets) for service in fields if service in index}
+      msgs = itertools.chain.from_iterable(self._filter_segment(i, service) for service in fields)
+      ret = msgs_to_columns(msgs, fields, counts)
+    else:
+      ret = msgs_to_columns(self._get_lr(i), fields)
+
+    # text and data columns are object arrays, which can only be loaded back by unpickling
+    arrays: dict[str, Any] = {f"{service}/{name}": col for service, cols in ret.items() for name, col in cols.items()}
+    if cache and all(col.dtype != object for col in arrays.values()):
+      os.makedirs(os.path.dirname(path), exist_ok=True)
+      with atomic_write_in_dir(path, mode="wb", overwrite=True) as f:
+        np.savez(f, **arrays)
+    return ret
+
+  def time_series_columns(self, fields: dict[str, list[str]], cache=True) -> dict[str, dict[str, np.ndarray]]:
+    """
+      The requested fields of each service as typed numpy arrays, see msgs_to_columns.
+      Each segment's columns are cached next to the download cache, so looking at a route again doesn't read its logs.
+    """
+    segments = [self._segment_columns(i, fields, cache) for i in range(len(self.logreader_identifiers))]
+    ret = {}
+    for service in fields:
+      parts = [seg[service] for seg in segments if service in seg]
+      if parts:
+        ret[service] = {name: np.concatenate([p[name] for p in parts]) for name in parts[0]}
+    return ret
+
 
 if __name__ == "__main__":
   import codecs
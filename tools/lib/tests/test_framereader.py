@@ -0,0 +1,129 @@
+import pickle
+import numpy as np
+
+from openpilot.tools.lib import framereader
+from openpilot.tools.lib.framereader import DiskCachedFrameReader, FrameReader, GOPCache, HEVC_SLICE_I, HEVC_SLICE_P
+
+W, H = 8, 4
+GOP_LEN = 5
+FRAME_COUNT = 20
+
+
+def fake_index_data():
+  frame_types = [(HEVC_SLICE_I if i % GOP_LEN == 0 else HEVC_SLICE_P, i) for i in range(FRAME_COUNT)]
+  return {
+    'index': np.array(frame_types + [(0xFFFFFFFF, FRAME_COUNT)], dtype=np.uint32),
+    'global_prefix': b'',
+    'probe': {'streams': [{'width': W, 'height': H}]},
+  }
+
+
+class TestFrameReader:
+  def setup_method(self):
+    self.decoded = []
+
+  def fake_decompress(self, rawdat, w, h, pix_fmt="rgb24", vid_fmt='hevc'):
+    # one byte per frame, the frame's index, so frames can be told apart
+    self.decoded.append(rawdat[0])
+    return np.repeat(np.frombuffer(rawdat, dtype=np.uint8), h * w * 3).reshape(-1, h, w, 3)
+
+  def reader(self, tmp_path, monkeypatch, **kwargs):
+    fn = tmp_path / "fcamera.hevc"
+    fn.write_bytes(bytes(range(FRAME_COUNT)))
+    monkeypatch.setattr(framereader, "decompress_video_data", self.fake_decompress)
+    return FrameReader(str(fn), fake_index_data(), **kwargs)
+
+  def test_frames(self, tmp_path, monkeypatch):
+    fr = self.reader(tmp_path, monkeypatch)
+    for fidx in [0, 7, 19, 3, 12, 12]:
+      assert (fr.get(fidx) == fidx).all()
+
+  def test_gop_decoded_once(self, tmp_path, monkeypatch):
+    fr = self.reader(tmp_path, monkeypatch, readahead=False)
+    for fidx in list(range(FRAME_COUNT)) + list(range(FRAME_COUNT))[::-1]:
+      fr.get(fidx)
+    assert self.decoded == [0, 5, 10, 15]
+
+  def test_readahead(self, tmp_path, monkeypatch):
+    fr = self.reader(tmp_path, monkeypatch)
+    fr.get(0)
+    fut = fr._pending.get(GOP_LEN)
+    if fut is not None:
+      fut.result()
+    assert GOP_LEN in fr._cache
+    fr.get(GOP_LEN)
+    assert self.decoded.count(GOP_LEN) == 1
+
+  def test_readahead_failure_retried(self, tmp_path, monkeypatch):
+    fr = self.reader(tmp_path, monkeypatch)
+    decompress = self.fake_decompress
+    def fail_once(rawdat, *args, **kwargs):
+      if rawdat[0] == GOP_LEN and GOP_LEN not in self.decoded:
+        self.decoded.append(GOP_LEN)
+        raise framereader.DataUnreadableError("decode failed")
+      return decompress(rawdat, *args, **kwargs)
+    monkeypatch.setattr(framereader, "decompress_video_data", fail_once)
+
+    fr.get(0)
+    fut = fr._pending.get(GOP_LEN)
+    if fut is not None:
+      fut.exception()
+    assert GOP_LEN not in fr._cache
+    assert (fr.get(GOP_LEN) == GOP_LEN).all()
+    assert self.decoded.count(GOP_LEN) == 2
+
+  def test_cache_budget(self, tmp_path, monkeypatch):
+    fr = self.reader(tmp_path, monkeypatch, readahead=False, cache_bytes=2 * GOP_LEN * H * W * 3)
+    for fidx in range(0, FRAME_COUNT, GOP_LEN):
+      fr.get(fidx)
+    fr.get(0)
+    assert self.decoded == [0, 5, 10, 15, 0]
+    assert fr._cache.nbytes <= fr._cache.capacity_bytes
+
+  def test_default_budget(self, tmp_path, monkeypatch):
+    fr = self.reader(tmp_path, monkeypatch, cache_size=7)
+    assert fr._cache.capacity_bytes == 7 * H * W * 3
+    monkeypatch.setattr(framereader, "DEFAULT_CACHE_BYTES", 1024 * 1024)
+    assert self.reader(tmp_path, monkeypatch, cache_size=7)._cache.capacity_bytes == 1024 * 1024
+
+  def test_readahead_keeps_current_gop(self, tmp_path, monkeypatch):
+    # room for one GOP, the one decoded ahead doesn't push out the one being read
+    fr = self.reader(tmp_path, monkeypatch, cache_size=GOP_LEN)
+    for fidx in range(FRAME_COUNT):
+      assert (fr.get(fidx) == fidx).all()
+      fut = fr._pending.get(fidx - fidx % GOP_LEN + GOP_LEN)
+      if fut is not None:
+        fut.result()
+    assert sorted(self.decoded) == [0, 5, 10, 15]
+
+  def test_pickle(self, tmp_path, monkeypatch):
+    fr = self.reader(tmp_path, monkeypatch, readahead=False)
+    fr.get(0)
+    fr = pickle.loads(pickle.dumps(fr))
+    assert (fr.get(0) == 0).all()
+    assert (fr.get(GOP_LEN + 1) == GOP_LEN + 1).all()
+
+  def test_disk_cache(self, tmp_path, monkeypatch):
+    self.reader(tmp_path, monkeypatch)
+    fn, cache_dir = str(tmp_path / "fcamera.hevc"), str(tmp_path / "frames")
+    fr = DiskCachedFrameReader(fn, cache_dir, fake_index_data(), pix_fmt="rgb24")
+    for fidx in [7, 6, 8, 0]:
+      assert (fr.get(fidx) == fidx).all()
+    assert self.decoded == [5, 0]
+    # only the GOP that was just decoded stays in memory
+    assert 0 in fr._cache and GOP_LEN not in fr._cache
+
+    # another reader gets the frames from the file
+    fr = DiskCachedFrameReader(fn, cache_dir, fake_index_data(), pix_fmt="rgb24")
+    for fidx in range(2 * GOP_LEN):
+      assert (fr.get(fidx) == fidx).all()
+    assert self.decoded == [5, 0]
+
+
+def test_gop_cache_keeps_newest():
+  cache = GOPCache(10)
+  cache.put(0, np.zeros(8, dtype=np.uint8))
+  cache.put(1, np.zeros(16, dtype=np.uint8))
+  assert 0 not in cache
+  assert cache.get(1) is not None
+  assert cache.nbytes == 16
@@ -1,16 +1,22 @@
+import bz2
 import capnp
+import numpy as np
 import contextlib
 import io
 import shutil
 import tempfile
+import threading
+import tracemalloc
 import os
 import pytest
 import requests
+import zstandard as zstd
 
 from parameterized import parameterized
 
-from cereal import log as capnp_log
-from openpilot.tools.lib.logreader import LogsUnavailable, LogIterable, LogReader, parse_indirect, ReadMode
+from cereal import car, log as capnp_log
+from openpilot.tools.lib.logreader import LogsUnavailable, LogIterable, LogReader, _log_cache_path, get_log_index, parse_indirect, ReadMode
+from openpilot.tools.lib.log_time_series import msgs_to_columns
 from openpilot.tools.lib.file_sources import comma_api_source, InternalUnavailableException
 from openpilot.tools.lib.route import SegmentRange
 from openpilot.tools.lib.url_file import URLFileException
@@ -254,3 +260,191 @@ class TestLogReader:
       msgs = list(LogReader(qlog.name, only_union_types=True))
       assert len(msgs) == num_msgs
       [m.which() for m in msgs]
+
+      msgs = list(LogReader(qlog.name, only_union_types=True, streaming=True))
+      assert len(msgs) == num_msgs
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_streaming(self, mocker, ext):
+    msgs = []
+    for i in range(1000):
+      msg = capnp_log.Event.new_message(logMonoTime=i)
+      msg.init('can', i % 4)
+      for j in range(i % 4):
+        msg.can[j].dat = bytes([i % 256]) * (i % 64)
+      msgs.append(msg.to_bytes())
+    dat = b"".join(msgs)
+    dat = {"": dat, ".bz2": bz2.compress(dat), ".zst": zstd.compress(dat)}[ext]
+
+    with tempfile.NamedTemporaryFile(suffix=ext) as f:
+      f.write(dat)
+      f.flush()
+
+      expected = [(m.logMonoTime, m.which(), [c.dat for c in m.can]) for m in LogReader(f.name)]
+      # small chunks so messages and compressed blocks straddle chunk boundaries
+      for chunk_size in (7, 100, 1 << 20):
+        mocker.patch("openpilot.tools.lib.logreader.STREAM_CHUNK_SIZE", chunk_size)
+        lr = LogReader(f.name, streaming=True)
+        assert [(m.logMonoTime, m.which(), [c.dat for c in m.can]) for m in lr] == expected
+        # iterating again reads the file again
+        assert len(list(lr)) == len(expected)
+
+  def test_streaming_bounded_memory(self):
+    msg = capnp_log.Event.new_message()
+    msg.init('can', 1)
+    msg.can[0].dat = b'\x00' * 2000
+    dat = msg.to_bytes() * 8000  # ~16 MB decompressed per segment
+
+    with tempfile.NamedTemporaryFile(suffix=".zst") as f:
+      f.write(zstd.compress(dat))
+      f.flush()
+
+      num_segments = 8
+      tracemalloc.start()
+      try:
+        count = sum(1 for _ in LogReader([f.name] * num_segments, streaming=True))
+        _, peak = tracemalloc.get_traced_memory()
+      finally:
+        tracemalloc.stop()
+
+      assert count == 8000 * num_segments
+      # independent of segment size and count: a chunk, its framing buffer, and the message being read
+      assert peak < 8 * 1024 * 1024, f"peak {peak / 1e6:.1f} MB for {len(dat) * num_segments / 1e6:.0f} MB of logs"
+
+  def test_streaming_sort_by_time(self):
+    with pytest.raises(ValueError):
+      LogReader(QLOG_FILE, streaming=True, sort_by_time=True)
+
+  @pytest.mark.parametrize("ext", ["", ".bz2", ".zst"])
+  def test_index(self, mocker, monkeypatch, ext):
+    msgs = []
+    for i in range(1000):
+      msg = capnp_log.Event.new_message(logMonoTime=1000 - i)
+      if i == 0:
+        msg.init('initData')
+      elif i % 10 == 0:
+        msg.init('carState').vEgo = i
+      else:
+        msg.init('can', 1)[0].dat = bytes([i % 256]) * (i % 64)
+      msgs.append(msg.to_bytes())
+    dat = b"".join(msgs)
+    dat = {"": dat, ".bz2": bz2.compress(dat), ".zst": zstd.compress(dat)}[ext]
+
+    with tempfile.TemporaryDirectory() as cache, tempfile.NamedTemporaryFile(suffix=ext) as f:
+      monkeypatch.setenv("COMMA_CACHE", cache)
+      f.write(dat)
+      f.flush()
+
+      index = get_log_index(f.name)
+      assert set(index) == {'initData', 'carState', 'can'}
+      assert len(index['carState'].offsets) == 99
+      assert (index['carState'].min_mono_time, index['carState'].max_mono_time) == (10, 990)
+
+      for sort_by_time in (False, True):
+        expected = LogReader(f.name, sort_by_time=sort_by_time)
+        lr = LogReader([f.name] * 2, sort_by_time=sort_by_time, use_index=True)
+        assert [m.vEgo for m in lr.filter('carState')] == [m.vEgo for m in expected.filter('carState')] * 2
+        assert [m[0].dat for m in lr.filter('can')] == [m[0].dat for m in expected.filter('can')] * 2
+        assert lr.first('initData') is not None
+        assert lr.first('controlsState') is None
+
+      # cached, the log isn't read again to filter types it doesn't have
+      build = mocker.patch("openpilot.tools.lib.logreader.build_log_index")
+      file_reader = mocker.patch("openpilot.tools.lib.logreader.FileReader")
+      assert LogReader(f.name, use_index=True).first('controlsState') is None
+      build.assert_not_called()
+      file_reader.assert_not_called()
+
+  @pytest.mark.parametrize("prefetch", [1, 2, 8])
+  def test_prefetch(self, prefetch):
+    with tempfile.TemporaryDirectory() as tmp:
+      fns = []
+      for i, ext in enumerate(["", ".bz2", ".zst"] * 2):
+        dat = b"".join(capnp_log.Event.new_message(logMonoTime=i * 100 + j, valid=j % 2 == 0).to_bytes() for j in range(100))
+        fns.append(os.path.join(tmp, f"{i}_rlog{ext}"))
+        with open(fns[-1], "wb") as f:
+          f.write({"": dat, ".bz2": bz2.compress(dat), ".zst": zstd.compress(dat)}[ext])
+
+      expected = [(m.logMonoTime, m.valid) for m in LogReader(fns)]
+      assert len(expected) == 600
+
+      lr = LogReader(fns, prefetch=prefetch)
+      assert [(m.logMonoTime, m.valid) for m in lr] == expected
+      # segments that were read stay in memory like without prefetching
+      assert [(m.logMonoTime, m.valid) for m in lr] == expected
+
+      # stopping early doesn't leave workers behind
+      threads = set(threading.enumerate())
+      it = iter(LogReader(fns, prefetch=prefetch))
+      assert next(it).logMonoTime == 0
+      assert len(set(threading.enumerate()) - threads) > 0
+      it.close()
+      assert set(threading.enumerate()) - threads == set()
+
+  def test_prefetch_streaming(self):
+    with pytest.raises(ValueError):
+      LogReader(QLOG_FILE, streaming=True, prefetch=2)
+
+  @pytest.mark.parametrize("use_index", [False, True])
+  def test_time_series_columns(self, mocker, monkeypatch, use_index):
+    msgs = []
+    for i in range(3000):
+      msg = capnp_log.Event.new_message(logMonoTime=(i * 7919) % 3000, valid=i % 3 != 0)
+      if i % 2:
+        cs = msg.init('carState')
+        cs.vEgo = i / 10
+        cs.gearShifter = 'drive' if i % 4 == 1 else 'park'
+        cs.cruiseState.speed = i
+      else:
+        msg.init('accelerometer').init('acceleration').v = [i, i + 1, i + 2]
+      msgs.append(msg.to_bytes())
+
+    fields = {'carState': ['vEgo', 'gearShifter', 'cruiseState/speed'], 'accelerometer': ['acceleration/v'], 'controlsState': ['curvature']}
+    with tempfile.TemporaryDirectory() as cache, tempfile.NamedTemporaryFile(suffix=".zst") as f:
+      monkeypatch.setenv("COMMA_CACHE", cache)
+      f.write(zstd.compress(b"".join(msgs)))
+      f.flush()
+
+      ts = LogReader(f.name).time_series
+      for _ in range(2):
+        cols = LogReader([f.name] * 2, use_index=use_index).time_series_columns(fields)
+        assert set(cols) == {'carState', 'accelerometer'}
+
+        car_state = cols['carState']
+        assert car_state['vEgo'].dtype == np.float32 and car_state['gearShifter'].dtype == np.uint16
+        assert len(car_state['t']) == 2 * len(ts['carState']['t'])
+        for name in ('t', '_valid', 'vEgo', 'cruiseState/speed'):
+          np.testing.assert_array_equal(car_state[name], np.tile(ts['carState'][name], 2))
+        gears = [car.CarState.GearShifter.schema.enumerants[str(g)] for g in ts['carState']['gearShifter']]
+        np.testing.assert_array_equal(car_state['gearShifter'], np.tile(gears, 2))
+
+        acc = cols['accelerometer']
+        assert acc['acceleration/v'].shape == (3000, 3)
+        np.testing.assert_array_equal(acc['acceleration/v'], np.tile(np.stack(ts['accelerometer']['acceleration/v']), (2, 1)))
+
+        # the second time the columns come from the cache
+        mocker.patch("openpilot.tools.lib.logreader.msgs_to_columns", side_effect=AssertionError)
+
+  def test_time_series_columns_text(self, monkeypatch):
+    msg = capnp_log.Event.new_message(logMonoTime=1)
+    msg.init('initData').gitCommit = "abc"
+    with tempfile.TemporaryDirectory() as cache, tempfile.NamedTemporaryFile(suffix=".zst") as f:
+      monkeypatch.setenv("COMMA_CACHE", cache)
+      f.write(zstd.compress(msg.to_bytes()))
+      f.flush()
+
+      # object columns aren't cached, they'd need pickle to load
+      for _ in range(2):
+        cols = LogReader(f.name).time_series_columns({'initData': ['gitCommit']})
+        assert list(cols['initData']['gitCommit']) == ["abc"]
+      assert not any(fn.endswith(".npz") for _, _, fns in os.walk(cache) for fn in fns)
+
+  def test_log_cache_path(self):
+    url = "https://commadata2.blob.core.windows.net/commadata2/a2a0ccea32023010/2023-07-27--13-01-19/0/rlog.zst"
+    assert _log_cache_path(url + "?sig=1", "p", "a") == _log_cache_path(url + "?sig=2", "p", "a")
+    assert _log_cache_path(url + "?sig=1", "p", "a") != _log_cache_path(url + "?sig=1", "p", "b")
+
+  def test_time_series_columns_bad_fields(self):
+    for fields in ({'carState': ['notAField']}, {'carState': ['cruiseState']}, {'notAService': ['vEgo']}, {'carState': ['vEgo/x']}):
+      with pytest.raises(ValueError):
+        msgs_to_columns([], fields)
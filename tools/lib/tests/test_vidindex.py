@@ -0,0 +1,61 @@
+import pytest
+
+from openpilot.tools.lib import framereader
+from openpilot.tools.lib.framereader import get_video_index, HEVC_SLICE_I, HEVC_SLICE_P
+from openpilot.tools.lib.vidindex import hevc_dimensions, hevc_index, VideoFileInvalid
+
+# VPS, SPS and PPS from x265, 322x242 coded as 328x248 with a conformance window
+PARAMETER_SETS = bytes.fromhex(
+  "00000140010c01ffff01600000030090000003000003003c9280900000000142010101600000030090000003000003003ca00a480f9c926592" +
+  "a4932b9a020000030002000003002810000000014401c172b46240"
+)
+# first_slice_segment_in_pic_flag, (no_output_of_prior_pics_flag,) slice_pic_parameter_set_id = 0 and slice_type
+IDR_SLICE = b"\x00\x00\x01\x26\x01\xac\xff\xff"
+P_SLICE = b"\x00\x00\x01\x02\x01\xd0\xff\xff"
+P_SLICE_SEGMENT = b"\x00\x00\x01\x02\x01\x40\xff\xff"
+
+
+def write_video(path, dat):
+  # byte streams start with a zero_byte before the first start code
+  path.write_bytes(b"\x00" + dat)
+  return str(path)
+
+
+def test_hevc_index(tmp_path):
+  gop = IDR_SLICE + P_SLICE + P_SLICE_SEGMENT + P_SLICE
+  dat = PARAMETER_SETS + gop + PARAMETER_SETS + gop
+  frame_types, dat_len, prefix = hevc_index(write_video(tmp_path / "fcamera.hevc", dat))
+
+  offsets = [len(PARAMETER_SETS) + 1, len(PARAMETER_SETS) + 1 + len(IDR_SLICE), len(PARAMETER_SETS) + 1 + len(IDR_SLICE + P_SLICE + P_SLICE_SEGMENT)]
+  offsets += [o + len(PARAMETER_SETS + gop) for o in offsets]
+  assert frame_types == list(zip([HEVC_SLICE_I, HEVC_SLICE_P, HEVC_SLICE_P] * 2, offsets, strict=True))
+  assert dat_len == len(dat) + 1
+  assert prefix == PARAMETER_SETS * 2
+
+
+def test_hevc_index_truncated(tmp_path):
+  fn = write_video(tmp_path / "fcamera.hevc", PARAMETER_SETS + IDR_SLICE + P_SLICE[:4])
+  with pytest.raises(VideoFileInvalid):
+    hevc_index(fn)
+  assert hevc_index(fn, allow_corrupt=True)[0] == [(HEVC_SLICE_I, len(PARAMETER_SETS) + 1)]
+
+
+def test_hevc_dimensions():
+  assert hevc_dimensions(PARAMETER_SETS) == (322, 242)
+  with pytest.raises(VideoFileInvalid):
+    hevc_dimensions(IDR_SLICE)
+
+
+def test_video_index_cached(tmp_path, monkeypatch):
+  monkeypatch.setenv("COMMA_CACHE", str(tmp_path / "cache"))
+  fn = write_video(tmp_path / "fcamera.hevc", PARAMETER_SETS + IDR_SLICE + P_SLICE)
+  index_data = get_video_index(fn)
+  assert (index_data['width'], index_data['height']) == (322, 242)
+
+  def fail(*args, **kwargs):
+    raise AssertionError("video indexed again")
+  monkeypatch.setattr(framereader, "hevc_index", fail)
+  cached = get_video_index(fn)
+  assert (cached['index'] == index_data['index']).all()
+  assert cached['global_prefix'] == index_data['global_prefix']
+  assert (cached['width'], cached['height']) == (322, 242)
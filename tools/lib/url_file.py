@@ -127,7 +127,7 @@ class URLFile:
         end = self.get_length() - 1
       else:
         end = min(self._pos + ll, self.get_length()) - 1
-      if self._pos >= end:
+      if self._pos > end:
         return b""
       headers['Range'] = f"bytes={self._pos}-{end}"
       download_range = True
@@ -4,6 +4,8 @@ import os
 import struct
 from enum import IntEnum
 
+import numpy as np
+
 from openpilot.tools.lib.filereader import FileReader
 
 DEBUG = int(os.getenv("DEBUG", "0"))
@@ -147,6 +149,12 @@ def get_ue(dat: bytes, start_idx: int, skip_bits: int) -> tuple[int, int]:
 
   raise VideoFileInvalid("invalid exponential-golomb code")
 
+def get_u(dat: bytes, start_idx: int, skip_bits: int, n: int) -> int:
+  val = 0
+  for k in range(skip_bits, skip_bits + n):
+    val = (val << 1) | ((dat[start_idx + k // 8] >> (7 - k % 8)) & 1)
+  return val
+
 def require_nal_unit_start(dat: bytes, nal_unit_start: int) -> None:
   if nal_unit_start < 1:
     raise ValueError("start index must be greater than zero")
@@ -258,6 +266,14 @@ def get_hevc_slice_type(dat: bytes, nal_unit_start: int, nal_unit_type: HevcNalU
     raise VideoFileInvalid("slice_type must be 0, 1, or 2")
   return slice_type, is_first_slice
 
+def find_nal_unit_starts(dat: bytes) -> np.ndarray:
+  # B.2 Byte stream NAL unit syntax
+  # emulation prevention guarantees a start code never shows up inside a NAL unit, so every match is a NAL unit start
+  d = np.frombuffer(dat, dtype=np.uint8)
+  ones = np.flatnonzero(d[2:] == 1)
+  starts: np.ndarray = ones[(d[ones] == 0) & (d[ones + 1] == 0)]
+  return starts
+
 def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, int, bytes]:
   with FileReader(hevc_file_name) as f:
     dat = f.read()
@@ -271,19 +287,35 @@ def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, in
   prefix_dat = b""
   frame_types = list()
 
+  # NAL unit boundaries and types are found for the whole file at once, only the
+  # parameter sets and the first slice header of each picture are parsed one by one
+  d = np.frombuffer(dat, dtype=np.uint8)
+  starts = find_nal_unit_starts(dat)
+  ends = np.append(starts[1:], len(dat))
+  has_header = starts + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE <= len(dat)
+  nal_unit_types = np.full(len(starts), -1)
+  nal_unit_types[has_header] = (d[starts[has_header] + NAL_UNIT_START_CODE_SIZE] >> 1) & 0x3F
+  has_rbsp = starts + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE < len(dat)
+  is_first_slice = np.zeros(len(starts), dtype=bool)
+  is_first_slice[has_rbsp] = d[starts[has_rbsp] + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE] >> 7 == 1
+
+  # truncated NAL units are parsed too, to fail the same way
+  is_slice = np.isin(nal_unit_types, [int(t) for t in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS])
+  parsed = np.isin(nal_unit_types, [int(t) for t in HEVC_PARAMETER_SET_NAL_UNITS]) | \
+           (is_slice & (is_first_slice | ~has_rbsp)) | ~has_header
+
   i = 1 # skip past first byte 0x00
   try:
-    while i < len(dat):
+    if len(starts) == 0 or starts[0] != i:
       require_nal_unit_start(dat, i)
-      nal_unit_len = get_hevc_nal_unit_length(dat, i)
+    for j in np.flatnonzero(parsed):
+      i = int(starts[j])
       nal_unit_type = get_hevc_nal_unit_type(dat, i)
       if nal_unit_type in HEVC_PARAMETER_SET_NAL_UNITS:
-        prefix_dat += dat[i:i+nal_unit_len]
-      elif nal_unit_type in HEVC_CODED_SLICE_SEGMENT_NAL_UNITS:
-        slice_type, is_first_slice = get_hevc_slice_type(dat, i, nal_unit_type)
-        if is_first_slice:
-          frame_types.append((slice_type, i))
-      i += nal_unit_len
+        prefix_dat += dat[i:int(ends[j])]
+      else:
+        slice_type, _ = get_hevc_slice_type(dat, i, nal_unit_type)
+        frame_types.append((slice_type, i))
   except Exception as e:
     if not allow_corrupt:
       raise
@@ -291,6 +323,77 @@ def hevc_index(hevc_file_name: str, allow_corrupt: bool=False) -> tuple[list, in
 
   return frame_types, len(dat), prefix_dat
 
+def hevc_dimensions(prefix_dat: bytes) -> tuple[int, int]:
+  """Width and height of the video, after cropping, from the SPS in the parameter sets"""
+  starts = find_nal_unit_starts(prefix_dat)
+  for start in starts:
+    if get_hevc_nal_unit_type(prefix_dat, start) == HevcNalUnitType.SPS_NUT:
+      break
+  else:
+    raise VideoFileInvalid("no SPS in parameter sets")
+
+  # 7.4.2 NAL unit semantics, emulation_prevention_three_byte is not part of the RBSP
+  nal_unit = prefix_dat[start + NAL_UNIT_START_CODE_SIZE + NAL_UNIT_HEADER_SIZE:]
+  next_starts = starts[starts > start]
+  if len(next_starts):
+    nal_unit = nal_unit[:next_starts[0] - start - NAL_UNIT_START_CODE_SIZE - NAL_UNIT_HEADER_SIZE]
+  rbsp = nal_unit.replace(b"\x00\x00\x03", b"\x00\x00")
+
+  # 7.3.2.2.1 General sequence parameter set RBSP syntax
+  # seq_parameter_set_rbsp( ) {                                           // descriptor
+  #   sps_video_parameter_set_id                                          u(4)
+  #   sps_max_sub_layers_minus1                                           u(3)
+  #   sps_temporal_id_nesting_flag                                        u(1)
+  #   profile_tier_level( 1, sps_max_sub_layers_minus1 )
+  #   sps_seq_parameter_set_id                                           ue(v)
+  #   chroma_format_idc                                                  ue(v)
+  #   if( chroma_format_idc = = 3 )
+  #     separate_colour_plane_flag                                        u(1)
+  #   pic_width_in_luma_samples                                          ue(v)
+  #   pic_height_in_luma_samples                                         ue(v)
+  #   conformance_window_flag                                             u(1)
+  #   if( conformance_window_flag ) {
+  #     conf_win_left_offset                                             ue(v)
+  #     conf_win_right_offset                                            ue(v)
+  #     conf_win_top_offset                                              ue(v)
+  #     conf_win_bottom_offset                                           ue(v)
+  #   }
+  # ...
+  max_sub_layers_minus1 = get_u(rbsp, 0, 4, 3)
+  skip_bits = 8
+
+  # 7.3.3 Profile, tier and level syntax
+  # general profile is 88 bits, general_level_idc 8, then the sub-layers' present flags, padded to 8 sub-layers
+  skip_bits += 88 + 8
+  sub_layer_flags = [(get_u(rbsp, 0, skip_bits + 2*k, 1), get_u(rbsp, 0, skip_bits + 2*k + 1, 1)) for k in range(max_sub_layers_minus1)]
+  if max_sub_layers_minus1 > 0:
+    skip_bits += 2 * 8
+  for profile_present, level_present in sub_layer_flags:
+    skip_bits += 88 * profile_present + 8 * level_present
+
+  def ue() -> int:
+    nonlocal skip_bits
+    val, size = get_ue(rbsp, 0, skip_bits)
+    skip_bits += size
+    return val
+
+  ue()  # sps_seq_parameter_set_id
+  chroma_format_idc = ue()
+  separate_colour_plane = 0
+  if chroma_format_idc == 3:
+    separate_colour_plane = get_u(rbsp, 0, skip_bits, 1)
+    skip_bits += 1
+  width, height = ue(), ue()
+  conformance_window = get_u(rbsp, 0, skip_bits, 1)
+  skip_bits += 1
+  if conformance_window:
+    values = [ue() for _ in range(4)]
+    # Table 6-1 - SubWidthC and SubHeightC values derived from chroma_format_idc and separate_colour_plane_flag
+    sub_width, sub_height = {1: (2, 2), 2: (2, 1)}.get(0 if separate_colour_plane else chroma_format_idc, (1, 1))
+    width -= sub_width * (values[0] + values[1])
+    height -= sub_height * (values[2] + values[3])
+  return width, height
+
 def main() -> None:
   parser = argparse.ArgumentParser()
   parser.add_argument("input_file", type=str)
@@ -1,9 +1,10 @@
 import math
+import time
 import multiprocessing
 import numpy as np
 
 from abc import ABC, abstractmethod
-from collections import namedtuple
+from collections import defaultdict, deque, namedtuple
 
 # W, H = 1928, 1208
 W, H = 1920, 1080
@@ -28,6 +29,48 @@ class GPSState:
     self.altitude = 0
 
 
+class TopicStats:
+  def __init__(self, maxlen: int = 1000):
+    self.count = 0
+    self.window_count = 0
+    self.last: dict = {}
+    self.latencies: deque[float] = deque(maxlen=maxlen)
+
+
+class BridgeStats:
+  """Per-topic counts, rates, last values and callback latencies, summarized periodically instead of logging every message."""
+  def __init__(self):
+    self.topics: defaultdict[str, TopicStats] = defaultdict(TopicStats)
+    self.window_start = time.monotonic()
+
+  def record(self, topic: str, latency: float, **last):
+    stats = self.topics[topic]
+    stats.count += 1
+    stats.window_count += 1
+    stats.latencies.append(latency)
+    stats.last.update(last)
+
+  def summary(self) -> dict:
+    now = time.monotonic()
+    dt = max(now - self.window_start, 1e-3)
+    self.window_start = now
+
+    ret = {}
+    for topic, stats in self.topics.items():
+      latencies_ms = np.array(stats.latencies) * 1000
+      p50, p99 = np.percentile(latencies_ms, [50, 99]) if len(latencies_ms) else (0., 0.)
+      ret[topic] = {
+        'count': stats.count,
+        'rate': round(stats.window_count / dt, 1),
+        'latency_ms_p50': round(float(p50), 3),
+        'latency_ms_p99': round(float(p99), 3),
+        'last': stats.last,
+      }
+      stats.window_count = 0
+      stats.latencies.clear()
+    return ret
+
+
 class IMUState:
   def __init__(self):
     self.accelerometer: vec3 = vec3(0,0,0)
@@ -9,6 +9,7 @@ from sensor_msgs.msg import NavSatFix  # or your custom GPS msg
 from cv_bridge import CvBridge
 import cv2
 import numpy as np
+import json
 import math
 import time
 
@@ -17,11 +18,12 @@ from cereal import log
 import cereal.messaging as messaging
 from msgq.visionipc import VisionIpcServer, VisionStreamType
 from common.params import Params
-from unobox.misc import W, H
-import copy
+from unobox.misc import W, H, BridgeStats
 
 from common.realtime import DT_DMON
 
+STATS_PERIOD = 10.  # seconds between bridge telemetry summaries
+
 class SensorBridge(Node):
   def __init__(self, dual_camera=False):
     super().__init__('sensor_bridge')
@@ -46,6 +48,10 @@ class SensorBridge(Node):
 
     self.vipc_server.start_listener()
 
+    # per message logging is too slow at IMU rates, callbacks record into stats that get logged periodically
+    self.stats = BridgeStats()
+    self.stats_timer = self.create_timer(STATS_PERIOD, self.log_stats)
+
     # IMU
     self.imu_sub = self.create_subscription(
         Imu,
@@ -78,24 +84,26 @@ class SensorBridge(Node):
         10
     )
 
-  def cam_send_yuv_road(self, yuv):
-    self._send_yuv(yuv, self.frame_road_id, 'roadCameraState', VisionStreamType.VISION_STREAM_ROAD)
+  def cam_send_yuv_road(self, yuv, recv_time=None):
+    self._send_yuv(yuv, self.frame_road_id, 'roadCameraState', VisionStreamType.VISION_STREAM_ROAD, recv_time)
     self.frame_road_id += 1
     if self.frame_road_id % 10 == 0:
         self.send_panda_state()
 
-  def cam_send_yuv_wide_road(self, yuv):
-    self._send_yuv(yuv, self.frame_wide_id, 'wideRoadCameraState', VisionStreamType.VISION_STREAM_WIDE_ROAD)
+  def cam_send_yuv_wide_road(self, yuv, recv_time=None):
+    self._send_yuv(yuv, self.frame_wide_id, 'wideRoadCameraState', VisionStreamType.VISION_STREAM_WIDE_ROAD, recv_time)
     self.frame_wide_id += 1
 
-  def _send_yuv(self, yuv, frame_id, pub_type, yuv_type):
-    yuv = yuv.tobytes()
+  def _send_yuv(self, yuv, frame_id, pub_type, yuv_type, recv_time=None):
+    # send() takes any buffer (bytes, ndarray, the ROS message data) and copies it into the VisionIpc buffer once
     eof = int(frame_id * 0.05 * 1e9)
     self.vipc_server.send(yuv_type, yuv, frame_id, eof, eof)
+    processing_time = time.monotonic() - recv_time if recv_time is not None else 0.
 
     dat = messaging.new_message(pub_type, valid=True)
     msg = {
       "frameId": frame_id,
+      "processingTime": processing_time,
       "transform": [1.0, 0.0, 0.0,
                     0.0, 1.0, 0.0,
                     0.0, 0.0, 1.0]
@@ -103,14 +111,18 @@ class SensorBridge(Node):
     setattr(dat, pub_type, msg)
     self.pm.send(pub_type, dat)
 
+  def log_stats(self):
+    self.get_logger().info(f'bridge stats: {json.dumps(self.stats.summary())}')
+
   def imu_mag_callback(self, msg: Imu):
+      t = time.monotonic()
       # Extract quaternion data
       orientation_q = msg.orientation
 
       # Check if orientation covariance is valid (optional but recommended)
       # If all zeros, orientation data might not be available/reliable
       if all(c == 0.0 for c in msg.orientation_covariance):
-          self.get_logger().warn('IMU orientation data covariance is zero/unknown. Bearing might be unreliable.')
+          self.get_logger().warn('IMU orientation data covariance is zero/unknown. Bearing might be unreliable.', throttle_duration_sec=STATS_PERIOD)
 
       # Convert quaternion to Euler angles (roll, pitch, yaw)
       # Angles are in radians, typically roll and pitch are referenced to gravity, yaw may drift
@@ -130,17 +142,13 @@ class SensorBridge(Node):
               bearing_deg += 360
           self.bearing_deg = bearing_deg
 
-          self.get_logger().info(f'Received IMU data: Bearing (Heading): {bearing_deg:.2f} degrees')
-
       except Exception as e:
           self.get_logger().error(f'Error processing IMU data: {e}')
 
+      self.stats.record('imu_mag', time.monotonic() - t, bearing_deg=round(self.bearing_deg, 2))
+
   def imu_callback(self, msg: Imu):
-      self.get_logger().info(
-          f'IMU lin_acc: x={msg.linear_acceleration.x:.3f}, '
-          f'y={msg.linear_acceleration.y:.3f}, '
-          f'z={msg.linear_acceleration.z:.3f}'
-      )
+      t = time.monotonic()
 
       dat = messaging.new_message('accelerometer', valid=True)
       dat.accelerometer.sensor = 4
@@ -159,10 +167,11 @@ class SensorBridge(Node):
       dat.gyroscope.gyroUncalibrated.v = [msg.angular_velocity.x, msg.angular_velocity.y, msg.angular_velocity.z]
       self.pm.send('gyroscope', dat)
 
+      acc = msg.linear_acceleration
+      self.stats.record('imu', time.monotonic() - t, lin_acc=[round(acc.x, 3), round(acc.y, 3), round(acc.z, 3)])
+
   def gps_callback(self, msg: NavSatFix):
-      self.get_logger().info(
-          f'GPS: lat={msg.latitude:.6f}, lon={msg.longitude:.6f}, alt={msg.altitude:.2f}'
-      )
+      t = time.monotonic()
 
       # todo venNED and speed should be set from the vhichle state
 
@@ -184,28 +193,29 @@ class SensorBridge(Node):
       }
 
       self.pm.send('gpsLocationExternal', dat)
+      self.stats.record('gps', time.monotonic() - t, lat=round(msg.latitude, 6), lon=round(msg.longitude, 6), alt=round(msg.altitude, 2))
 
   def image_callback(self, msg: Image):
+      recv_time = time.monotonic()
       # Convert ROS Image message to OpenCV image
       try:
           # Handle NV12 encoding (YUV 4:2:0 format)
           if msg.encoding == 'nv12':
-              # NV12 format: Y plane (full res) + interleaved UV plane (half res)
-              height = msg.height
-              width = msg.width
-
-              # Convert raw data to numpy array
-              img_data = np.frombuffer(msg.data, dtype=np.uint8)
-
-              # NV12 format: Y plane is width*height, then interleaved UV is width*height/2
-              # OpenCV expects NV12 as a single array of shape (height * 3 // 2, width)
-              # The first height rows are Y, the remaining height/2 rows are interleaved UV
-              yuv_image = img_data.reshape((height * 3 // 2, width))
-              vis_yuv = copy.deepcopy(yuv_image)
-              self.cam_send_yuv_road(yuv_image)
+              # NV12 format: Y plane (full res) + interleaved UV plane (half res),
+              # already the VisionIpc layout, so the message data is sent as is
+              frame_id = self.frame_road_id
+              self.cam_send_yuv_road(msg.data, recv_time)
+
+              # camera header stamp (wall clock) until the frame is in VisionIpc
+              stamp = msg.header.stamp.sec + msg.header.stamp.nanosec * 1e-9
+              ingest_ms = round((time.time() - stamp) * 1000, 1) if stamp > 0 else None  # noqa: TID251
+              self.stats.record('image', time.monotonic() - recv_time, frame_id=frame_id, ingest_latency_ms=ingest_ms)
+
               if self.vis:
+                # OpenCV expects NV12 as a single array of shape (height * 3 // 2, width)
+                yuv_image = np.frombuffer(msg.data, dtype=np.uint8).reshape((msg.height * 3 // 2, msg.width))
                 # Convert NV12 to BGR using OpenCV
-                cv_image = cv2.cvtColor(vis_yuv, cv2.COLOR_YUV2BGR_NV12)
+                cv_image = cv2.cvtColor(yuv_image, cv2.COLOR_YUV2BGR_NV12)
                 cv2.imshow('camera0', cv_image)
                 cv2.waitKey(1)
           else:
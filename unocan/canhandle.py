@@ -1,34 +1,63 @@
 from .utils import logger
+import time
+from collections import deque
 import can
 
+from openpilot.common.realtime import DT_CTRL
 from openpilot.selfdrive.pandad.pandad_api_impl import can_list_to_can_capnp
 from opendbc.car.common.conversions import Conversions as CV
 import cereal.messaging as messaging
 from opendbc.car.can_definitions import CanData
 
+MAX_RECV_FRAMES = 1000  # per published can message
+TX_QUEUE_SIZE = 256  # frames held back while the kernel tx queue is full
+TX_MAX_AGE = DT_CTRL  # seconds, queued frames older than one control cycle are stale
+TX_WARNING_INTERVAL = 1.  # seconds between tx queue warnings
+
 class CanHandle:
-  # TODO: implement can_send_many and can_recv
   def __init__(self, channel: str = "can0", bus: int = 0, fd: bool = False):
     self.interface = "socketcan"
     self.channel = channel
-    self.bus = bus
+    self.src = bus
     self.fd = fd
     # self.can_logger = can.Logger(filename='can_log.asc', append=False)
     self.bus = can.Bus(interface=self.interface, channel=self.channel, bitrate=500000)
     self.pm = messaging.PubMaster(['can'])
     # notifier = can.Notifier(self.bus, [self.can_logger, can.Printer()])
 
+    self.tx_queue: deque[tuple[float, can.Message]] = deque()  # (monotonic time queued, frame)
+    self.tx_dropped = 0
+    self.last_tx_warning = 0.0
+    self.rx_frames = 0
+    self.rx_latency = 0.0  # seconds from the kernel rx timestamp to publishing, for the last frame
+
   def can_send(self, address: int, data: bytes, bus: int = 0):
-    self.can_send_many([(address, data, bus)])
+    self.can_send_many([CanData(address, data, bus)])
 
-  def can_send_many(self, messages: list[tuple[int, bytes, int]], timeout: int = 25):
-    # logger.info(f"Sending {len(messages)} messages {messages}")
-    logger.info(f"Sending {len(messages)} messages")
+  def can_send_many(self, messages: list[CanData], timeout: int = 25):
+    logger.debug(f"Sending {len(messages)} messages")
+    # queue the whole sendcan message first, anything the kernel can't take
+    # within timeout (ms) stays queued for the next call, oldest dropped first.
+    # frames from an earlier sendcan message are dropped once they're older than
+    # a control cycle, so a stalled bus doesn't replay old actuator commands
+    now = time.monotonic()
     for msg in messages:
-      # print ("sending msg", msg)
-      can_msg = can.Message(arbitration_id=msg.address, data=msg.dat, is_extended_id=False, is_rx=False, channel=self.channel)
-      # print ("sent ", can_msg)
-      self.bus.send(can_msg)
+      self.tx_queue.append((now, can.Message(arbitration_id=msg.address, data=msg.dat, is_extended_id=False, is_rx=False, channel=self.channel)))
+    while self.tx_queue and (len(self.tx_queue) > TX_QUEUE_SIZE or now - self.tx_queue[0][0] > TX_MAX_AGE):
+      self.tx_queue.popleft()
+      self.tx_dropped += 1
+
+    deadline = now + timeout / 1000
+    while self.tx_queue:
+      try:
+        self.bus.send(self.tx_queue[0][1], timeout=max(deadline - time.monotonic(), 0))
+      except can.CanError:
+        break
+      self.tx_queue.popleft()
+
+    if self.tx_queue and time.monotonic() - self.last_tx_warning > TX_WARNING_INTERVAL:
+      logger.warning(f"CAN tx queue full, {len(self.tx_queue)} frames pending, {self.tx_dropped} dropped")
+      self.last_tx_warning = time.monotonic()
 
   def set_obd(self, obd):
     pass
@@ -37,24 +66,30 @@ class CanHandle:
   def health(self):
     return {
       'controls_allowed': True,
+      'tx_queue_depth': len(self.tx_queue),
+      'tx_dropped': self.tx_dropped,
+      'rx_frames': self.rx_frames,
+      'rx_latency': self.rx_latency,
     }
 
-  def can_recv(self):
-    # self.can_recv()
-    # logger.info("Receiving messages")
-    # debug use
-    # return [(592, b'\x00\x00\x00\x00\x00\x00@\x00', 0)]
-    msg = self.bus.recv(0.1)
+  def can_recv(self, timeout: float = 0.1):
+    # wait for the first frame, then drain everything the socket already has
     msg_list = []
-    if msg is None:
-      msg_list = [] # empty list
-    else:
-      msg_list.append((msg.arbitration_id, msg.data, 0))
-    # print ("receive can messages from unocan board from Ecar E70", len(msg_list))
-    # print (msg_list)
+    msg = self.bus.recv(timeout)
+    last_timestamp = 0.0
+    while msg is not None:
+      msg_list.append((msg.arbitration_id, msg.data, self.src))
+      last_timestamp = msg.timestamp
+      if len(msg_list) >= MAX_RECV_FRAMES:
+        break
+      msg = self.bus.recv(0)
+
     self.pm.send("can", can_list_to_can_capnp(msg_list))
-    # print (msg)
+    if msg_list:
+      self.rx_frames += len(msg_list)
+      # socketcan timestamps come from the kernel (SO_TIMESTAMP) on the wall clock
+      self.rx_latency = time.time() - last_timestamp  # noqa: TID251
     return msg_list
 
   def reset(self):
-    logger.info("Resetting CAN handle")
\ No newline at end of file
+    logger.info("Resetting CAN handle")
@@ -0,0 +1,94 @@
+import can
+import pytest
+
+from opendbc.car.can_definitions import CanData
+from unocan import canhandle
+from unocan.canhandle import CanHandle, TX_MAX_AGE, TX_QUEUE_SIZE
+
+
+class FakeBus:
+  """Kernel tx queue that takes `room` frames before sends time out."""
+  def __init__(self, *args, **kwargs):
+    self.room = 1000
+    self.sent: list[can.Message] = []
+
+  def send(self, msg, timeout=None):
+    if self.room == 0:
+      raise can.CanOperationError("Transmit buffer full")
+    self.room -= 1
+    self.sent.append(msg)
+
+
+def frames(n, start=0):
+  return [CanData(start + i, bytes([i % 256]), 0) for i in range(n)]
+
+
+class TestCanHandle:
+  @pytest.fixture(autouse=True)
+  def setup_handle(self, mocker):
+    mocker.patch.object(canhandle.can, 'Bus', FakeBus)
+    mocker.patch.object(canhandle.messaging, 'PubMaster')
+    self.t = 100.
+    mocker.patch.object(canhandle.time, 'monotonic', lambda: self.t)
+    self.ch = CanHandle()
+    self.bus = self.ch.bus
+
+  def sent(self):
+    return [msg.arbitration_id for msg in self.bus.sent]
+
+  def test_send(self):
+    self.ch.can_send_many(frames(3))
+    assert self.sent() == [0, 1, 2]
+    assert len(self.ch.tx_queue) == 0
+
+  def test_pending_drained(self):
+    self.bus.room = 2
+    self.ch.can_send_many(frames(5))
+    assert self.sent() == [0, 1]
+    assert len(self.ch.tx_queue) == 3
+
+    # the rest goes out in order within the same control cycle
+    self.bus.room = 1000
+    self.ch.can_send_many([])
+    assert self.sent() == [0, 1, 2, 3, 4]
+    assert len(self.ch.tx_queue) == 0
+    assert self.ch.tx_dropped == 0
+
+  def test_drop_oldest(self):
+    self.bus.room = 0
+    self.ch.can_send_many(frames(TX_QUEUE_SIZE))
+    self.ch.can_send_many(frames(10, start=TX_QUEUE_SIZE))
+    assert len(self.ch.tx_queue) == TX_QUEUE_SIZE
+    assert self.ch.tx_dropped == 10
+
+    self.bus.room = 1000
+    self.ch.can_send_many([])
+    assert self.sent() == list(range(10, TX_QUEUE_SIZE + 10))
+
+  def test_stale_frames_dropped(self):
+    # the bus stalls for a control cycle, only the newest sendcan goes out once it recovers
+    self.bus.room = 0
+    self.ch.can_send_many(frames(3))
+    self.t += TX_MAX_AGE * 2
+    self.bus.room = 1000
+    self.ch.can_send_many(frames(2, start=10))
+    assert self.sent() == [10, 11]
+    assert self.ch.tx_dropped == 3
+
+  def test_warning_rate_limited(self, mocker):
+    warning = mocker.patch.object(canhandle.logger, 'warning')
+    self.bus.room = 0
+    for _ in range(10):
+      self.ch.can_send_many(frames(1))
+      self.t += 0.01
+    assert warning.call_count == 1
+
+  def test_health(self):
+    self.bus.room = 1
+    self.ch.can_send_many(frames(3))
+    self.t += TX_MAX_AGE * 2
+    self.ch.can_send_many([])
+    health = self.ch.health()
+    assert health['tx_queue_depth'] == 0
+    assert health['tx_dropped'] == 2
+    assert health['rx_frames'] == 0
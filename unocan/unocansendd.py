@@ -1,29 +1,69 @@
+import time
+import threading
+
 from cereal import messaging
-from openpilot.common.realtime import Ratekeeper
 from unocan import CanHandle
+from unocan.utils import logger, LatencyHistogram
+
+STATS_INTERVAL = 10.  # seconds between latency summaries
+RX_TIMEOUT = 0.1  # seconds, only bounds how quickly the rx thread notices exit
+TX_TIMEOUT = 10  # ms to wait on the kernel per update, one control cycle
 
-RATE=50
 
 class CanSend:
   def __init__(self) -> None:
-    self.rk = Ratekeeper(RATE, print_delay_threshold=None)
     self.ch = CanHandle()
-    self.sm = messaging.SubMaster(['sendcan'])
+    # no conflate, every sendcan message has to go out
+    self.sendcan_sock = messaging.sub_sock('sendcan', timeout=100)
+    self.exit_event = threading.Event()
+    self.rx_error: Exception | None = None
+
+    # sendcan logMonoTime until the frames are handed to the kernel
+    self.tx_latency = LatencyHistogram("sendcan to wire")
+    self.last_stats = time.monotonic()
+
+  def can_recv_thread(self):
+    # publishes to can as soon as frames arrive, independent of sendcan
+    try:
+      while not self.exit_event.is_set():
+        self.ch.can_recv(timeout=RX_TIMEOUT)
+    except Exception as e:
+      # e.g. the interface went down, stop tx too so the process exits and gets restarted
+      logger.exception("can rx failed")
+      self.rx_error = e
+      self.exit_event.set()
 
   def update(self):
-    self.sm.update()
-    if self.sm.valid['sendcan']:
-      self.ch.can_send_many(self.sm["sendcan"], timeout=25)
-    self.ch.can_recv()
-    self.rk.keep_time()
+    msgs = [msg for msg in messaging.drain_sock(self.sendcan_sock, wait_for_one=True) if msg.valid]
+    for i, msg in enumerate(msgs):
+      # only wait on the kernel for the newest message, so a stalled bus can't make us fall behind sendcan
+      self.ch.can_send_many(msg.sendcan, timeout=TX_TIMEOUT if i == len(msgs) - 1 else 0)
+      self.tx_latency.add((time.monotonic_ns() - msg.logMonoTime) / 1e6)
+
+    if not msgs and self.ch.tx_queue:
+      # retry frames the kernel couldn't take while sendcan is quiet
+      self.ch.can_send_many([], timeout=TX_TIMEOUT)
+
+    if time.monotonic() - self.last_stats > STATS_INTERVAL:
+      logger.info(self.tx_latency.summary())
+      self.tx_latency.reset()
+      self.last_stats = time.monotonic()
 
   def cansend_thread(self):
-    while True:
-      self.update()
+    rx_thread = threading.Thread(target=self.can_recv_thread, daemon=True)
+    rx_thread.start()
+    try:
+      while not self.exit_event.is_set():
+        self.update()
+    finally:
+      self.exit_event.set()
+      rx_thread.join()
+    if self.rx_error is not None:
+      raise self.rx_error
 
 def main():
   cansendd = CanSend()
   cansendd.cansend_thread()
 
 if __name__ == "__main__":
-  main()
\ No newline at end of file
+  main()
@@ -9,3 +9,46 @@ logger.setLevel(LOGLEVEL)
 handler = logging.StreamHandler()
 handler.setFormatter(logging.Formatter('%(message)s'))
 logger.addHandler(handler)
+
+
+class LatencyHistogram:
+  """Counts latencies (ms) into fixed buckets, the last bucket catches everything above the largest bound."""
+  BOUNDS_MS = (0.1, 0.25, 0.5, 1, 2.5, 5, 10, 25, 50, 100)
+
+  def __init__(self, name: str):
+    self.name = name
+    self.reset()
+
+  def reset(self) -> None:
+    self.counts = [0] * (len(self.BOUNDS_MS) + 1)
+    self.total = 0
+    self.sum_ms = 0.0
+    self.max_ms = 0.0
+
+  def add(self, latency_ms: float):
+    i = 0
+    while i < len(self.BOUNDS_MS) and latency_ms > self.BOUNDS_MS[i]:
+      i += 1
+    self.counts[i] += 1
+    self.total += 1
+    self.sum_ms += latency_ms
+    self.max_ms = max(self.max_ms, latency_ms)
+
+  def percentile(self, p: float) -> float:
+    # upper bound of the bucket holding the p-th percentile, max_ms for the overflow bucket
+    target = self.total * p / 100
+    seen = 0
+    for bound, count in zip(self.BOUNDS_MS, self.counts, strict=False):
+      seen += count
+      if count and seen >= target:
+        return bound
+    return self.max_ms
+
+  def summary(self) -> str:
+    if self.total == 0:
+      return f"{self.name}: no samples"
+    buckets = " ".join(f"<={b}:{c}" for b, c in zip(self.BOUNDS_MS, self.counts, strict=False) if c)
+    if self.counts[-1]:
+      buckets += f" >{self.BOUNDS_MS[-1]}:{self.counts[-1]}"
+    mean = self.sum_ms / self.total
+    return f"{self.name}: n={self.total} mean={mean:.2f}ms p50<={self.percentile(50)}ms p99<={self.percentile(99)}ms max={self.max_ms:.2f}ms [{buckets}]"